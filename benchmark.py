@@ -0,0 +1,194 @@
+"""
+Benchmark script for Anonymous Chat Bot
+Measures database throughput under different SQLite connection profiles
+
+Usage:
+    python benchmark.py [users]
+"""
+
+import os
+import random
+import re
+import string
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+# Add current directory to path
+sys.path.insert(0, os.path.dirname(__file__))
+
+from database import Database
+from config import SQLITE_PRAGMAS, URL_PATTERNS, BAD_WORDS
+from moderation import ModerationEngine
+
+PROFILES = {
+    'default': {},
+    'tuned': SQLITE_PRAGMAS,
+}
+
+# Typical relayed messages: mostly clean, some with links or bad words
+SAMPLE_MESSAGES = [
+    "hey, how are you doing today?",
+    "i was wondering whether you like music and films, what did you watch lately",
+    "add me @someone_else",
+    "check www.example.com for more",
+    "this is a scam honestly",
+    "lol",
+]
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of samples (nearest rank)"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+def fresh_database(pragmas):
+    """Create an empty on-disk database with the given profile"""
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    return Database(path, pragmas=pragmas)
+
+
+def seed_users(db, count):
+    for user_id in range(1, count + 1):
+        db.create_user(user_id, 'male' if user_id % 2 else 'female', 20 + user_id % 30)
+
+
+def bench_matchmaking(pragmas, users):
+    """Pairs of users: one joins the queue, the other matches. Returns matches/sec."""
+    db = fresh_database(pragmas)
+    seed_users(db, users)
+
+    start = time.perf_counter()
+    matches = 0
+    for user_id in range(1, users, 2):
+        db.atomic_join_queue(user_id, 'any')
+        success, _, _ = db.atomic_match(user_id + 1, 'any')
+        if success:
+            matches += 1
+            db.atomic_end_chat(user_id)
+    elapsed = time.perf_counter() - start
+    return matches / elapsed
+
+
+def bench_batch_matchmaking(pragmas, users):
+    """Everyone joins the queue, then one batched tick pairs them. Returns matches/sec."""
+    db = fresh_database(pragmas)
+    seed_users(db, users)
+
+    start = time.perf_counter()
+    for user_id in range(1, users + 1):
+        db.atomic_join_queue(user_id, 'any')
+    matches = len(db.atomic_match_pending())
+    elapsed = time.perf_counter() - start
+    return matches / elapsed
+
+
+def bench_relay_under_load(pragmas, users, readers=4, duration=2.0):
+    """
+    Relay-style point reads (user state lookups) from several threads while one
+    writer thread runs matchmaking transactions. Returns (reads/sec, p99 ms).
+    """
+    db = fresh_database(pragmas)
+    seed_users(db, users)
+    stop = threading.Event()
+    latencies = [[] for _ in range(readers)]
+
+    def writer():
+        user_id = 1
+        while not stop.is_set():
+            db.atomic_join_queue(user_id, 'any')
+            db.atomic_match(user_id + 1, 'any')
+            db.atomic_end_chat(user_id)
+            user_id = user_id + 2 if user_id + 2 < users else 1
+
+    def reader(samples):
+        user_id = 1
+        while not stop.is_set():
+            started = time.perf_counter()
+            db.get_user_state(user_id)
+            samples.append(time.perf_counter() - started)
+            user_id = user_id % users + 1
+
+    threads = [threading.Thread(target=writer)]
+    threads += [threading.Thread(target=reader, args=(samples,)) for samples in latencies]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    all_samples = [sample for samples in latencies for sample in samples]
+    return len(all_samples) / duration, percentile(all_samples, 99) * 1000
+
+
+def legacy_contains_link(text):
+    """The per-message filter moderation.ModerationEngine replaced (compiles every call)"""
+    url_pattern = re.compile(
+        r'http[s]?://|www\.|t\.me|@\w+|[\w-]+\.(com|net|org|io|co|ru|me)'
+    )
+    return bool(url_pattern.search(text.lower()))
+
+
+def legacy_contains_bad_words(text, bad_words):
+    text_lower = text.lower()
+    return any(word in text_lower for word in bad_words)
+
+
+def bench_moderation(word_count, rounds=2000):
+    """Microseconds per message: legacy link + bad-word checks vs ModerationEngine.check"""
+    rng = random.Random(word_count)
+    words = list(BAD_WORDS) + [
+        ''.join(rng.choices(string.ascii_lowercase, k=7)) for _ in range(max(0, word_count - len(BAD_WORDS)))
+    ]
+    engine = ModerationEngine(URL_PATTERNS, words)
+
+    def legacy():
+        for text in SAMPLE_MESSAGES:
+            legacy_contains_link(text) or legacy_contains_bad_words(text, words)
+
+    def engine_check():
+        for text in SAMPLE_MESSAGES:
+            engine.check(text)
+
+    per_message = rounds * len(SAMPLE_MESSAGES) / 1e6
+    return (
+        timeit.timeit(legacy, number=rounds) / per_message,
+        timeit.timeit(engine_check, number=rounds) / per_message,
+    )
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    print("=" * 60)
+    print(f"Database benchmark ({users} users)")
+    print("=" * 60)
+    print(f"{'profile':<10} {'matches/s':>12} {'batched/s':>12} {'relay reads/s':>15} {'relay p99 ms':>14}")
+
+    for name, pragmas in PROFILES.items():
+        matches_per_sec = bench_matchmaking(pragmas, users)
+        batched_per_sec = bench_batch_matchmaking(pragmas, users)
+        reads_per_sec, p99_ms = bench_relay_under_load(pragmas, users)
+        print(f"{name:<10} {matches_per_sec:>12.0f} {batched_per_sec:>12.0f} {reads_per_sec:>15.0f} {p99_ms:>14.2f}")
+
+    print("=" * 60)
+    print("Moderation (µs per message)")
+    print("=" * 60)
+    print(f"{'bad words':<10} {'legacy':>12} {'engine':>12}")
+
+    for word_count in (len(BAD_WORDS), ModerationEngine.AUTOMATON_MIN_WORDS, 500, 5000):
+        legacy_us, engine_us = bench_moderation(word_count)
+        print(f"{word_count:<10} {legacy_us:>12.2f} {engine_us:>12.2f}")
+
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    main()
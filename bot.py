@@ -3,8 +3,11 @@ Anonymous Telegram Chat Bot
 Main bot file with all handlers and logic
 """
 
+import asyncio
 import logging
-from telegram.error import BadRequest, Forbidden
+import time
+from telegram.constants import ChatMemberStatus, ChatType
+from telegram.error import BadRequest, Forbidden, TelegramError
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -20,35 +23,160 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     PreCheckoutQueryHandler,
+    TypeHandler,
     filters,
     ContextTypes,
     ConversationHandler
 )
-from database import Database
-from config import BOT_TOKEN, ADMIN_IDS, REQUIRED_CHANNELS, VIP_PRICES
-from translations import get_text
-import re
+from database import Database, AsyncDatabase
+from config import (
+    BOT_TOKEN,
+    ADMIN_IDS,
+    REQUIRED_CHANNELS,
+    VIP_PRICES,
+    SUBSCRIPTION_CACHE_TTL,
+    SUBSCRIPTION_CACHE_NEGATIVE_TTL,
+    SUBSCRIPTION_CACHE_SIZE,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    STATS_SNAPSHOT_INTERVAL,
+    STATS_SNAPSHOT_RETENTION_DAYS,
+    VIP_EXPIRY_TICK,
+    VIP_EXPIRY_BATCH,
+    MEMBERSHIP_STALE_AFTER,
+    SQLITE_PRAGMAS,
+    SQLITE_WAL_CHECKPOINT_INTERVAL,
+    MATCHMAKING_MODE,
+    MATCHMAKING_TICK_MS,
+    SEND_GLOBAL_RATE,
+    SEND_PER_CHAT_RATE,
+    SEND_CONCURRENCY,
+    SEND_MAX_RETRIES,
+    BROADCAST_BATCH_SIZE,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_MAX_CONNECTIONS,
+    UPDATE_CONCURRENCY,
+    URL_PATTERNS,
+    BAD_WORDS,
+    BAD_WORDS_FILE,
+    BAD_WORDS_RELOAD_INTERVAL,
+    RELAY_RATE_LIMIT,
+    RELAY_RATE_WINDOW,
+    SEARCH_RATE_LIMIT,
+    SEARCH_RATE_WINDOW,
+    RATE_LIMIT_EVICT_INTERVAL,
+    METRICS_HOST,
+    METRICS_PORT,
+    LOG_LEVEL,
+    LOG_LEVELS,
+    LOG_FORMAT,
+    LOG_SAMPLE_RATES,
+    LOG_FILE,
+)
+from translations import BUTTON_ACTIONS, get_text
+from logging_config import parse_mapping, setup_logging
+from utils import RateLimiter, TTLCache
+import metrics
+from sender import InstrumentedRequest, MessageSender
+from update_processor import PerUserUpdateProcessor
+from request_context import RequestContext, query_stats
+from moderation import ModerationService
 from datetime import datetime
 
-# Enable logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 # Conversation states
 GENDER, AGE = range(2)
 
-# Initialize database
-db = Database()
+# Initialize database. Handlers go through async_db so SQLite never blocks the event loop.
+db = Database(pragmas=SQLITE_PRAGMAS, user_cache_size=USER_CACHE_SIZE, user_cache_ttl=USER_CACHE_TTL)
+async_db = AsyncDatabase(db)
+RequestContext.database = async_db
+
+# (user_id, channel) -> is_member. Saves one get_chat_member call per channel per update.
+membership_cache = TTLCache(max_size=SUBSCRIPTION_CACHE_SIZE, ttl=SUBSCRIPTION_CACHE_TTL)
+
+# Per-user throttles, checked before any DB transaction or API call.
+relay_limiter = RateLimiter(RELAY_RATE_LIMIT, RELAY_RATE_WINDOW)
+search_limiter = RateLimiter(SEARCH_RATE_LIMIT, SEARCH_RATE_WINDOW)
+# At most one "slow down" reply per user per relay window, so the reply can't be abused either.
+throttle_notice_limiter = RateLimiter(1, RELAY_RATE_WINDOW)
+
+# VIPs per /viplist message; keeps each page far below Telegram's 4096-char limit
+VIPLIST_PAGE_SIZE = 25
+
+
+async def mark_unreachable(user_id: int):
+    """A send failed with Forbidden: the user blocked the bot. Skip them until they come back."""
+    if db.is_reachable(user_id):
+        logger.info("[REACHABILITY] User %s blocked the bot", user_id, extra={'event': 'blocked', 'user_id': user_id})
+        await async_db.mark_user_unreachable(user_id)
+
+# Rate-limited fan-out for broadcasts, VIP notices and admin alerts.
+sender = MessageSender(
+    global_rate=SEND_GLOBAL_RATE,
+    per_chat_rate=SEND_PER_CHAT_RATE,
+    max_concurrency=SEND_CONCURRENCY,
+    max_retries=SEND_MAX_RETRIES,
+    on_forbidden=mark_unreachable,
+)
+
+# Link / bad-word filter for relayed messages. Starts with BAD_WORDS only;
+# the word file is loaded (and reloaded on change) by a background job.
+moderation = ModerationService(URL_PATTERNS, BAD_WORDS, BAD_WORDS_FILE)
+
+# Scrape-time gauges: read from the live structures, so they cost nothing between scrapes.
+metrics.Gauge(
+    'chatbot_queue_depth', 'Users waiting in the search queue by bucket', ('gender', 'target_gender', 'vip'),
+    fn=lambda: {(gender, target, str(vip).lower()): n for (gender, target, vip), n in db.matchmaker.depths().items()},
+)
+metrics.Gauge('chatbot_active_chats', 'Chats in progress', fn=lambda: len(db.routes) // 2)
+metrics.Gauge('chatbot_vip_expiry_scheduled', 'VIP subscriptions waiting in the expiry heap', fn=lambda: len(db.vip_expiry))
+
+
+def _cache_stats():
+    return {'user': db.user_cache_stats(), 'membership': membership_cache.stats()}
+
+
+metrics.Gauge(
+    'chatbot_cache_lookups', 'In-process cache lookups since start', ('cache', 'result'),
+    fn=lambda: {
+        (name, result): stats[result + 's']
+        for name, stats in _cache_stats().items()
+        for result in ('hit', 'miss')
+    },
+)
+metrics.Gauge(
+    'chatbot_cache_hit_ratio', 'In-process cache hit ratio since start', ('cache',),
+    fn=lambda: {(name,): stats['hit_rate'] for name, stats in _cache_stats().items()},
+)
+metrics.Gauge(
+    'chatbot_db_calls_per_update', 'Average DB calls per update by update kind', ('kind',),
+    fn=lambda: {(kind,): row['per_update'] for kind, row in query_stats.summary().items()},
+)
 
 class AnonymousChatBot:
     def __init__(self):
         # REMOVED: self.active_chats and self.search_queue
         # All state now managed atomically in database
-        pass
+        self.broadcast_tasks = {}  # {job_id: asyncio.Task} for broadcasts running in this process
+        # Reply-keyboard action (translation key) -> handler; labels resolve via BUTTON_ACTIONS
+        self.menu_actions = {
+            "btn_search": self.search,
+            "btn_next": self.next_partner,
+            "btn_stop": self.stop,
+            "btn_profile": self.profile,
+            "btn_vip": self.vip_info,
+            "btn_rules": self.rules,
+            "btn_help": self.help_command,
+        }
 
     def _format_vip_plan_lines(self, lang: str) -> str:
         return "\n".join(
@@ -67,9 +195,9 @@ class AnonymousChatBot:
             for days, stars in VIP_PRICES.items()
         ])
 
-    def _format_partner_ratings_line(self, target_user_id: int, lang: str = 'en') -> str:
+    async def _format_partner_ratings_line(self, target_user_id: int, lang: str = 'en') -> str:
         """VIP-only: return a one-line summary of partner ratings."""
-        ratings = db.get_user_ratings(target_user_id)
+        ratings = await async_db.get_user_ratings(target_user_id)
 
         good = int(ratings.get('good') or 0)
         bad = int(ratings.get('bad') or 0)
@@ -88,9 +216,68 @@ class AnonymousChatBot:
             total=total,
         )
     
-    def _get_user_lang(self, user_id: int) -> str:
+    async def _match_message(self, viewer: dict, other: dict, lang: str) -> str:
+        """Match notification for viewer; VIPs also see the partner's profile and ratings."""
+        text = get_text("match_found", lang)
+        if viewer.get('is_vip'):
+            gender_emoji = "♂️" if other['gender'] == 'male' else "♀️" if other['gender'] == 'female' else "⚧️"
+            text += f"\n\n👑 VIP Info: {gender_emoji} {other['gender'].capitalize()}, {other['age']} years old"
+            text += "\n" + await self._format_partner_ratings_line(other['user_id'], lang)
+        else:
+            text += get_text("vip_match_upsell", lang)
+        return text
+
+    async def _send_or_prune(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, **kwargs) -> bool:
+        """Send a message; if the recipient blocked the bot, flag them unreachable. Returns True if delivered."""
+        try:
+            await context.bot.send_message(chat_id, text, **kwargs)
+            return True
+        except Forbidden as e:
+            logger.warning("Could not send to %s: %s", chat_id, e)
+            await mark_unreachable(chat_id)
+            return False
+
+    async def _announce_match(self, context: ContextTypes.DEFAULT_TYPE, user_id: int, partner_id: int, chat_id: int):
+        """Send match notifications for a pair made by the batched matchmaking tick."""
+        logger.info("[MATCH TICK] Matched %s <-> %s", user_id, partner_id,
+                    extra={'event': 'match', 'user_id': user_id, 'partner_id': partner_id, 'chat_id': chat_id})
+        user, partner = await asyncio.gather(async_db.get_user(user_id), async_db.get_user(partner_id))
+        user_lang, partner_lang = await asyncio.gather(self._get_user_lang(user_id), self._get_user_lang(partner_id))
+        results = await asyncio.gather(
+            self._send_or_prune(context, user_id, await self._match_message(user, partner, user_lang)),
+            self._send_or_prune(context, partner_id, await self._match_message(partner, user, partner_lang)),
+            return_exceptions=True,
+        )
+        for recipient_id, result in zip((user_id, partner_id), results):
+            if isinstance(result, Exception):
+                logger.warning("[MATCH TICK] Could not notify %s: %s", recipient_id, result)
+            elif not result:
+                # Blocked the bot: end the chat so the other side isn't left talking to nobody
+                await self._disconnect_user(recipient_id, context, reason='BLOCKED')
+
+    async def matchmaking_tick(self, context: ContextTypes.DEFAULT_TYPE):
+        """Batched matchmaking: pair the whole queue in one transaction, then notify everyone together."""
+        started = time.perf_counter()
+        pairs = await async_db.atomic_match_pending()
+        if not pairs:
+            return
+        await asyncio.gather(*(self._announce_match(context, *pair) for pair in pairs))
+        logger.info("[MATCH TICK] Matched %s pairs", len(pairs),
+                    extra={'event': 'match_tick', 'pairs': len(pairs), 'duration': time.perf_counter() - started})
+
+    @staticmethod
+    def _chat_id(user_id: int):
+        """chat_sessions id of the user's active chat (routing table, no DB hop), or None"""
+        route = db.get_route(user_id)
+        return route[1] if route else None
+
+    async def _get_user_lang(self, user_id: int) -> str:
         """Get user's preferred language, default to 'en'."""
-        return db.get_user_language(user_id)
+        # Chatting users carry their language in the routing table (no DB hop).
+        route = db.get_route(user_id)
+        if route:
+            return route[2]
+        return await async_db.get_user_language(user_id)
     
     def _detect_language(self, update: Update) -> str:
         """Detect language from Telegram client."""
@@ -123,7 +310,7 @@ class AnonymousChatBot:
             reply_markup=self._main_menu_keyboard(lang),
         )
 
-    def _resolve_target_user_id(self, raw_target: str):
+    async def _resolve_target_user_id(self, raw_target: str):
         """Resolve admin target from either numeric id or @username.
 
         Returns:
@@ -138,7 +325,7 @@ class AnonymousChatBot:
         if raw_target.lstrip('-').isdigit():
             return int(raw_target)
 
-        user_row = db.get_user_by_username(raw_target)
+        user_row = await async_db.get_user_by_username(raw_target)
         if not user_row:
             return None
         return int(user_row['user_id'])
@@ -147,30 +334,17 @@ class AnonymousChatBot:
         """
         Get partner_id from active chat session.
         Returns None if user is not in CHATTING state.
+        Served from the in-memory routing table, so safe to call from the event loop.
         """
-        state_info = db.get_user_state(user_id)
-        if not state_info or state_info['state'] != 'CHATTING' or not state_info['chat_id']:
-            return None
-        
-        # Get partner from chat_sessions table
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT user1_id, user2_id FROM chat_sessions WHERE chat_id = ?
-        ''', (state_info['chat_id'],))
-        row = cursor.fetchone()
-        if not row:
-            return None
-        
-        return row['user2_id'] if row['user1_id'] == user_id else row['user1_id']
-        
+        return db.get_partner_id(user_id)
+
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
         user_id = update.effective_user.id
         username = (update.effective_user.username or None)
 
         # Check if user exists in database
-        user = db.get_user(user_id)
+        user = await context.user_row()
 
         if not user:
             # New user - check if language was already selected
@@ -206,11 +380,12 @@ class AnonymousChatBot:
             if not await self.check_subscriptions(update, context):
                 return
             
-            lang = self._get_user_lang(user_id)
+            lang = await context.user_lang()
             
             # Persist username for admin tools (/ban /unban /givevip by @username)
             if username and user.get('username') != username:
-                db.set_username(user_id, username)
+                await async_db.set_username(user_id, username)
+                context.forget()
 
             # VIP: reset target choice each time user starts the bot, so next /search shows
             # Boy/Girl/Random options again.
@@ -223,22 +398,120 @@ class AnonymousChatBot:
                 lang,
             )
 
-    async def _get_missing_required_channels(self, user_id: int, context: ContextTypes.DEFAULT_TYPE):
-        """Return required channels the user is not currently subscribed to."""
+    def _cache_membership(self, user_id: int, channel: str, is_member: bool):
+        membership_cache.set(
+            (user_id, channel),
+            is_member,
+            ttl=SUBSCRIPTION_CACHE_TTL if is_member else SUBSCRIPTION_CACHE_NEGATIVE_TTL,
+        )
+
+    async def _fetch_channel_membership(self, user_id: int, channel: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """Live get_chat_member check for one channel; result is cached and stored."""
+        try:
+            member = await context.bot.get_chat_member(channel, user_id)
+        except Exception as e:
+            # Don't cache API errors: the next interaction retries.
+            logger.error("Error checking subscription for %s: %s", channel, e)
+            return False
+
+        is_member = member.status not in ('left', 'kicked')
+        self._cache_membership(user_id, channel, is_member)
+        await async_db.set_channel_membership(user_id, channel, is_member)
+        return is_member
+
+    def _required_channel_for(self, chat):
+        """Map a Telegram chat to its REQUIRED_CHANNELS entry (@username or numeric id)."""
+        username = (chat.username or '').lower()
+        for channel in REQUIRED_CHANNELS:
+            if channel == str(chat.id) or (username and channel.lstrip('@').lower() == username):
+                return channel
+        return None
+
+    async def _get_missing_required_channels(self, user_id: int, context: ContextTypes.DEFAULT_TYPE, live: bool = False):
+        """Return required channels the user is not currently subscribed to.
+
+        Lookup order: membership cache, then state stored from chat_member updates
+        (positives if fresher than MEMBERSHIP_STALE_AFTER, negatives only within
+        SUBSCRIPTION_CACHE_NEGATIVE_TTL), then live API checks in parallel.
+        live=True skips straight to the API.
+        """
         if not REQUIRED_CHANNELS:
             return []
 
-        not_subscribed = []
-        for channel in REQUIRED_CHANNELS:
-            try:
-                member = await context.bot.get_chat_member(channel, user_id)
-                if member.status in ['left', 'kicked']:
-                    not_subscribed.append(channel)
-            except Exception as e:
-                logger.error(f"Error checking subscription for {channel}: {e}")
-                not_subscribed.append(channel)
+        membership = {}
+        if not live:
+            for channel in REQUIRED_CHANNELS:
+                cached = membership_cache.get((user_id, channel))
+                if cached is not None:
+                    membership[channel] = cached
+
+            if len(membership) < len(REQUIRED_CHANNELS):
+                # Stored negatives age like cached ones: the user may have joined since.
+                stored = await async_db.get_channel_memberships(
+                    user_id, MEMBERSHIP_STALE_AFTER, SUBSCRIPTION_CACHE_NEGATIVE_TTL
+                )
+                for channel in REQUIRED_CHANNELS:
+                    if channel not in membership and channel in stored:
+                        membership[channel] = stored[channel]
+                        self._cache_membership(user_id, channel, stored[channel])
+
+        unknown = [channel for channel in REQUIRED_CHANNELS if channel not in membership]
+        if unknown:
+            results = await asyncio.gather(
+                *(self._fetch_channel_membership(user_id, channel, context) for channel in unknown)
+            )
+            membership.update(zip(unknown, results))
 
-        return not_subscribed
+        return [channel for channel in REQUIRED_CHANNELS if not membership[channel]]
+
+    async def channel_member_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Track joins/leaves in required channels (bot must be admin there)."""
+        chat_member = update.chat_member
+        channel = self._required_channel_for(chat_member.chat)
+        if not channel:
+            return
+
+        new_member = chat_member.new_chat_member
+        user_id = new_member.user.id
+        is_member = new_member.status not in ('left', 'kicked') and getattr(new_member, 'is_member', True)
+
+        self._cache_membership(user_id, channel, is_member)
+        await async_db.set_channel_membership(user_id, channel, is_member)
+
+        if is_member or user_id in ADMIN_IDS:
+            return
+
+        # The member can differ from the sender (an admin removing them), so
+        # this can't go through context.user_row().
+        user = await async_db.get_user(user_id)
+        if not user:
+            return
+
+        logger.info("[SUBSCRIPTION] User %s left %s", user_id, channel)
+        if user.get('subscribed'):
+            await async_db.update_user_subscription(user_id, False)
+        await self._disconnect_user(user_id, context)
+
+    async def bot_member_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Private chat my_chat_member: the user blocked (kicked) or restarted the bot."""
+        chat_member = update.my_chat_member
+        if chat_member.chat.type != ChatType.PRIVATE:
+            return
+
+        user_id = chat_member.chat.id
+        if chat_member.new_chat_member.status == ChatMemberStatus.BANNED:
+            await mark_unreachable(user_id)
+            await self._disconnect_user(user_id, context, reason='BLOCKED')
+        else:
+            await async_db.mark_user_reachable(user_id)
+
+    async def track_reachability(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Any message/callback from an unreachable user means they unblocked the bot."""
+        user = update.effective_user
+        if not user or update.chat_member or update.my_chat_member:
+            return
+        if not db.is_reachable(user.id):
+            await async_db.mark_user_reachable(user.id)
 
     async def _send_subscription_required_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str, channels=None):
         """Send a subscription prompt that works for both messages and callbacks."""
@@ -252,32 +525,34 @@ class AnonymousChatBot:
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
 
-    async def _disconnect_user_for_subscription_loss(self, user_id: int, context: ContextTypes.DEFAULT_TYPE):
-        """Force user out of queue/chat after they unsubscribe from required channels."""
-        state_info = db.get_user_state(user_id)
+    async def _disconnect_user(self, user_id: int, context: ContextTypes.DEFAULT_TYPE, reason: str = 'SUBSCRIPTION'):
+        """Force user out of queue/chat (left a required channel, or blocked the bot)."""
+        state_info = await async_db.get_user_state(user_id)
         if not state_info:
             return
 
         if state_info['state'] == 'SEARCHING':
-            db.atomic_leave_queue(user_id)
+            await async_db.atomic_leave_queue(user_id)
             return
 
         if state_info['state'] in ('CHATTING', 'RATING'):
-            success, partner_id, _ = db.atomic_end_chat(user_id)
+            success, partner_id, _ = await async_db.atomic_end_chat(user_id)
             if success and partner_id:
-                partner_lang = self._get_user_lang(partner_id)
+                partner_lang = await self._get_user_lang(partner_id)
                 try:
                     await context.bot.send_message(
                         partner_id,
                         get_text("partner_left", partner_lang)
                     )
                 except (Forbidden, BadRequest) as e:
-                    logger.warning(f"[SUBSCRIPTION] Could not notify partner {partner_id}: {e}")
+                    if isinstance(e, Forbidden):
+                        await mark_unreachable(partner_id)
+                    logger.warning("[%s] Could not notify partner %s: %s", reason, partner_id, e)
 
                 try:
                     await self.show_rating_to_user(context, partner_id, user_id)
                 except (Forbidden, BadRequest) as e:
-                    logger.warning(f"[SUBSCRIPTION] Could not send rating to partner {partner_id}: {e}")
+                    logger.warning("[%s] Could not send rating to partner %s: %s", reason, partner_id, e)
 
     async def enforce_live_subscription(self, update: Update, context: ContextTypes.DEFAULT_TYPE, disconnect_active: bool = True) -> bool:
         """Re-check required channels on every important interaction."""
@@ -285,7 +560,7 @@ class AnonymousChatBot:
         if user_id in ADMIN_IDS:
             return True
 
-        user = db.get_user(user_id)
+        user = await context.user_row()
         lang = (
             (user.get('language') if user else None)
             or context.user_data.get('language')
@@ -294,15 +569,17 @@ class AnonymousChatBot:
 
         not_subscribed = await self._get_missing_required_channels(user_id, context)
         if not not_subscribed:
-            if user:
-                db.update_user_subscription(user_id, True)
+            if user and not user.get('subscribed'):
+                await async_db.update_user_subscription(user_id, True)
+                context.forget()
             return True
 
-        if user:
-            db.update_user_subscription(user_id, False)
+        if user and user.get('subscribed'):
+            await async_db.update_user_subscription(user_id, False)
 
         if disconnect_active:
-            await self._disconnect_user_for_subscription_loss(user_id, context)
+            await self._disconnect_user(user_id, context)
+        context.forget()
 
         await self._send_subscription_required_message(update, context, lang, not_subscribed)
         return False
@@ -317,13 +594,14 @@ class AnonymousChatBot:
         await query.answer()
         
         user_id = query.from_user.id
-        user = db.get_user(user_id)
+        user = await context.user_row()
         lang = (
             (user.get('language') if user else None)
             or context.user_data.get('language')
             or self._detect_language(update)
         )
-        not_subscribed = await self._get_missing_required_channels(user_id, context)
+        # The user says they just subscribed: bypass cached/stored (negative) results.
+        not_subscribed = await self._get_missing_required_channels(user_id, context, live=True)
         
         if not_subscribed:
             channel_links = '\n'.join([f"• {ch}" for ch in not_subscribed])
@@ -335,7 +613,7 @@ class AnonymousChatBot:
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
         else:
-            db.update_user_subscription(user_id, True)
+            await async_db.update_user_subscription(user_id, True)
 
             await query.edit_message_text(get_text("subscription_verified", lang))
             
@@ -391,7 +669,8 @@ class AnonymousChatBot:
             gender = context.user_data.get('gender')
             
             username = (update.effective_user.username or None)
-            db.create_user(user_id, gender, age, username=username, language=lang)
+            await async_db.create_user(user_id, gender, age, username=username, language=lang)
+            context.forget()
             
             context.user_data['awaiting_age'] = False
             
@@ -405,17 +684,33 @@ class AnonymousChatBot:
                 get_text("age_invalid_number", lang)
             )
     
+    async def _throttled(self, update: Update, context: ContextTypes.DEFAULT_TYPE, limiter: RateLimiter) -> bool:
+        """True if the user is over the limit (the update should be dropped)"""
+        user_id = update.effective_user.id
+        if limiter.is_allowed(user_id):
+            return False
+
+        if throttle_notice_limiter.is_allowed(user_id):
+            lang = await context.user_lang()
+            await update.effective_message.reply_text(
+                get_text("rate_limited", lang, seconds=max(1, limiter.get_remaining_time(user_id)))
+            )
+        return True
+
     async def search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /search command - atomic matchmaking with state machine"""
+        if await self._throttled(update, context, search_limiter):
+            return
+
         user_id = update.effective_user.id
         msg = update.effective_message
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
         if not await self.enforce_live_subscription(update, context):
             return
         
         # Check if user is registered
-        user = db.get_user(user_id)
+        user = await context.user_row()
         if not user:
             await msg.reply_text(
                 get_text("register_first", lang)
@@ -430,7 +725,7 @@ class AnonymousChatBot:
             return
         
         # Check current state
-        state_info = db.get_user_state(user_id)
+        state_info = await context.user_state()
         if state_info and state_info['state'] == 'CHATTING':
             await msg.reply_text(
                 get_text("already_in_chat", lang)
@@ -464,57 +759,45 @@ class AnonymousChatBot:
         else:
             target_gender = 'any'
         
-        logger.info(f"[ATOMIC] User {user_id} searching with filter: {target_gender}")
+        logger.info("[ATOMIC] User %s searching with filter: %s", user_id, target_gender)
         
-        # Try atomic match first
-        success, partner_id, message = db.atomic_match(user_id, target_gender)
+        # Try atomic match first (in batch mode the matchmaking tick pairs the queue instead)
+        success, partner_id = False, None
+        if MATCHMAKING_MODE != 'batch':
+            success, partner_id, message = await async_db.atomic_match(user_id, target_gender)
         
         if success and partner_id:
             # MATCHED!
-            partner = db.get_user(partner_id)
-            
-            # Notify both users
-            user_is_vip = user['is_vip']
-            partner_is_vip = partner['is_vip']
-            partner_lang = self._get_user_lang(partner_id)
-            
-            user_message = get_text("match_found", lang)
-            partner_message = get_text("match_found", partner_lang)
+            partner = await async_db.get_user(partner_id)
+            partner_lang = await self._get_user_lang(partner_id)
             
-            # Add VIP info
-            if user_is_vip:
-                gender_emoji = "♂️" if partner['gender'] == 'male' else "♀️" if partner['gender'] == 'female' else "⚧️"
-                user_message += f"\n\n👑 VIP Info: {gender_emoji} {partner['gender'].capitalize()}, {partner['age']} years old"
-                user_message += "\n" + self._format_partner_ratings_line(partner_id, lang)
-            else:
-                user_message += get_text("vip_match_upsell", lang)
-            
-            if partner_is_vip:
-                gender_emoji = "♂️" if user['gender'] == 'male' else "♀️" if user['gender'] == 'female' else "⚧️"
-                partner_message += f"\n\n👑 VIP Info: {gender_emoji} {user['gender'].capitalize()}, {user['age']} years old"
-                partner_message += "\n" + self._format_partner_ratings_line(user_id, partner_lang)
-            else:
-                partner_message += get_text("vip_match_upsell", partner_lang)
-            
-            await msg.reply_text(user_message)
-            await context.bot.send_message(partner_id, partner_message)
+            # Notify the partner first: if they blocked the bot, undo the match and keep searching
+            if not await self._send_or_prune(context, partner_id, await self._match_message(partner, user, partner_lang)):
+                await async_db.atomic_end_chat(user_id)
+                success = False
+        
+        if success and partner_id:
+            await msg.reply_text(await self._match_message(user, partner, lang))
             
-            logger.info(f"[ATOMIC] Matched {user_id} <-> {partner_id} (filter: {target_gender}, partner_gender: {partner['gender']})")
+            logger.info("[ATOMIC] Matched %s <-> %s (filter: %s, partner_gender: %s)", user_id, partner_id, target_gender, partner['gender'],
+                        extra={'event': 'match', 'user_id': user_id, 'partner_id': partner_id,
+                               'chat_id': self._chat_id(user_id)})
             
         else:
             # No match found, join queue
-            success, queue_message = db.atomic_join_queue(user_id, target_gender)
+            success, queue_message = await async_db.atomic_join_queue(user_id, target_gender)
             
             if success:
                 await msg.reply_text(
                     get_text("searching", lang)
                 )
-                logger.info(f"[ATOMIC] User {user_id} joined queue with filter: {target_gender}")
+                logger.info("[ATOMIC] User %s joined queue with filter: %s", user_id, target_gender,
+                            extra={'event': 'queue_join', 'user_id': user_id})
             else:
                 await msg.reply_text(
                     f"❗️ {queue_message}"
                 )
-                logger.warning(f"[ATOMIC] User {user_id} failed to join queue: {queue_message}")
+                logger.warning("[ATOMIC] User %s failed to join queue: %s", user_id, queue_message)
 
     async def vip_search_choice_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """VIP-only: handle gender choice before searching."""
@@ -525,10 +808,10 @@ class AnonymousChatBot:
             return
         
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
         
         # Prevent choice change if already searching/chatting
-        state_info = db.get_user_state(user_id)
+        state_info = await context.user_state()
         if state_info and state_info['state'] in ('SEARCHING', 'CHATTING'):
             await query.edit_message_text(
                 get_text("already_in_state", lang).format(state=state_info['state'].lower())
@@ -556,7 +839,7 @@ class AnonymousChatBot:
     async def stop(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /stop command - end current chat or search (atomic)"""
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
         if not await self.enforce_live_subscription(update, context):
             return
@@ -566,7 +849,7 @@ class AnonymousChatBot:
             del context.user_data['vip_target_gender']
 
         # Check state
-        state_info = db.get_user_state(user_id)
+        state_info = await context.user_state()
         if not state_info:
             await update.message.reply_text(
                 get_text("not_in_chat_or_search", lang)
@@ -575,24 +858,25 @@ class AnonymousChatBot:
         
         if state_info['state'] == 'SEARCHING':
             # Leave queue
-            success, message = db.atomic_leave_queue(user_id)
+            success, message = await async_db.atomic_leave_queue(user_id)
             if success:
                 await update.message.reply_text(
                     get_text("search_cancelled", lang)
                 )
-                logger.info(f"[ATOMIC] User {user_id} left search queue")
+                logger.info("[ATOMIC] User %s left search queue", user_id, extra={'event': 'queue_leave', 'user_id': user_id})
             else:
                 await update.message.reply_text(f"❗️ {message}")
             return
         
         if state_info['state'] == 'CHATTING':
             # End chat
-            success, partner_id, message = db.atomic_end_chat(user_id)
+            chat_id = self._chat_id(user_id)  # the route is gone once the chat ends
+            success, partner_id, message = await async_db.atomic_end_chat(user_id)
             if success and partner_id:
                 # Show rating to the user who stopped
                 await self.show_rating(update, context, user_id, partner_id)
 
-                partner_lang = self._get_user_lang(partner_id)
+                partner_lang = await self._get_user_lang(partner_id)
                 # Send "partner left" first, then rating — each wrapped so one failure
                 # doesn't block the other (e.g. partner blocked the bot)
                 try:
@@ -601,13 +885,16 @@ class AnonymousChatBot:
                         get_text("partner_left", partner_lang)
                     )
                 except (Forbidden, BadRequest) as e:
-                    logger.warning(f"[STOP] Could not send partner_left to {partner_id}: {e}")
+                    if isinstance(e, Forbidden):
+                        await mark_unreachable(partner_id)
+                    logger.warning("[STOP] Could not send partner_left to %s: %s", partner_id, e)
                 try:
                     await self.show_rating_to_user(context, partner_id, user_id)
                 except (Forbidden, BadRequest) as e:
-                    logger.warning(f"[STOP] Could not send rating to {partner_id}: {e}")
+                    logger.warning("[STOP] Could not send rating to %s: %s", partner_id, e)
 
-                logger.info(f"[ATOMIC] User {user_id} ended chat with {partner_id}")
+                logger.info("[ATOMIC] User %s ended chat with %s", user_id, partner_id,
+                            extra={'event': 'chat_end', 'user_id': user_id, 'partner_id': partner_id, 'chat_id': chat_id})
             else:
                 await update.message.reply_text(f"❗️ {message}")
             return
@@ -619,12 +906,12 @@ class AnonymousChatBot:
     async def sharelink(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Share your Telegram @username / t.me link with your current partner (consent-based)."""
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
         if not await self.enforce_live_subscription(update, context):
             return
 
-        partner_id = self._get_partner_id(user_id)
+        partner_id = context.partner_id()
         if not partner_id:
             await update.message.reply_text(
                 get_text("not_in_chat", lang)
@@ -657,14 +944,14 @@ class AnonymousChatBot:
             return
 
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
         action = query.data
 
         if action == "sharelink_cancel":
             await query.edit_message_text(get_text("share_cancelled", lang))
             return
 
-        partner_id = self._get_partner_id(user_id)
+        partner_id = context.partner_id()
         if not partner_id:
             await query.edit_message_text(
                 get_text("not_in_chat", lang)
@@ -692,8 +979,11 @@ class AnonymousChatBot:
         Ends current chat + starts new search in one transaction.
         Prevents race conditions.
         """
+        if await self._throttled(update, context, search_limiter):
+            return
+
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
         msg = update.effective_message
 
         if not await self.enforce_live_subscription(update, context):
@@ -704,7 +994,7 @@ class AnonymousChatBot:
             del context.user_data['vip_target_gender']
         
         # Get user info for VIP filter
-        user = db.get_user(user_id)
+        user = await context.user_row()
         if not user:
             await msg.reply_text(
                 get_text("register_first", lang)
@@ -732,70 +1022,63 @@ class AnonymousChatBot:
             target_gender = context.user_data.get('vip_next_target_gender', 'any')
             del context.user_data['vip_next_target_gender']
         
-        logger.info(f"[ATOMIC /next] User {user_id} with filter: {target_gender}")
+        logger.info("[ATOMIC /next] User %s with filter: %s", user_id, target_gender)
         
         # Execute atomic next operation
-        success, action, data = db.atomic_next_partner(user_id, target_gender)
+        success, action, data = await async_db.atomic_next_partner(
+            user_id, target_gender, try_match=MATCHMAKING_MODE != 'batch'
+        )
         
         if not success:
             await msg.reply_text(
                 f"❗️ Error: {data.get('message', 'Unknown error')}"
             )
-            logger.error(f"[ATOMIC /next] Failed for {user_id}: {data.get('message')}")
+            logger.error("[ATOMIC /next] Failed for %s: %s", user_id, data.get('message'))
             return
         
         # Notify old partner that the chat was ended (applies to both 'matched' and 'searching')
         old_partner_id = data.get('old_partner_id')
         if old_partner_id:
-            old_partner_lang = self._get_user_lang(old_partner_id)
+            old_partner_lang = await self._get_user_lang(old_partner_id)
             try:
                 await context.bot.send_message(
                     old_partner_id,
                     get_text("partner_left", old_partner_lang)
                 )
             except (Forbidden, BadRequest) as e:
-                logger.warning(f"[NEXT] Could not send partner_left to old partner {old_partner_id}: {e}")
+                if isinstance(e, Forbidden):
+                    await mark_unreachable(old_partner_id)
+                logger.warning("[NEXT] Could not send partner_left to old partner %s: %s", old_partner_id, e)
             try:
                 await self.show_rating_to_user(context, old_partner_id, user_id)
             except (Forbidden, BadRequest) as e:
-                logger.warning(f"[NEXT] Could not send rating to old partner {old_partner_id}: {e}")
+                logger.warning("[NEXT] Could not send rating to old partner %s: %s", old_partner_id, e)
 
         if action == 'matched':
             # Matched immediately!
             partner_info = data['partner']
             partner_id = partner_info['user_id']
-            partner_lang = self._get_user_lang(partner_id)
-            
-            # Notify both users
-            user_message = get_text("match_found", lang)
-            partner_message = get_text("match_found", partner_lang)
-            
-            # Add VIP info
-            if user.get('is_vip'):
-                gender_emoji = "♂️" if partner_info['gender'] == 'male' else "♀️" if partner_info['gender'] == 'female' else "⚧️"
-                user_message += f"\n\n👑 VIP Info: {gender_emoji} {partner_info['gender'].capitalize()}, {partner_info['age']} years old"
-                user_message += "\n" + self._format_partner_ratings_line(partner_id, lang)
-            else:
-                user_message += get_text("vip_match_upsell", lang)
+            partner_lang = await self._get_user_lang(partner_id)
             
-            if partner_info['is_vip']:
-                gender_emoji = "♂️" if user['gender'] == 'male' else "♀️" if user['gender'] == 'female' else "⚧️"
-                partner_message += f"\n\n👑 VIP Info: {gender_emoji} {user['gender'].capitalize()}, {user['age']} years old"
-                partner_message += "\n" + self._format_partner_ratings_line(user_id, partner_lang)
-            else:
-                partner_message += get_text("vip_match_upsell", partner_lang)
+            # Notify the partner first: if they blocked the bot, undo the match and keep searching
+            if not await self._send_or_prune(context, partner_id, await self._match_message(partner_info, user, partner_lang)):
+                await async_db.atomic_end_chat(user_id)
+                await async_db.atomic_join_queue(user_id, target_gender)
+                await msg.reply_text(get_text("searching", lang))
+                return
             
-            await msg.reply_text(user_message)
-            await context.bot.send_message(partner_id, partner_message)
+            await msg.reply_text(await self._match_message(user, partner_info, lang))
             
-            logger.info(f"[ATOMIC /next] Matched {user_id} <-> {partner_id}")
+            logger.info("[ATOMIC /next] Matched %s <-> %s", user_id, partner_id,
+                        extra={'event': 'match', 'user_id': user_id, 'partner_id': partner_id,
+                               'chat_id': self._chat_id(user_id)})
             
         elif action == 'searching':
             # Joined queue
             await msg.reply_text(
                 get_text("searching", lang)
             )
-            logger.info(f"[ATOMIC /next] User {user_id} joined queue")
+            logger.info("[ATOMIC /next] User %s joined queue", user_id, extra={'event': 'queue_join', 'user_id': user_id})
         
         else:
             await msg.reply_text(
@@ -855,7 +1138,7 @@ class AnonymousChatBot:
         
         await context.bot.send_message(
             rater_id,
-            get_text("rate_partner", self._get_user_lang(rater_id)),
+            get_text("rate_partner", await self._get_user_lang(rater_id)),
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
     
@@ -873,31 +1156,33 @@ class AnonymousChatBot:
         target_id = int(parts[2])
         
         # Record rating
-        db.add_rating(rater_id, target_id, rating_type)
+        await async_db.add_rating(rater_id, target_id, rating_type)
         
         if rating_type == 'scam':
             # Notify admins
-            scam_count = db.get_scam_count(target_id)
-            for admin_id in ADMIN_IDS:
-                await context.bot.send_message(
-                    admin_id,
-                    f"⚠️ REPORT: User {target_id} was reported for scam/abuse\n"
-                    f"Total reports: {scam_count}\n"
-                    f"Reported by: {rater_id}"
-                )
+            scam_count = await async_db.get_scam_count(target_id)
+            alert = (
+                f"⚠️ REPORT: User {target_id} was reported for scam/abuse\n"
+                f"Total reports: {scam_count}\n"
+                f"Reported by: {rater_id}"
+            )
+            await sender.send_many(context.bot, ({'chat_id': admin_id, 'text': alert} for admin_id in ADMIN_IDS))
             
             await query.edit_message_text(
-                get_text("thanks_report", self._get_user_lang(rater_id))
+                get_text("thanks_report", await context.user_lang())
             )
         else:
             await query.edit_message_text(
-                get_text("thanks_rating_with_type", self._get_user_lang(rater_id), rating_type=rating_type)
+                get_text("thanks_rating_with_type", await context.user_lang(), rating_type=rating_type)
             )
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle regular messages - relay to chat partner"""
+        if await self._throttled(update, context, relay_limiter):
+            return
+
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
         if not await self.enforce_live_subscription(update, context):
             return
@@ -912,7 +1197,7 @@ class AnonymousChatBot:
                     )
                     return
 
-                db.update_age(user_id, age)
+                await async_db.update_age(user_id, age)
                 context.user_data['awaiting_age_edit'] = False
                 await update.message.reply_text(
                     get_text("age_updated", lang)
@@ -927,7 +1212,7 @@ class AnonymousChatBot:
             return
         
         # Check if in active chat (atomic)
-        partner_id = self._get_partner_id(user_id)
+        partner_id = context.partner_id()
         if not partner_id:
             await update.message.reply_text(
                 get_text("not_in_chat", lang)
@@ -936,15 +1221,15 @@ class AnonymousChatBot:
         
         message_text = update.message.text
         
-        # Check for links
-        if self.contains_link(message_text):
+        # Check for links and bad words (one pass)
+        verdict = moderation.check(message_text)
+        if verdict.link:
             await update.message.reply_text(
                 get_text("no_links", lang)
             )
             return
         
-        # Check for bad words (basic filter)
-        if self.contains_bad_words(message_text):
+        if verdict.bad_word:
             await update.message.reply_text(
                 get_text("keep_respectful", lang)
             )
@@ -953,20 +1238,30 @@ class AnonymousChatBot:
         # Forward message to partner
         try:
             await context.bot.send_message(partner_id, message_text)
+            logger.info("Relayed text %s -> %s", user_id, partner_id,
+                        extra={'event': 'relay', 'user_id': user_id, 'partner_id': partner_id,
+                               'chat_id': self._chat_id(user_id)})
+        except Forbidden as e:
+            logger.warning("Partner %s blocked the bot: %s", partner_id, e)
+            await mark_unreachable(partner_id)
+            await self._disconnect_user(partner_id, context, reason='BLOCKED')
         except Exception as e:
-            logger.error(f"Error sending message: {e}")
+            logger.error("Error sending message: %s", e)
             await update.message.reply_text(
                 get_text("send_failed", lang)
             )
 
     async def handle_media(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Relay non-text messages (photos, videos, GIFs, etc.) to chat partner."""
+        if await self._throttled(update, context, relay_limiter):
+            return
+
         user_id = update.effective_user.id
 
         if not await self.enforce_live_subscription(update, context):
             return
 
-        partner_id = self._get_partner_id(user_id)
+        partner_id = context.partner_id()
         if not partner_id:
             await update.effective_message.reply_text(
                 "❗️ You're not in an active chat.\nUse /search to find a partner."
@@ -982,35 +1277,28 @@ class AnonymousChatBot:
                 from_chat_id=msg.chat_id,
                 message_id=msg.message_id,
             )
+            logger.info("Relayed media %s -> %s", user_id, partner_id,
+                        extra={'event': 'relay', 'user_id': user_id, 'partner_id': partner_id,
+                               'chat_id': self._chat_id(user_id)})
+        except Forbidden as e:
+            logger.warning("Partner %s blocked the bot: %s", partner_id, e)
+            await mark_unreachable(partner_id)
+            await self._disconnect_user(partner_id, context, reason='BLOCKED')
         except Exception as e:
-            logger.error(f"Error sending media: {e}")
+            logger.error("Error sending media: %s", e)
             await update.effective_message.reply_text(
                 "❗️ Failed to send media. Your partner may have left."
             )
     
-    def contains_link(self, text: str) -> bool:
-        """Check if text contains links"""
-        url_pattern = re.compile(
-            r'http[s]?://|www\.|t\.me|@\w+|[\w-]+\.(com|net|org|io|co|ru|me)'
-        )
-        return bool(url_pattern.search(text.lower()))
-    
-    def contains_bad_words(self, text: str) -> bool:
-        """Check if text contains bad words (basic filter)"""
-        # Add your blacklist here
-        bad_words = ['spam', 'scam']  # Expand this list as needed
-        text_lower = text.lower()
-        return any(word in text_lower for word in bad_words)
-    
     async def profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /profile command"""
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
         if not await self.enforce_live_subscription(update, context):
             return
 
-        user = db.get_user(user_id)
+        user = await context.user_row()
 
         if not user:
             await update.effective_message.reply_text(
@@ -1027,11 +1315,11 @@ class AnonymousChatBot:
         # Add VIP expiration info if user is VIP
         vip_info = vip_status
         if user["is_vip"]:
-            days_remaining = db.get_vip_days_remaining(user_id)
+            days_remaining = await async_db.get_vip_days_remaining(user_id)
             if days_remaining is not None:
                 vip_info = get_text("profile_vip_days", lang, days=days_remaining)
 
-        ratings = db.get_user_ratings(user_id)
+        ratings = await async_db.get_user_ratings(user_id)
 
         profile_text = get_text(
             "profile_text",
@@ -1059,8 +1347,7 @@ class AnonymousChatBot:
         if not await self.enforce_live_subscription(update, context):
             return
 
-        user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
         keyboard = [
             [
@@ -1085,14 +1372,15 @@ class AnonymousChatBot:
             return
 
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
         gender = query.data.split("_")[-1]  # male|female
         if gender not in ("male", "female"):
             await query.edit_message_text(get_text("invalid_gender_choice", lang))
             return
 
-        db.update_gender(user_id, gender)
+        await async_db.update_gender(user_id, gender)
+        context.forget()
         await query.edit_message_text(get_text("gender_updated", lang, gender=gender.capitalize()))
 
     async def edit_profile_age_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1103,8 +1391,7 @@ class AnonymousChatBot:
         if not await self.enforce_live_subscription(update, context):
             return
 
-        user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
         context.user_data["awaiting_age_edit"] = True
         await query.edit_message_text(get_text("edit_profile_enter_age", lang))
@@ -1118,9 +1405,9 @@ class AnonymousChatBot:
             return
 
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
-        user = db.get_user(user_id)
+        user = await context.user_row()
         if not user:
             await query.edit_message_text(get_text("register_first", lang))
             return
@@ -1131,10 +1418,10 @@ class AnonymousChatBot:
         gender_label = get_text(f"gender_{user['gender']}", lang).split(" ", 1)[1]
         vip_status = get_text("vip_member", lang) if user["is_vip"] else get_text("regular_user", lang)
         if user["is_vip"]:
-            days_remaining = db.get_vip_days_remaining(user_id)
+            days_remaining = await async_db.get_vip_days_remaining(user_id)
             if days_remaining is not None:
                 vip_status = get_text("profile_vip_days", lang, days=days_remaining)
-        ratings = db.get_user_ratings(user_id)
+        ratings = await async_db.get_user_ratings(user_id)
         profile_text = get_text(
             "profile_text",
             lang,
@@ -1156,15 +1443,15 @@ class AnonymousChatBot:
     async def vip_info(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /vip command"""
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
         if not await self.enforce_live_subscription(update, context):
             return
 
-        user = db.get_user(user_id)
+        user = await context.user_row()
         
         if user and user['is_vip']:
-            days_remaining = db.get_vip_days_remaining(user_id)
+            days_remaining = await async_db.get_vip_days_remaining(user_id)
             if days_remaining is not None:
                 if days_remaining > 0:
                     # Active VIP with days remaining
@@ -1203,7 +1490,7 @@ class AnonymousChatBot:
             return
         
         user_id = query.from_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
         parts = query.data.split('_')
 
         if len(parts) < 3 or not parts[2].isdigit():
@@ -1241,7 +1528,7 @@ class AnonymousChatBot:
     async def successful_payment(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle successful payment"""
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
         if not await self.enforce_live_subscription(update, context, disconnect_active=False):
             return
@@ -1255,7 +1542,8 @@ class AnonymousChatBot:
         if vip_days not in VIP_PRICES:
             vip_days = 30
 
-        db.set_vip_status(user_id, True, days=vip_days)
+        await async_db.set_vip_status(user_id, True, days=vip_days)
+        context.forget()
         
         await update.message.reply_text(
             get_text("vip_payment_success", lang, days=vip_days)
@@ -1266,8 +1554,7 @@ class AnonymousChatBot:
         if not await self.enforce_live_subscription(update, context):
             return
 
-        user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
         await update.message.reply_text(get_text("rules_text", lang))
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1276,7 +1563,7 @@ class AnonymousChatBot:
             return
 
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
         help_text = get_text("help_text", lang)
         if user_id in ADMIN_IDS:
@@ -1335,8 +1622,9 @@ class AnonymousChatBot:
         if lang_code not in ("en", "ru", "hy"):
             lang_code = "en"
         
-        db.set_user_language(user_id, lang_code)
+        await async_db.set_user_language(user_id, lang_code)
         context.user_data['language'] = lang_code
+        context.forget()
         
         await query.edit_message_text(
             get_text("language_changed", lang_code),
@@ -1354,42 +1642,10 @@ class AnonymousChatBot:
         """Route reply-keyboard button presses to the existing command handlers."""
         text = (update.effective_message.text or "").strip()
         
-        # Try to detect which button was pressed across all languages
-        user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
-        
-        # Build mapping with current language
-        mapping = {
-            get_text("btn_search", lang): self.search,
-            get_text("btn_next", lang): self.next_partner,
-            get_text("btn_stop", lang): self.stop,
-            get_text("btn_profile", lang): self.profile,
-            get_text("btn_vip", lang): self.vip_info,
-            get_text("btn_rules", lang): self.rules,
-            get_text("btn_help", lang): self.help_command,
-        }
-
-        handler = mapping.get(text)
+        # Labels of every language map to the same action, so an old keyboard still works
+        handler = self.menu_actions.get(BUTTON_ACTIONS.get(text))
         if handler is None:
-            # Try all languages as fallback (user might have old keyboard)
-            for fallback_lang in ["en", "ru", "hy"]:
-                if fallback_lang == lang:
-                    continue
-                fallback_mapping = {
-                    get_text("btn_search", fallback_lang): self.search,
-                    get_text("btn_next", fallback_lang): self.next_partner,
-                    get_text("btn_stop", fallback_lang): self.stop,
-                    get_text("btn_profile", fallback_lang): self.profile,
-                    get_text("btn_vip", fallback_lang): self.vip_info,
-                    get_text("btn_rules", fallback_lang): self.rules,
-                    get_text("btn_help", fallback_lang): self.help_command,
-                }
-                handler = fallback_mapping.get(text)
-                if handler:
-                    break
-            
-            if handler is None:
-                return
+            return
 
         await handler(update, context)
     
@@ -1401,7 +1657,7 @@ class AnonymousChatBot:
         if user_id not in ADMIN_IDS:
             return
 
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
         await update.message.reply_text(get_text("admin_commands_list", lang))
 
     async def admin_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1411,19 +1667,39 @@ class AnonymousChatBot:
         if user_id not in ADMIN_IDS:
             return
         
-        stats = db.get_stats()
+        stats = await async_db.get_stats()
+        day_ago = await async_db.get_stats_snapshot(24)
+        week_ago = await async_db.get_stats_snapshot(24 * 7)
+        user_cache = db.user_cache_stats()
+        
+        def line(label, key):
+            # "👥 Total Users: 120 (24h +5, 7d +31)" once snapshots that old exist
+            trends = [
+                f"{period} {stats[key] - snapshot[key]:+d}"
+                for period, snapshot in (("24h", day_ago), ("7d", week_ago))
+                if snapshot
+            ]
+            return f"{label}: {stats[key]}" + (f" ({', '.join(trends)})" if trends else "") + "\n"
         
         stats_text = (
             f"📊 Bot Statistics\n\n"
-            f"👥 Total Users: {stats['total_users']}\n"
-            f"👑 VIP Users: {stats['vip_users']}\n"
-            f"🚫 Banned Users: {stats['banned_users']}\n"
-            f"💬 Active Chats: {stats['active_chats']}\n"
-            f"🔍 Users in Queue: {stats['in_queue']}\n"
-            f"⭐ Total Ratings: {stats['total_ratings']}\n"
-            f"⛔ Total Reports: {stats['total_reports']}"
+            + line("👥 Total Users", 'total_users')
+            + line("👑 VIP Users", 'vip_users')
+            + line("🚫 Banned Users", 'banned_users')
+            + line("💬 Active Chats", 'active_chats')
+            + line("🔍 Users in Queue", 'in_queue')
+            + line("⭐ Total Ratings", 'total_ratings')
+            + line("⛔ Total Reports", 'total_reports')
+            + f"🗃 User cache: {user_cache['hit_rate']:.0%} hits ({user_cache['size']} cached)"
         )
         
+        per_update = query_stats.summary()
+        if per_update:
+            stats_text += "\n\n🧮 DB calls per update:\n" + "\n".join(
+                f"{kind}: {row['per_update']:.1f} ({row['updates']} updates)"
+                for kind, row in sorted(per_update.items())
+            )
+        
         await update.message.reply_text(stats_text)
     
     async def admin_ban(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1438,18 +1714,18 @@ class AnonymousChatBot:
             return
         
         try:
-            target_id = self._resolve_target_user_id(context.args[0])
+            target_id = await self._resolve_target_user_id(context.args[0])
             if target_id is None:
                 await update.message.reply_text(
                     "❗️ Unknown target. Use numeric id or @username. (User must have started the bot at least once.)"
                 )
                 return
-            db.ban_user(target_id)
+            await async_db.ban_user(target_id)
             
             # Disconnect if in chat (atomic)
-            state_info = db.get_user_state(target_id)
+            state_info = await async_db.get_user_state(target_id)
             if state_info and state_info['state'] == 'CHATTING':
-                success, partner_id, message = db.atomic_end_chat(target_id)
+                success, partner_id, message = await async_db.atomic_end_chat(target_id)
                 if success and partner_id:
                     await context.bot.send_message(
                         partner_id,
@@ -1478,13 +1754,13 @@ class AnonymousChatBot:
             return
         
         try:
-            target_id = self._resolve_target_user_id(context.args[0])
+            target_id = await self._resolve_target_user_id(context.args[0])
             if target_id is None:
                 await update.message.reply_text(
                     get_text("admin_unknown_target", "en")
                 )
                 return
-            db.unban_user(target_id)
+            await async_db.unban_user(target_id)
             
             await update.message.reply_text(get_text("admin_unban_done", "en", user_id=target_id))
             
@@ -1498,13 +1774,13 @@ class AnonymousChatBot:
         if user_id not in ADMIN_IDS:
             return
 
-        changed = db.unban_all_users()
+        changed = await async_db.unban_all_users()
         await update.message.reply_text(get_text("admin_unban_all_done", "en", count=changed))
     
     async def admin_give_vip(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /givevip command (admin only)"""
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
         
         if user_id not in ADMIN_IDS:
             return
@@ -1514,7 +1790,7 @@ class AnonymousChatBot:
             return
         
         try:
-            target_id = self._resolve_target_user_id(context.args[0])
+            target_id = await self._resolve_target_user_id(context.args[0])
             if target_id is None:
                 await update.message.reply_text(
                     get_text("admin_unknown_target", lang)
@@ -1526,11 +1802,11 @@ class AnonymousChatBot:
                 await update.message.reply_text(get_text("admin_invalid_days", lang))
                 return
 
-            db.set_vip_status(target_id, True, days=days)
+            await async_db.set_vip_status(target_id, True, days=days)
             
             await context.bot.send_message(
                 target_id,
-                get_text("admin_vip_granted_target", self._get_user_lang(target_id), days=days)
+                get_text("admin_vip_granted_target", await self._get_user_lang(target_id), days=days)
             )
             
             await update.message.reply_text(get_text("admin_vip_granted_done", lang, user_id=target_id, days=days))
@@ -1546,7 +1822,7 @@ class AnonymousChatBot:
     async def admin_take_vip(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /takevip command (admin only)."""
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
         if user_id not in ADMIN_IDS:
             return
@@ -1556,69 +1832,106 @@ class AnonymousChatBot:
             return
 
         try:
-            target_id = self._resolve_target_user_id(context.args[0])
+            target_id = await self._resolve_target_user_id(context.args[0])
             if target_id is None:
                 await update.message.reply_text(get_text("admin_unknown_target", lang))
                 return
 
-            db.set_vip_status(target_id, False)
+            await async_db.set_vip_status(target_id, False)
 
             try:
                 await context.bot.send_message(
                     target_id,
-                    get_text("admin_vip_removed_target", self._get_user_lang(target_id))
+                    get_text("admin_vip_removed_target", await self._get_user_lang(target_id))
                 )
             except Exception as e:
-                logger.warning(f"Failed to notify {target_id} about VIP removal: {e}")
+                logger.warning("Failed to notify %s about VIP removal: %s", target_id, e)
 
             await update.message.reply_text(get_text("admin_vip_removed_done", lang, user_id=target_id))
 
         except (ValueError, IndexError):
             await update.message.reply_text(get_text("admin_invalid_target", lang))
 
+    async def _vip_list_page(self, lang: str, after=None, before=None, start: int = 1):
+        """Text and prev/next keyboard for one /viplist page, or (None, None) if there are no VIPs."""
+        page = await async_db.get_vip_page(after=after, before=before, limit=VIPLIST_PAGE_SIZE)
+        users = page['users']
+        if not users:
+            if after is not None or before is not None:
+                # The VIPs around the cursor expired or were removed; start over.
+                return await self._vip_list_page(lang)
+            return None, None
+        if before is not None:
+            start = max(1, start - len(users))
+
+        total = (await async_db.get_stats())['vip_users']
+        lines = [get_text("admin_viplist_header", lang, count=total)]
+        for index, vip_user in enumerate(users, start=start):
+            target_id = vip_user['user_id']
+            username = vip_user.get('username')
+            if username:
+                user_label = get_text("admin_viplist_user_label", lang, username=username, user_id=target_id)
+            else:
+                user_label = get_text("admin_viplist_user_id_only", lang, user_id=target_id)
+
+            days_remaining = vip_user['days_remaining']
+            if days_remaining is None:
+                lines.append(get_text("admin_viplist_line_lifetime", lang, index=index, user_label=user_label))
+            else:
+                lines.append(get_text("admin_viplist_line_days", lang, index=index, user_label=user_label, days=days_remaining))
+
+        # callback_data: viplist|<p or n>|<first index of the page being left / entered>|<user_id>|<sort_key>
+        # (at most ~60 bytes: the sort key is a 26-char timestamp)
+        buttons = []
+        if page['has_prev']:
+            first = users[0]
+            buttons.append(InlineKeyboardButton(
+                get_text("admin_viplist_prev", lang),
+                callback_data=f"viplist|p|{start}|{first['user_id']}|{first['sort_key']}",
+            ))
+        if page['has_next']:
+            last = users[-1]
+            buttons.append(InlineKeyboardButton(
+                get_text("admin_viplist_next", lang),
+                callback_data=f"viplist|n|{start + len(users)}|{last['user_id']}|{last['sort_key']}",
+            ))
+        return "\n".join(lines), (InlineKeyboardMarkup([buttons]) if buttons else None)
+
     async def admin_vip_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /viplist command (admin only)."""
         user_id = update.effective_user.id
-        lang = self._get_user_lang(user_id)
+        lang = await context.user_lang()
 
         if user_id not in ADMIN_IDS:
             return
 
-        vip_users = db.get_vip_users()
-        if not vip_users:
+        text, reply_markup = await self._vip_list_page(lang)
+        if text is None:
             await update.message.reply_text(get_text("admin_viplist_empty", lang))
             return
+        await update.message.reply_text(text, reply_markup=reply_markup)
 
-        vip_entries = []
-        for vip_user in vip_users:
-            target_id = vip_user['user_id']
-            username = vip_user.get('username')
-            days_remaining = db.get_vip_days_remaining(target_id)
-
-            if username:
-                user_label = get_text("admin_viplist_user_label", lang, username=username, user_id=target_id)
-            else:
-                user_label = get_text("admin_viplist_user_id_only", lang, user_id=target_id)
-
-            sort_key = days_remaining if days_remaining is not None else 10**9
-            vip_entries.append({
-                'user_label': user_label,
-                'days_remaining': days_remaining,
-                'sort_key': sort_key,
-            })
-
-        vip_entries.sort(key=lambda item: (item['sort_key'], item['user_label'].lower()))
-
-        lines = [get_text("admin_viplist_header", lang, count=len(vip_entries))]
-        for index, vip_entry in enumerate(vip_entries, start=1):
-            days_remaining = vip_entry['days_remaining']
+    async def vip_list_page_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /viplist prev/next buttons (admin only)."""
+        query = update.callback_query
+        user_id = update.effective_user.id
+        if user_id not in ADMIN_IDS:
+            await query.answer()
+            return
 
-            if days_remaining is None:
-                lines.append(get_text("admin_viplist_line_lifetime", lang, index=index, user_label=vip_entry['user_label']))
-            else:
-                lines.append(get_text("admin_viplist_line_days", lang, index=index, user_label=vip_entry['user_label'], days=days_remaining))
+        lang = await context.user_lang()
+        _, direction, start, cursor_user_id, sort_key = query.data.split("|", 4)
+        cursor = (sort_key, int(cursor_user_id))
+        if direction == "p":
+            text, reply_markup = await self._vip_list_page(lang, before=cursor, start=int(start))
+        else:
+            text, reply_markup = await self._vip_list_page(lang, after=cursor, start=int(start))
 
-        await update.message.reply_text("\n".join(lines))
+        await query.answer()
+        if text is None:
+            await query.edit_message_text(get_text("admin_viplist_empty", lang))
+            return
+        await query.edit_message_text(text, reply_markup=reply_markup)
     
     async def admin_reports(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /reports command (admin only)"""
@@ -1627,7 +1940,7 @@ class AnonymousChatBot:
         if user_id not in ADMIN_IDS:
             return
         
-        reports = db.get_recent_reports()
+        reports = await async_db.get_recent_reports()
         
         if not reports:
             await update.message.reply_text(get_text("admin_no_reports", "en"))
@@ -1651,56 +1964,231 @@ class AnonymousChatBot:
             return
         
         message = ' '.join(context.args)
-        users = db.get_all_users()
+        job_id = await async_db.create_broadcast(user_id, message)
+        job = await async_db.get_broadcast(job_id)
+        status = await update.message.reply_text(f"📢 Broadcast #{job_id} started for {job['total']} users...")
+        await async_db.set_broadcast_status_message(job_id, status.message_id)
         
-        success = 0
-        failed = 0
+        self.start_broadcast_worker(context.application, job_id)
+
+    def start_broadcast_worker(self, application: Application, job_id: int):
+        """Run a stored broadcast job in the background (also used to resume after restart)."""
+        if job_id in self.broadcast_tasks:
+            return
+        task = application.create_task(self._run_broadcast_job(application.bot, job_id))
+        self.broadcast_tasks[job_id] = task
+        task.add_done_callback(lambda _: self.broadcast_tasks.pop(job_id, None))
+
+    async def _run_broadcast_job(self, bot, job_id: int):
+        """
+        Stream recipients in keyset batches through the rate-limited sender.
+        The cursor is saved after each batch, so a restart resends at most one batch.
+        """
+        job = await async_db.get_broadcast(job_id)
+        text = f"📢 Announcement:\n\n{job['message']}"
+        cursor = job['last_user_id']
+        sent, failed = job['sent'], job['failed']
+        status = job['status']
+
+        while status == 'running':
+            recipients = await async_db.get_broadcast_recipients(cursor, BROADCAST_BATCH_SIZE)
+            if not recipients:
+                await async_db.finish_broadcast(job_id)
+                status = 'done'
+                break
+
+            stats = await sender.send_many(bot, ({'chat_id': uid, 'text': text} for uid in recipients))
+            cursor = recipients[-1]
+            sent += stats['sent']
+            failed += stats['failed']
+            status = await async_db.advance_broadcast(job_id, cursor, stats['sent'], stats['failed'])
+            await self._edit_broadcast_status(bot, job, f"📢 Broadcast #{job_id}: {sent + failed}/{job['total']}\nSent: {sent}\nFailed: {failed}")
+
+        if status == 'done':
+            await self._edit_broadcast_status(
+                bot, job,
+                f"✅ Broadcast complete!\n"
+                f"Sent: {sent}\n"
+                f"Failed: {failed}"
+            )
+        logger.info("Broadcast #%s %s: sent=%s failed=%s", job_id, status, sent, failed,
+                    extra={'event': 'broadcast', 'job_id': job_id, 'sent': sent, 'failed': failed})
+
+    async def _edit_broadcast_status(self, bot, job: dict, text: str):
+        if not job.get('status_message_id'):
+            return
+        try:
+            await bot.edit_message_text(text, chat_id=job['admin_id'], message_id=job['status_message_id'])
+        except TelegramError:
+            # A failed progress edit (deleted message, NetworkError, TimedOut,
+            # RetryAfter) must not stop the broadcast itself.
+            pass
+
+    async def admin_broadcast_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /broadcast_status command (admin only)"""
+        user_id = update.effective_user.id
         
-        for user in users:
-            try:
-                await context.bot.send_message(user['user_id'], f"📢 Announcement:\n\n{message}")
-                success += 1
-            except Exception as e:
-                failed += 1
-                logger.error(f"Failed to send to {user['user_id']}: {e}")
+        if user_id not in ADMIN_IDS:
+            return
+        
+        job = await async_db.get_broadcast()
+        if not job:
+            await update.message.reply_text("No broadcasts yet.")
+            return
+        
+        await update.message.reply_text(
+            f"📢 Broadcast #{job['job_id']}: {job['status']}\n"
+            f"Progress: {job['sent'] + job['failed']}/{job['total']}\n"
+            f"Sent: {job['sent']}\n"
+            f"Failed: {job['failed']}\n"
+            f"Started: {job['created_at']}"
+        )
+
+    async def admin_broadcast_cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /broadcast_cancel command (admin only)"""
+        user_id = update.effective_user.id
         
+        if user_id not in ADMIN_IDS:
+            return
+        
+        if context.args:
+            if not context.args[0].isdigit():
+                await update.message.reply_text("Usage: /broadcast_cancel [job_id]")
+                return
+            job_ids = [int(context.args[0])]
+        else:
+            # get_broadcast() only sees the newest job; several can be running at once.
+            job_ids = await async_db.get_running_broadcasts()
+        
+        cancelled = []
+        for job_id in job_ids:
+            if not await async_db.finish_broadcast(job_id, 'cancelled'):
+                continue
+            task = self.broadcast_tasks.get(job_id)
+            if task:
+                task.cancel()
+            cancelled.append(job_id)
+        
+        if not cancelled:
+            await update.message.reply_text("No running broadcast.")
+            return
         await update.message.reply_text(
-            f"✅ Broadcast complete!\n"
-            f"Sent: {success}\n"
-            f"Failed: {failed}"
+            "🛑 Cancelled broadcast " + ", ".join(f"#{job_id}" for job_id in cancelled) + "."
         )
 
+    async def admin_reload_words(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /reloadwords command (admin only)"""
+        user_id = update.effective_user.id
+        
+        if user_id not in ADMIN_IDS:
+            return
+        
+        try:
+            await asyncio.to_thread(moderation.reload, True)
+        except OSError as e:
+            await update.message.reply_text(f"❌ Could not read {BAD_WORDS_FILE}: {e}")
+            return
+        await update.message.reply_text(f"✅ Word list reloaded: {moderation.engine.word_count} terms.")
+
 def main():
     """Start the bot"""
+    # Logging goes through a queue; a background thread formats and writes records.
+    # Done here rather than at import, so importing bot (tests, tooling) leaves logging alone.
+    setup_logging(
+        level=LOG_LEVEL,
+        levels=parse_mapping(LOG_LEVELS),
+        fmt=LOG_FORMAT,
+        sample_rates=parse_mapping(LOG_SAMPLE_RATES),
+        log_file=LOG_FILE or None,
+    )
+    
     # Create bot instance
     bot = AnonymousChatBot()
     
     # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        # Same pool size PTB uses by default; the subclass only adds API call metrics.
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .context_types(ContextTypes(context=RequestContext))
+        .build()
+    )
     
-    # Background task to check VIP expirations
+    def notify_vip_expired(context: ContextTypes.DEFAULT_TYPE, expired_users):
+        """Send expiry notices through the rate-limited sender without holding up the job"""
+        logger.info("Expired %s VIP subscriptions", len(expired_users),
+                    extra={'event': 'vip_expired', 'count': len(expired_users)})
+
+        def notices():
+            for expired_user in expired_users:
+                lang = expired_user.get('language') or 'en'
+                yield {
+                    'chat_id': expired_user['user_id'],
+                    'text': get_text("vip_expired_text", lang, plans=bot._format_vip_plan_lines(lang)),
+                    'reply_markup': bot._vip_plan_keyboard(lang),
+                }
+
+        context.application.create_task(sender.send_many(context.bot, notices()))
+
+    async def expire_due_vips(context: ContextTypes.DEFAULT_TYPE):
+        """Expire VIPs within seconds of their deadline (driven by the in-memory expiry heap)"""
+        deadline = db.vip_expiry.next_deadline()
+        if deadline is None or deadline > time.time():
+            return  # nothing due: no DB call
+        try:
+            expired_users = await async_db.expire_due_vips(VIP_EXPIRY_BATCH)
+            if expired_users:
+                notify_vip_expired(context, expired_users)
+        except Exception as e:
+            logger.error("Error expiring VIPs: %s", e)
+
+    # Daily safety net for VIPs the expiry heap doesn't know about
     async def check_vip_expirations(context: ContextTypes.DEFAULT_TYPE):
-        """Check and expire VIP subscriptions daily"""
+        """Expire any VIP subscription past its deadline"""
         try:
-            expired_users = db.check_and_expire_vips()
+            expired_users = await async_db.check_and_expire_vips()
             if expired_users:
-                logger.info(f"Expired {len(expired_users)} VIP subscriptions")
-
-                for expired_user in expired_users:
-                    expired_user_id = expired_user['user_id']
-                    lang = expired_user.get('language') or 'en'
-                    keyboard = bot._vip_plan_keyboard(lang)
-
-                    try:
-                        await context.bot.send_message(
-                            expired_user_id,
-                            get_text("vip_expired_text", lang, plans=bot._format_vip_plan_lines(lang)),
-                            reply_markup=keyboard,
-                        )
-                    except (Forbidden, BadRequest) as e:
-                        logger.warning(f"Could not send VIP expiration notice to {expired_user_id}: {e}")
+                notify_vip_expired(context, expired_users)
+        except Exception as e:
+            logger.error("Error checking VIP expirations: %s", e)
+
+    async def checkpoint_wal(context: ContextTypes.DEFAULT_TYPE):
+        """Keep the WAL file from growing between SQLite's automatic checkpoints"""
+        try:
+            busy, wal_pages, checkpointed = await async_db.wal_checkpoint()
+            if busy:
+                logger.warning("WAL checkpoint incomplete: %s/%s pages", checkpointed, wal_pages)
+        except Exception as e:
+            logger.error("Error checkpointing WAL: %s", e)
+    
+    async def snapshot_stats(context: ContextTypes.DEFAULT_TYPE):
+        """Record the /stats counters so /stats can show trends"""
+        try:
+            await async_db.take_stats_snapshot(STATS_SNAPSHOT_RETENTION_DAYS)
+        except Exception as e:
+            logger.error("Error taking stats snapshot: %s", e)
+    
+    async def resume_broadcasts(context: ContextTypes.DEFAULT_TYPE):
+        """Restart broadcasts that were still running when the process stopped"""
+        for job_id in await async_db.get_running_broadcasts():
+            logger.info("Resuming broadcast #%s", job_id)
+            bot.start_broadcast_worker(context.application, job_id)
+    
+    async def reload_bad_words(context: ContextTypes.DEFAULT_TYPE):
+        """Pick up edits to the word list file without a restart"""
+        try:
+            # Building the automaton for a large list takes seconds: keep it off the event loop.
+            if await asyncio.to_thread(moderation.reload):
+                logger.info("Loaded %s moderation terms", moderation.engine.word_count)
         except Exception as e:
-            logger.error(f"Error checking VIP expirations: {e}")
+            logger.error("Error reloading %s: %s", BAD_WORDS_FILE, e)
+    
+    async def evict_idle_rate_limits(context: ContextTypes.DEFAULT_TYPE):
+        """Drop throttle state of users who have been quiet long enough to be back at full allowance"""
+        for limiter in (relay_limiter, search_limiter, throttle_notice_limiter):
+            limiter.evict_idle()
     
     # Set bot commands (menu in Telegram UI)
     async def post_init(app: Application):
@@ -1716,11 +2204,42 @@ def main():
             BotCommand("help", "🆘 Show help"),
         ])
         
-        # Schedule daily VIP expiration check (runs every 24 hours)
+        # VIP expiry: a short tick driven by the expiry heap, plus a daily sweep as a safety net
         job_queue = app.job_queue
+        job_queue.run_repeating(expire_due_vips, interval=VIP_EXPIRY_TICK, first=VIP_EXPIRY_TICK)
         job_queue.run_repeating(check_vip_expirations, interval=86400, first=10)  # 86400 seconds = 24 hours
+
+        if SQLITE_WAL_CHECKPOINT_INTERVAL > 0 and str(SQLITE_PRAGMAS.get('journal_mode', '')).upper() == 'WAL':
+            job_queue.run_repeating(checkpoint_wal, interval=SQLITE_WAL_CHECKPOINT_INTERVAL, first=SQLITE_WAL_CHECKPOINT_INTERVAL)
+
+        job_queue.run_once(resume_broadcasts, when=1)
+
+        if STATS_SNAPSHOT_INTERVAL > 0:
+            job_queue.run_repeating(snapshot_stats, interval=STATS_SNAPSHOT_INTERVAL, first=STATS_SNAPSHOT_INTERVAL)
+
+        job_queue.run_repeating(evict_idle_rate_limits, interval=RATE_LIMIT_EVICT_INTERVAL, first=RATE_LIMIT_EVICT_INTERVAL)
+
+        if BAD_WORDS_RELOAD_INTERVAL > 0:
+            job_queue.run_repeating(reload_bad_words, interval=BAD_WORDS_RELOAD_INTERVAL, first=0)
+        else:
+            job_queue.run_once(reload_bad_words, when=0)
+
+        if MATCHMAKING_MODE == 'batch':
+            tick = MATCHMAKING_TICK_MS / 1000
+            job_queue.run_repeating(bot.matchmaking_tick, interval=tick, first=tick)
+
+        if METRICS_PORT:
+            app.bot_data['metrics_server'] = await metrics.serve(METRICS_HOST, METRICS_PORT)
     
+    async def post_shutdown(app: Application):
+        server = app.bot_data.pop('metrics_server', None)
+        if server:
+            server.close()
+            await server.wait_closed()
+        async_db.close()
+
     application.post_init = post_init
+    application.post_shutdown = post_shutdown
     
     # Add handlers
     application.add_handler(CommandHandler("start", bot.start))
@@ -1745,6 +2264,9 @@ def main():
     application.add_handler(CommandHandler("viplist", bot.admin_vip_list))
     application.add_handler(CommandHandler("reports", bot.admin_reports))
     application.add_handler(CommandHandler("broadcast", bot.admin_broadcast))
+    application.add_handler(CommandHandler("broadcast_status", bot.admin_broadcast_status))
+    application.add_handler(CommandHandler("broadcast_cancel", bot.admin_broadcast_cancel))
+    application.add_handler(CommandHandler("reloadwords", bot.admin_reload_words))
     
     # Callback handlers
     application.add_handler(CallbackQueryHandler(bot.verify_subscription_callback, pattern="^verify_subscription$"))
@@ -1758,8 +2280,14 @@ def main():
     application.add_handler(CallbackQueryHandler(bot.vip_search_choice_callback, pattern="^vip_search_"))
     application.add_handler(CallbackQueryHandler(bot.vip_next_choice_callback, pattern="^vip_next_"))
     application.add_handler(CallbackQueryHandler(bot.sharelink_callback, pattern="^sharelink_"))
+    application.add_handler(CallbackQueryHandler(bot.vip_list_page_callback, pattern=r"^viplist\|"))
     application.add_handler(CallbackQueryHandler(bot.buy_vip_callback, pattern=r"^buy_vip(?:_\d+)?$"))
     
+    # Membership changes in required channels (bot must be admin there)
+    application.add_handler(ChatMemberHandler(bot.channel_member_update, ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(ChatMemberHandler(bot.bot_member_update, ChatMemberHandler.MY_CHAT_MEMBER))
+    application.add_handler(TypeHandler(Update, bot.track_reachability), group=-1)
+
     # Payment handlers
     application.add_handler(PreCheckoutQueryHandler(bot.precheckout_callback))
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, bot.successful_payment))
@@ -1789,9 +2317,28 @@ def main():
         )
     )
     
+    # Per-handler latency and error metrics
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = metrics.instrument_handler(handler.callback)
+    
     # Start the bot
-    logger.info("Bot started!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        from webhook import serve_webhook
+
+        logger.info("Bot started (webhook)!")
+        asyncio.run(serve_webhook(
+            application,
+            url=WEBHOOK_URL,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        ))
+    else:
+        logger.info("Bot started!")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
@@ -19,6 +19,16 @@ ADMIN_IDS = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if
 # Required channels for subscription (comma-separated in .env, e.g., "@channel1,@channel2")
 REQUIRED_CHANNELS = [ch.strip() for ch in os.getenv('REQUIRED_CHANNELS', '').split(',') if ch.strip()]
 
+# Channel membership cache (seconds). Members are re-checked less often than
+# non-members, so a user who just subscribed is recognised quickly.
+SUBSCRIPTION_CACHE_TTL = float(os.getenv('SUBSCRIPTION_CACHE_TTL', '300'))
+SUBSCRIPTION_CACHE_NEGATIVE_TTL = float(os.getenv('SUBSCRIPTION_CACHE_NEGATIVE_TTL', '30'))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', '50000'))
+
+# Stored membership (kept current by chat_member updates) is trusted for this many
+# seconds before falling back to a live get_chat_member check.
+MEMBERSHIP_STALE_AFTER = int(os.getenv('MEMBERSHIP_STALE_AFTER', '86400'))
+
 # VIP plans in Telegram Stars
 VIP_PRICES = {
     7: int(os.getenv('VIP_PRICE_7_DAYS', '100')),
@@ -29,17 +39,105 @@ VIP_PRICES = {
 # Database path
 DATABASE_PATH = os.getenv('DATABASE_PATH', 'chatbot.db')
 
+# SQLite connection profile, applied to every new connection.
+# WAL lets readers proceed while a BEGIN IMMEDIATE writer holds the lock;
+# synchronous=NORMAL is durable across app crashes in WAL mode.
+SQLITE_PRAGMAS = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000')),
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', '-65536')),  # negative = KiB (64 MiB)
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', '268435456')),  # 256 MiB
+    'temp_store': os.getenv('SQLITE_TEMP_STORE', 'MEMORY'),
+}
+
+# Seconds between wal_checkpoint(TRUNCATE) runs (0 disables)
+SQLITE_WAL_CHECKPOINT_INTERVAL = int(os.getenv('SQLITE_WAL_CHECKPOINT_INTERVAL', '300'))
+
+# In-process cache of users rows. The bot invalidates entries on every write;
+# the TTL (seconds) only matters for edits made outside the bot (manage_bot.py).
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '60'))
+
+# Seconds between snapshots of the /stats counters (0 disables), and how long to keep them
+STATS_SNAPSHOT_INTERVAL = int(os.getenv('STATS_SNAPSHOT_INTERVAL', '3600'))
+STATS_SNAPSHOT_RETENTION_DAYS = int(os.getenv('STATS_SNAPSHOT_RETENTION_DAYS', '90'))
+
+# Seconds between VIP expiry checks (each VIP expires at most this late), and
+# the most subscriptions expired per check; the rest wait for the next tick
+VIP_EXPIRY_TICK = float(os.getenv('VIP_EXPIRY_TICK', '5'))
+VIP_EXPIRY_BATCH = int(os.getenv('VIP_EXPIRY_BATCH', '200'))
+
+# Matchmaking mode: 'instant' matches on every /search, 'batch' only queues
+# searchers and pairs the whole queue every MATCHMAKING_TICK_MS milliseconds.
+MATCHMAKING_MODE = os.getenv('MATCHMAKING_MODE', 'instant').lower()
+MATCHMAKING_TICK_MS = int(os.getenv('MATCHMAKING_TICK_MS', '500'))
+
+# Outbound sender limits (broadcasts, VIP notices, admin alerts).
+# Telegram allows about 30 messages/sec per bot and 1 message/sec per chat.
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_PER_CHAT_RATE = float(os.getenv('SEND_PER_CHAT_RATE', '1'))
+SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', '20'))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '3'))
+
+# Recipients loaded (and progress saved) per broadcast batch
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '500'))
+
+# How updates arrive: 'polling' (getUpdates) or 'webhook' (embedded aiohttp server).
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # public https base URL; empty = don't register (local testing)
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')  # required in webhook mode; 1-256 of A-Z a-z 0-9 _ -
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))  # parallel connections Telegram may open
+
+# Prometheus-style metrics at http://METRICS_HOST:METRICS_PORT/metrics (0 disables).
+# Keep the host on localhost unless the scraper runs elsewhere.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+
+# Updates processed concurrently (1 = strictly one at a time).
+# Updates from the same user always run one after another, in order.
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '64'))
+
+# Per-user throttles (GCRA): bursts of up to LIMIT, then LIMIT per WINDOW seconds.
+# Relay covers chat messages and media; search covers /search and /next.
+RELAY_RATE_LIMIT = int(os.getenv('RELAY_RATE_LIMIT', '10'))
+RELAY_RATE_WINDOW = float(os.getenv('RELAY_RATE_WINDOW', '10'))
+SEARCH_RATE_LIMIT = int(os.getenv('SEARCH_RATE_LIMIT', '5'))
+SEARCH_RATE_WINDOW = float(os.getenv('SEARCH_RATE_WINDOW', '30'))
+RATE_LIMIT_EVICT_INTERVAL = int(os.getenv('RATE_LIMIT_EVICT_INTERVAL', '300'))  # seconds between idle-user sweeps
+
+# Logging: LOG_LEVEL for everything, LOG_LEVELS overrides per logger
+# (e.g. "database=DEBUG,httpx=WARNING"). LOG_FORMAT is 'json' or 'text'.
+# LOG_SAMPLE_RATES keeps 1 in N records of high-volume events ("relay=100").
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.getenv('LOG_LEVELS', 'httpx=WARNING')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', 'relay=100')
+LOG_FILE = os.getenv('LOG_FILE', '')  # also write records here (optional)
+
 # Bad words filter (optional - expand as needed)
 BAD_WORDS = [
     'spam', 'scam', 'fraud'
     # Add more words as needed
 ]
 
-# URL patterns for link detection
+# Larger word list: UTF-8, one term per line, '#' comments. Merged with BAD_WORDS.
+# Matching ignores case, Cyrillic/Latin look-alikes and leetspeak (see moderation.normalize).
+# The file is re-read when it changes (checked every BAD_WORDS_RELOAD_INTERVAL seconds,
+# 0 = load once at startup) or on /reloadwords.
+BAD_WORDS_FILE = os.getenv('BAD_WORDS_FILE', 'bad_words.txt')
+BAD_WORDS_RELOAD_INTERVAL = int(os.getenv('BAD_WORDS_RELOAD_INTERVAL', '60'))
+
+# URL patterns for link detection (matched against the lowercased message).
+# (?<![\w-]) only lets the domain pattern start at a word boundary, where the
+# leftmost match starts anyway; without it the regex retries inside every word.
 URL_PATTERNS = [
     r'http[s]?://',
     r'www\.',
     r't\.me',
     r'@\w+',
-    r'[\w-]+\.(com|net|org|io|co|ru|me|uk|de|fr|it|es|cn|jp|in|br|au)'
+    r'(?<![\w-])[\w-]+\.(com|net|org|io|co|ru|me|uk|de|fr|it|es|cn|jp|in|br|au)'
 ]
@@ -3,22 +3,296 @@ Database module for Anonymous Chat Bot
 Handles all database operations using SQLite
 """
 
+import asyncio
+import contextvars
+import functools
 import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import threading
 
+import metrics
+from matchmaking import MatchmakingEngine
+from utils import TTLCache
+from vip_expiry import ExpiryHeap
+
+# Rebuilds per-user rating counters from the ratings history
+RATING_COUNTERS_BACKFILL = '''
+    INSERT OR REPLACE INTO rating_counters (user_id, good, bad, scam)
+    SELECT target_id,
+           SUM(rating_type = 'good'),
+           SUM(rating_type = 'bad'),
+           SUM(rating_type = 'scam')
+    FROM ratings
+    GROUP BY target_id
+'''
+
+# /viplist order: soonest expiry first, lifetime VIPs (no expiry) last.
+# Must match idx_users_vip_expiry exactly for the index to be used.
+VIP_SORT_KEY = "COALESCE(vip_expires_at, '9999-12-31')"
+
+# Global counters shown by /stats, in stats_counters and stats_snapshots column order
+STATS_COUNTERS = ('total_users', 'vip_users', 'banned_users', 'chatting_users', 'in_queue', 'total_ratings', 'total_reports')
+
+# Current value of every global counter, computed from the base tables
+STATS_COUNTERS_ACTUAL = '''
+    SELECT (SELECT COUNT(*) FROM users) AS total_users,
+           (SELECT COUNT(*) FROM users WHERE is_vip = 1) AS vip_users,
+           (SELECT COUNT(*) FROM users WHERE is_banned = 1) AS banned_users,
+           (SELECT COUNT(*) FROM users WHERE state = 'CHATTING' AND current_chat_id IS NOT NULL) AS chatting_users,
+           (SELECT COUNT(*) FROM search_queue) AS in_queue,
+           (SELECT COUNT(*) FROM ratings) AS total_ratings,
+           (SELECT COUNT(*) FROM ratings WHERE rating_type = 'scam') AS total_reports
+'''
+
+STATS_COUNTERS_BACKFILL = f'''
+    INSERT OR REPLACE INTO stats_counters (id, {', '.join(STATS_COUNTERS)})
+    SELECT 1, * FROM ({STATS_COUNTERS_ACTUAL})
+'''
+
+# What one users row contributes to the user counters. `IS` keeps NULLs at 0.
+_USER_CONTRIBUTION = '''
+            vip_users = vip_users {op} ({row}.is_vip IS 1),
+            banned_users = banned_users {op} ({row}.is_banned IS 1),
+            chatting_users = chatting_users {op} ({row}.state IS 'CHATTING' AND {row}.current_chat_id IS NOT NULL)'''
+
+# Triggers keep stats_counters in step with every write, inside the writer's
+# transaction, including writes made outside this class (manage_bot.py, manual SQL).
+# INSERT OR REPLACE (create_user) deletes the old row; that only fires
+# stats_users_delete with PRAGMA recursive_triggers = ON, which get_connection sets.
+#
+# Any other writer (a script or sqlite3 shell session using raw SQL instead of
+# Database) must run `PRAGMA recursive_triggers = ON` on its connection first.
+# Without it a REPLACE of a users row is counted as a new user and
+# stats_counters drifts until check_stats_counters(repair=True) is run.
+# Migration 5 creates these as they are; change them only through a new migration.
+STATS_COUNTERS_TRIGGERS = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users BEGIN
+        UPDATE stats_counters SET total_users = total_users + 1,{_USER_CONTRIBUTION.format(op='+', row='NEW')}
+        WHERE id = 1;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS stats_users_update AFTER UPDATE OF is_vip, is_banned, state, current_chat_id ON users
+    BEGIN
+        UPDATE stats_counters SET{_USER_CONTRIBUTION.format(op='-', row='OLD')}
+        WHERE id = 1;
+        UPDATE stats_counters SET{_USER_CONTRIBUTION.format(op='+', row='NEW')}
+        WHERE id = 1;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users BEGIN
+        UPDATE stats_counters SET total_users = total_users - 1,{_USER_CONTRIBUTION.format(op='-', row='OLD')}
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_queue_insert AFTER INSERT ON search_queue BEGIN
+        UPDATE stats_counters SET in_queue = in_queue + 1 WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_queue_delete AFTER DELETE ON search_queue BEGIN
+        UPDATE stats_counters SET in_queue = in_queue - 1 WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_ratings_insert AFTER INSERT ON ratings BEGIN
+        UPDATE stats_counters SET total_ratings = total_ratings + 1,
+            total_reports = total_reports + (NEW.rating_type = 'scam')
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_ratings_delete AFTER DELETE ON ratings BEGIN
+        UPDATE stats_counters SET total_ratings = total_ratings - 1,
+            total_reports = total_reports - (OLD.rating_type = 'scam')
+        WHERE id = 1;
+    END
+    ''',
+]
+
+# Shipped with migration 5, dropped by migration 7: it subtracted the old row on
+# every conflicting INSERT, including INSERT OR IGNORE and upserts that keep it.
+_STATS_USERS_REPLACE_TRIGGER = '''
+    CREATE TRIGGER IF NOT EXISTS stats_users_replace BEFORE INSERT ON users
+    WHEN EXISTS (SELECT 1 FROM users WHERE user_id = NEW.user_id) BEGIN
+        UPDATE stats_counters SET
+            total_users = total_users - 1,
+            vip_users = vip_users - (SELECT is_vip IS 1 FROM users WHERE user_id = NEW.user_id),
+            banned_users = banned_users - (SELECT is_banned IS 1 FROM users WHERE user_id = NEW.user_id),
+            chatting_users = chatting_users - (
+                SELECT state IS 'CHATTING' AND current_chat_id IS NOT NULL FROM users WHERE user_id = NEW.user_id
+            )
+        WHERE id = 1;
+    END
+    '''
+
+# Versioned schema migrations: (version, description, statements).
+# init_database applies every entry newer than PRAGMA user_version, in order,
+# then records the new version. Append new entries; never edit shipped ones.
+MIGRATIONS = [
+    (1, 'indexes for hot queries', [
+        # get_user_ratings / get_scam_count filter by target (and type)
+        'CREATE INDEX IF NOT EXISTS idx_ratings_target_type ON ratings(target_id, rating_type)',
+        # get_recent_reports / get_stats filter by type, group by target
+        'CREATE INDEX IF NOT EXISTS idx_ratings_type_target ON ratings(rating_type, target_id)',
+        # atomic_match / atomic_next_partner walk the queue in this order
+        'CREATE INDEX IF NOT EXISTS idx_search_queue_order ON search_queue(is_vip DESC, joined_at ASC, target_gender)',
+        # get_user_by_username matches case-insensitively
+        'CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(LOWER(username))',
+        # get_stats counters
+        'CREATE INDEX IF NOT EXISTS idx_users_state_chat ON users(state, current_chat_id)',
+        'CREATE INDEX IF NOT EXISTS idx_users_is_vip ON users(is_vip)',
+        'CREATE INDEX IF NOT EXISTS idx_users_is_banned ON users(is_banned)',
+    ]),
+    (2, 'denormalized rating counters', [
+        '''
+        CREATE TABLE IF NOT EXISTS rating_counters (
+            user_id INTEGER PRIMARY KEY,
+            good INTEGER NOT NULL DEFAULT 0,
+            bad INTEGER NOT NULL DEFAULT 0,
+            scam INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        RATING_COUNTERS_BACKFILL,
+    ]),
+    (3, 'persistent broadcast jobs', [
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            status_message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)',
+    ]),
+    (4, 'reachability flag for users who blocked the bot', [
+        'ALTER TABLE users ADD COLUMN reachable INTEGER NOT NULL DEFAULT 1',
+        'ALTER TABLE users ADD COLUMN blocked_at TIMESTAMP',
+    ]),
+    (5, 'global stats counters and snapshots', [
+        f'''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            {', '.join(f'{name} INTEGER NOT NULL DEFAULT 0' for name in STATS_COUNTERS)}
+        )
+        ''',
+        STATS_COUNTERS_BACKFILL,
+        *STATS_COUNTERS_TRIGGERS,
+        _STATS_USERS_REPLACE_TRIGGER,
+        f'''
+        CREATE TABLE IF NOT EXISTS stats_snapshots (
+            taken_at TIMESTAMP PRIMARY KEY,
+            {', '.join(f'{name} INTEGER NOT NULL' for name in STATS_COUNTERS)}
+        )
+        ''',
+    ]),
+    (6, 'partial index for /viplist pages', [
+        f'CREATE INDEX IF NOT EXISTS idx_users_vip_expiry ON users({VIP_SORT_KEY}, user_id) WHERE is_vip = 1',
+        # VIP counts come from stats_counters now, and every is_vip = 1 read can use
+        # the partial index; left in place, the planner prefers it and sorts each page.
+        'DROP INDEX IF EXISTS idx_users_is_vip',
+    ]),
+    (7, 'count REPLACE through the delete trigger', [
+        # REPLACE fires stats_users_delete instead (recursive_triggers, see get_connection);
+        # recount so databases that ran an INSERT OR IGNORE / upsert under the old trigger are right.
+        'DROP TRIGGER IF EXISTS stats_users_replace',
+        STATS_COUNTERS_BACKFILL,
+    ]),
+]
+
+# Names of AsyncDatabase calls made while handling the current update.
+# Set per update (see request_context.count_db_calls); None = not counting.
+db_calls = contextvars.ContextVar('db_calls', default=None)
+
+def _timestamp(value):
+    """Unix timestamp of a stored (local, naive) TIMESTAMP value"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.timestamp()
+
+
+def _timed_operation(method):
+    """Record the duration of a Database transaction method in metrics.DB_TRANSACTION"""
+    histogram = metrics.DB_TRANSACTION
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started, method.__name__)
+
+    return wrapper
+
+
+# PRAGMAs accepted in a connection profile (see config.SQLITE_PRAGMAS)
+SUPPORTED_PRAGMAS = ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'mmap_size', 'temp_store')
+
+
 class Database:
-    def __init__(self, db_path='chatbot.db'):
+    def __init__(self, db_path='chatbot.db', pragmas=None, user_cache_size=10000, user_cache_ttl=60):
         self.db_path = db_path
+        self.pragmas = dict(pragmas or {})
+        unknown = set(self.pragmas) - set(SUPPORTED_PRAGMAS)
+        if unknown:
+            raise ValueError(f"Unsupported PRAGMA(s): {', '.join(sorted(unknown))}")
         self.local = threading.local()
+        # Active-chat routing table: user_id -> (partner_id, chat_id, lang).
+        # Written through by the atomic_* methods after commit, so the relay
+        # hot path never has to read users/chat_sessions.
+        self.routes = {}
+        self._routes_lock = threading.Lock()
+        # In-memory mirror of search_queue used to pick partners without SQL scans.
+        self.matchmaker = MatchmakingEngine()
+        # Users who blocked the bot (reachable = 0), so incoming updates can
+        # flip the flag back without a DB read.
+        self.unreachable = set()
+        # user_id -> users row (dict). Every method that writes users rows
+        # invalidates the affected ids after commit; the TTL bounds staleness
+        # for edits made by other processes (manage_bot.py).
+        self.user_cache = TTLCache(max_size=user_cache_size, ttl=user_cache_ttl)
+        # Upcoming vip_expires_at deadlines, so expiry runs on time without scanning users.
+        self.vip_expiry = ExpiryHeap()
         self.init_database()
+        self.load_routes()
+        self.load_queue()
+        self.load_unreachable()
+        self.load_vip_expiries()
     
     def get_connection(self):
         """Get thread-local database connection"""
         if not hasattr(self.local, 'conn'):
-            self.local.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-            self.local.conn.row_factory = sqlite3.Row
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            for name, value in self.pragmas.items():
+                conn.execute(f'PRAGMA {name} = {value}')
+            # REPLACE must fire DELETE triggers to keep stats_counters right
+            conn.execute('PRAGMA recursive_triggers = ON')
+            self.local.conn = conn
         return self.local.conn
+
+    def wal_checkpoint(self, mode='TRUNCATE'):
+        """Checkpoint the WAL file. Returns (busy, wal_pages, checkpointed_pages)."""
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            raise ValueError(f"Invalid checkpoint mode: {mode}")
+        conn = self.get_connection()
+        row = conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+        return tuple(row)
     
     def init_database(self):
         """Initialize database tables"""
@@ -192,7 +466,30 @@ class Database:
             )
         ''')
         
+        # Required-channel membership, fed by chat_member updates and live checks
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS channel_memberships (
+                user_id INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                is_member BOOLEAN NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, channel)
+            )
+        ''')
+        
+        self._apply_migrations(cursor)
         conn.commit()
+
+    def _apply_migrations(self, cursor):
+        """Apply MIGRATIONS newer than the schema version stored in the DB file."""
+        cursor.execute('PRAGMA user_version')
+        current_version = cursor.fetchone()[0]
+        for version, _description, statements in MIGRATIONS:
+            if version <= current_version:
+                continue
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute(f'PRAGMA user_version = {int(version)}')
     
     def create_user(self, user_id, gender, age, username=None, language='en'):
         """Create a new user"""
@@ -205,9 +502,16 @@ class Database:
         ''', (user_id, username, gender, age, language))
         
         conn.commit()
+        self.user_cache.invalidate(user_id)
+        self.vip_expiry.remove(user_id)
+        # REPLACE resets state to IDLE, so any stale route must go too.
+        self._close_route(user_id)
     
     def get_user_language(self, user_id):
         """Get user's preferred language."""
+        route = self.routes.get(user_id)
+        if route:
+            return route[2]
         user = self.get_user(user_id)
         if user and user.get('language'):
             return user['language']
@@ -219,6 +523,12 @@ class Database:
         cursor = conn.cursor()
         cursor.execute('UPDATE users SET language = ? WHERE user_id = ?', (language, user_id))
         conn.commit()
+        self.user_cache.invalidate(user_id)
+
+        with self._routes_lock:
+            route = self.routes.get(user_id)
+            if route:
+                self.routes[user_id] = (route[0], route[1], language)
 
     def set_username(self, user_id, username):
         """Persist Telegram username (without @) for user_id."""
@@ -226,6 +536,7 @@ class Database:
         cursor = conn.cursor()
         cursor.execute('UPDATE users SET username = ? WHERE user_id = ?', (username, user_id))
         conn.commit()
+        self.user_cache.invalidate(user_id)
 
     def get_user_by_username(self, username):
         """Get user by Telegram username (with or without leading @)."""
@@ -245,7 +556,19 @@ class Database:
         return None
     
     def get_user(self, user_id):
-        """Get user by ID"""
+        """Get user by ID (from the user cache when possible)"""
+        user = self.cached_user(user_id)
+        if user is not None:
+            return user
+        return self._load_user(user_id)
+
+    def cached_user(self, user_id):
+        """Return a copy of the cached users row, or None on a miss. Never touches SQLite."""
+        user = self.user_cache.get(user_id)
+        return dict(user) if user is not None else None
+
+    def _load_user(self, user_id):
+        """Read the users row from SQLite and cache it"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
@@ -253,8 +576,14 @@ class Database:
         row = cursor.fetchone()
         
         if row:
-            return dict(row)
+            user = dict(row)
+            self.user_cache.set(user_id, user)
+            return dict(user)
         return None
+
+    def user_cache_stats(self):
+        """Hit/miss counters of the user cache"""
+        return self.user_cache.stats()
     
     def update_user_subscription(self, user_id, subscribed):
         """Update user subscription status"""
@@ -266,7 +595,96 @@ class Database:
         ''', (subscribed, user_id))
         
         conn.commit()
+        self.user_cache.invalidate(user_id)
+    
+    def _invalidate_users(self, *user_ids):
+        for user_id in user_ids:
+            if user_id is not None:
+                self.user_cache.invalidate(user_id)
+
+    def load_unreachable(self):
+        """Rebuild the in-memory set of unreachable users (called at startup)."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id FROM users WHERE reachable = 0')
+        self.unreachable = {row['user_id'] for row in cursor.fetchall()}
+        return len(self.unreachable)
     
+    def is_reachable(self, user_id):
+        """False if a send to user_id failed with Forbidden (bot blocked) and they haven't been back"""
+        return user_id not in self.unreachable
+    
+    @_timed_operation
+    def mark_user_unreachable(self, user_id):
+        """
+        Flag a user who blocked the bot: skipped by broadcasts and matchmaking.
+        A queued user is taken out of the queue in the same transaction.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            self._begin_immediate(conn, 'mark_user_unreachable')
+            cursor.execute('''
+                UPDATE users SET reachable = 0, blocked_at = CURRENT_TIMESTAMP
+                WHERE user_id = ? AND reachable = 1
+            ''', (user_id,))
+            cursor.execute('DELETE FROM search_queue WHERE user_id = ?', (user_id,))
+            cursor.execute('''
+                UPDATE users
+                SET state = 'IDLE', search_target_gender = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ? AND state = 'SEARCHING'
+            ''', (user_id,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        self.user_cache.invalidate(user_id)
+        self.matchmaker.remove(user_id)
+        self.unreachable.add(user_id)
+    
+    def mark_user_reachable(self, user_id):
+        """Clear the unreachable flag (the user talked to the bot again)"""
+        if user_id not in self.unreachable:
+            return
+        conn = self.get_connection()
+        conn.execute('UPDATE users SET reachable = 1, blocked_at = NULL WHERE user_id = ?', (user_id,))
+        conn.commit()
+        self.user_cache.invalidate(user_id)
+        self.unreachable.discard(user_id)
+    
+    def set_channel_membership(self, user_id, channel, is_member):
+        """Store the latest known membership of user_id in a required channel."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO channel_memberships (user_id, channel, is_member, updated_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id, channel) DO UPDATE SET
+                is_member = excluded.is_member,
+                updated_at = excluded.updated_at
+        ''', (user_id, channel, is_member))
+        conn.commit()
+
+    def get_channel_memberships(self, user_id, max_age_seconds, negative_max_age_seconds=None):
+        """
+        Return {channel: is_member} for stored rows newer than max_age_seconds.
+        "Not a member" rows go stale after negative_max_age_seconds instead (if given),
+        so a user who just joined isn't held back by an old negative.
+        """
+        if negative_max_age_seconds is None:
+            negative_max_age_seconds = max_age_seconds
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT channel, is_member
+            FROM channel_memberships
+            WHERE user_id = ? AND updated_at >= datetime('now', ?)
+              AND (is_member = 1 OR updated_at >= datetime('now', ?))
+        ''', (user_id, f'-{int(max_age_seconds)} seconds', f'-{int(negative_max_age_seconds)} seconds'))
+        return {row['channel']: bool(row['is_member']) for row in cursor.fetchall()}
+
     def set_vip_status(self, user_id, is_vip, days=30):
         """Set VIP status for user with expiration date"""
         conn = self.get_connection()
@@ -286,6 +704,8 @@ class Database:
             ''', (is_vip, user_id))
         
         conn.commit()
+        self.user_cache.invalidate(user_id)
+        self.vip_expiry.set(user_id, expiration_date.timestamp() if is_vip else None)
 
     def update_gender(self, user_id, gender):
         """Update user's gender."""
@@ -293,6 +713,11 @@ class Database:
         cursor = conn.cursor()
         cursor.execute('UPDATE users SET gender = ? WHERE user_id = ?', (gender, user_id))
         conn.commit()
+        self.user_cache.invalidate(user_id)
+
+        entry = self.matchmaker.entry(user_id)
+        if entry:
+            self.matchmaker.add(user_id, gender, entry[1], entry[2], joined_at=self.matchmaker.joined_at(user_id))
 
     def update_age(self, user_id, age):
         """Update user's age."""
@@ -300,6 +725,7 @@ class Database:
         cursor = conn.cursor()
         cursor.execute('UPDATE users SET age = ? WHERE user_id = ?', (age, user_id))
         conn.commit()
+        self.user_cache.invalidate(user_id)
     
     def get_vip_expiration(self, user_id):
         """Get VIP expiration date for a user"""
@@ -320,45 +746,132 @@ class Database:
         remaining = expiration - datetime.now()
         return max(0, remaining.days)
 
-    def get_vip_users(self):
-        """Get all active VIP users with expiration info."""
+    def get_vip_page(self, after=None, before=None, limit=25):
+        """
+        One page of active VIPs, soonest expiry first and lifetime VIPs last.
+
+        Keyset pagination: `after` / `before` is the (sort_key, user_id) of the
+        last / first row of the page being left, so each page is one index
+        range read however deep it is. Returns {'users': [...], 'has_prev',
+        'has_next'}; each user has user_id, username, days_remaining (None
+        for lifetime) and sort_key.
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
 
-        cursor.execute('''
-            SELECT user_id, username, vip_expires_at
+        # Spelled out rather than as a row value, so SQLite seeks the index on the sort key.
+        if before is not None:
+            sort_key, user_id = before
+            condition = f'AND {VIP_SORT_KEY} <= ? AND ({VIP_SORT_KEY} < ? OR user_id < ?)'
+            order, params = 'DESC', (sort_key, sort_key, user_id)
+        elif after is not None:
+            sort_key, user_id = after
+            condition = f'AND {VIP_SORT_KEY} >= ? AND ({VIP_SORT_KEY} > ? OR user_id > ?)'
+            order, params = 'ASC', (sort_key, sort_key, user_id)
+        else:
+            condition, order, params = '', 'ASC', ()
+
+        # Same day count as get_vip_days_remaining: whole days left, never negative.
+        cursor.execute(f'''
+            SELECT user_id, username,
+                   {VIP_SORT_KEY} AS sort_key,
+                   CASE WHEN vip_expires_at IS NULL THEN NULL
+                        ELSE MAX(0, CAST(julianday(vip_expires_at) - julianday('now', 'localtime') AS INTEGER))
+                   END AS days_remaining
             FROM users
-            WHERE is_vip = 1
-            ORDER BY vip_expires_at IS NULL DESC, vip_expires_at ASC, user_id ASC
-        ''')
+            WHERE is_vip = 1 {condition}
+            ORDER BY {VIP_SORT_KEY} {order}, user_id {order}
+            LIMIT ?
+        ''', params + (limit + 1,))
+        users = [dict(row) for row in cursor.fetchall()]
 
-        return [dict(row) for row in cursor.fetchall()]
+        more = len(users) > limit
+        users = users[:limit]
+        if before is not None:
+            users.reverse()
+            return {'users': users, 'has_prev': more, 'has_next': True}
+        return {'users': users, 'has_prev': after is not None, 'has_next': more}
     
-    def check_and_expire_vips(self):
-        """Expire outdated VIP subscriptions and return affected users."""
+    def load_vip_expiries(self):
+        """Rebuild the VIP expiry heap from users (called at startup)."""
         conn = self.get_connection()
         cursor = conn.cursor()
-        
-        now = datetime.now()
-
         cursor.execute('''
-            SELECT user_id, language
-            FROM users
-            WHERE is_vip = 1
-            AND vip_expires_at IS NOT NULL
-            AND vip_expires_at < ?
-        ''', (now,))
+            SELECT user_id, vip_expires_at FROM users
+            WHERE is_vip = 1 AND vip_expires_at IS NOT NULL
+        ''')
+        heap = ExpiryHeap()
+        for row in cursor.fetchall():
+            heap.set(row['user_id'], _timestamp(row['vip_expires_at']))
+        self.vip_expiry = heap
+        return len(heap)
+
+    def _expire_vips(self, cursor, condition, params):
+        """Clear is_vip for rows matching condition whose expiry has passed; returns [{user_id, language}]"""
+        where = f'''
+            WHERE is_vip = 1 AND vip_expires_at IS NOT NULL
+            AND {VIP_SORT_KEY} <= ? AND {condition}
+        '''
+        now = (datetime.now(),)
+        cursor.execute(f'SELECT user_id, language FROM users {where}', now + params)
         expired_users = [dict(row) for row in cursor.fetchall()]
+        cursor.execute(f'UPDATE users SET is_vip = 0 {where}', now + params)
+        return expired_users
 
-        cursor.execute('''
-            UPDATE users 
-            SET is_vip = 0 
-            WHERE is_vip = 1 
-            AND vip_expires_at IS NOT NULL 
-            AND vip_expires_at < ?
-        ''', (now,))
+    @_timed_operation
+    def expire_due_vips(self, limit=200):
+        """
+        Expire VIPs whose deadline in the expiry heap has passed (at most limit).
+
+        The UPDATE re-checks is_vip and vip_expires_at, so a renewal that
+        reached the DB some other way (manage_bot.py) is not expired; such
+        users are put back in the heap with their new deadline.
+        Returns [{user_id, language}] of users that lost VIP.
+        """
+        due = self.vip_expiry.pop_due(time.time(), limit)
+        if not due:
+            return []
 
+        placeholders = ','.join('?' * len(due))
+        conn = None
+        try:
+            # Inside the try: a busy/locked DB must still put the popped ids back.
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            self._begin_immediate(conn, 'expire_due_vips')
+            expired_users = self._expire_vips(cursor, f'user_id IN ({placeholders})', tuple(due))
+            cursor.execute(f'''
+                SELECT user_id, vip_expires_at FROM users
+                WHERE user_id IN ({placeholders}) AND is_vip = 1 AND vip_expires_at IS NOT NULL
+            ''', tuple(due))
+            renewed = cursor.fetchall()
+            conn.commit()
+        except Exception:
+            for user_id in due:
+                self.vip_expiry.set(user_id, time.time())  # retry on the next tick
+            if conn is not None:
+                conn.rollback()
+            raise
+
+        self._invalidate_users(*(user['user_id'] for user in expired_users))
+        for row in renewed:
+            self.vip_expiry.set(row['user_id'], _timestamp(row['vip_expires_at']))
+        return expired_users
+    
+    def check_and_expire_vips(self):
+        """
+        Expire every outdated VIP subscription and return affected users.
+        Safety net for expire_due_vips (e.g. VIP granted by another process):
+        an indexed range read over idx_users_vip_expiry, not a table scan.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        expired_users = self._expire_vips(cursor, '1', ())
         conn.commit()
+        for expired_user in expired_users:
+            self.vip_expiry.remove(expired_user['user_id'])
+        self._invalidate_users(*(user['user_id'] for user in expired_users))
         return expired_users
     
     def ban_user(self, user_id):
@@ -371,6 +884,7 @@ class Database:
         ''', (user_id,))
         
         conn.commit()
+        self.user_cache.invalidate(user_id)
     
     def unban_user(self, user_id):
         """Unban a user"""
@@ -382,6 +896,7 @@ class Database:
         ''', (user_id,))
         
         conn.commit()
+        self.user_cache.invalidate(user_id)
 
     def unban_all_users(self) -> int:
         """Unban all users.
@@ -394,10 +909,11 @@ class Database:
         cursor.execute('UPDATE users SET is_banned = 0 WHERE is_banned = 1')
         changed = cursor.rowcount
         conn.commit()
+        self.user_cache.clear()
         return changed
     
     def add_rating(self, rater_id, target_id, rating_type):
-        """Add a rating"""
+        """Add a rating and bump the target's counters in the same transaction"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
@@ -406,23 +922,29 @@ class Database:
             VALUES (?, ?, ?)
         ''', (rater_id, target_id, rating_type))
         
+        cursor.execute('''
+            INSERT INTO rating_counters (user_id, good, bad, scam)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                good = good + excluded.good,
+                bad = bad + excluded.bad,
+                scam = scam + excluded.scam
+        ''', (target_id, int(rating_type == 'good'), int(rating_type == 'bad'), int(rating_type == 'scam')))
+        
         conn.commit()
     
     def get_user_ratings(self, user_id):
-        """Get ratings for a user"""
+        """Get ratings for a user (O(1) counter lookup)"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT 
-                COUNT(CASE WHEN rating_type = 'good' THEN 1 END) as good,
-                COUNT(CASE WHEN rating_type = 'bad' THEN 1 END) as bad,
-                COUNT(CASE WHEN rating_type = 'scam' THEN 1 END) as scam
-            FROM ratings
-            WHERE target_id = ?
+            SELECT good, bad, scam FROM rating_counters WHERE user_id = ?
         ''', (user_id,))
         
         row = cursor.fetchone()
+        if not row:
+            return {'good': 0, 'bad': 0, 'scam': 0}
         return {
             'good': row['good'],
             'bad': row['bad'],
@@ -431,63 +953,122 @@ class Database:
     
     def get_scam_count(self, user_id):
         """Get number of scam reports for a user"""
+        return self.get_user_ratings(user_id)['scam']
+
+    def check_rating_counters(self, repair=False):
+        """
+        Compare rating_counters with the ratings history.
+        Returns list of user_ids whose counters are wrong (before repair).
+        With repair=True, counters are rebuilt from ratings.
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT COUNT(*) as count
-            FROM ratings
-            WHERE target_id = ? AND rating_type = 'scam'
-        ''', (user_id,))
+            SELECT t.user_id
+            FROM (
+                SELECT target_id AS user_id,
+                       SUM(rating_type = 'good') AS good,
+                       SUM(rating_type = 'bad') AS bad,
+                       SUM(rating_type = 'scam') AS scam
+                FROM ratings
+                GROUP BY target_id
+            ) t
+            LEFT JOIN rating_counters c ON c.user_id = t.user_id
+            WHERE c.user_id IS NULL OR c.good != t.good OR c.bad != t.bad OR c.scam != t.scam
+            UNION
+            SELECT c.user_id
+            FROM rating_counters c
+            WHERE (c.good + c.bad + c.scam) > 0
+              AND NOT EXISTS (SELECT 1 FROM ratings r WHERE r.target_id = c.user_id)
+        ''')
+        mismatched = [row['user_id'] for row in cursor.fetchall()]
         
-        return cursor.fetchone()['count']
+        if repair and mismatched:
+            cursor.execute('DELETE FROM rating_counters')
+            cursor.execute(RATING_COUNTERS_BACKFILL)
+            conn.commit()
+        
+        return mismatched
     
     def get_stats(self):
-        """Get bot statistics"""
+        """Get bot statistics (a single read of the trigger-maintained counters)"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        # Total users
-        cursor.execute('SELECT COUNT(*) as count FROM users')
-        total_users = cursor.fetchone()['count']
-        
-        # VIP users
-        cursor.execute('SELECT COUNT(*) as count FROM users WHERE is_vip = 1')
-        vip_users = cursor.fetchone()['count']
-        
-        # Banned users
-        cursor.execute('SELECT COUNT(*) as count FROM users WHERE is_banned = 1')
-        banned_users = cursor.fetchone()['count']
+        cursor.execute('SELECT * FROM stats_counters WHERE id = 1')
+        return self._stats_from_counters(cursor.fetchone())
+
+    @staticmethod
+    def _stats_from_counters(row):
+        """get_stats() dict from a stats_counters or stats_snapshots row"""
+        return {
+            'total_users': row['total_users'],
+            'vip_users': row['vip_users'],
+            'banned_users': row['banned_users'],
+            'active_chats': row['chatting_users'] // 2,  # Divide by 2 since both users are counted
+            'in_queue': row['in_queue'],
+            'total_ratings': row['total_ratings'],
+            'total_reports': row['total_reports']
+        }
+
+    def check_stats_counters(self, repair=False):
+        """
+        Compare stats_counters with counts over the base tables.
+        Returns {counter: (stored, actual)} for wrong counters (before repair).
+        With repair=True, counters are recomputed.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
         
-        # Active chats
-        cursor.execute('''
-            SELECT COUNT(*) as count 
-            FROM users 
-            WHERE state = 'CHATTING' AND current_chat_id IS NOT NULL
-        ''')
-        active_chats = cursor.fetchone()['count'] // 2  # Divide by 2 since both users are counted
+        cursor.execute('SELECT * FROM stats_counters WHERE id = 1')
+        stored = cursor.fetchone()
+        cursor.execute(STATS_COUNTERS_ACTUAL)
+        actual = cursor.fetchone()
+        mismatched = {
+            name: (stored[name], actual[name])
+            for name in STATS_COUNTERS
+            if stored[name] != actual[name]
+        }
         
-        # Users in queue
-        cursor.execute('SELECT COUNT(*) as count FROM search_queue')
-        in_queue = cursor.fetchone()['count']
+        if repair and mismatched:
+            cursor.execute(STATS_COUNTERS_BACKFILL)
+            conn.commit()
         
-        # Total ratings
-        cursor.execute('SELECT COUNT(*) as count FROM ratings')
-        total_ratings = cursor.fetchone()['count']
+        return mismatched
+
+    def take_stats_snapshot(self, retention_days=90):
+        """Copy the current counters into stats_snapshots; drop snapshots older than retention_days"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
         
-        # Total reports
-        cursor.execute("SELECT COUNT(*) as count FROM ratings WHERE rating_type = 'scam'")
-        total_reports = cursor.fetchone()['count']
+        columns = ', '.join(STATS_COUNTERS)
+        cursor.execute(f'''
+            INSERT OR REPLACE INTO stats_snapshots (taken_at, {columns})
+            SELECT CURRENT_TIMESTAMP, {columns} FROM stats_counters WHERE id = 1
+        ''')
+        if retention_days:
+            cursor.execute(
+                "DELETE FROM stats_snapshots WHERE taken_at < datetime('now', ?)",
+                (f'-{int(retention_days)} days',)
+            )
+        conn.commit()
+
+    def get_stats_snapshot(self, hours_ago):
+        """get_stats() as of the most recent snapshot at least hours_ago hours old (plus taken_at), or None"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
         
-        return {
-            'total_users': total_users,
-            'vip_users': vip_users,
-            'banned_users': banned_users,
-            'active_chats': active_chats,
-            'in_queue': in_queue,
-            'total_ratings': total_ratings,
-            'total_reports': total_reports
-        }
+        cursor.execute('''
+            SELECT * FROM stats_snapshots
+            WHERE taken_at <= datetime('now', ?)
+            ORDER BY taken_at DESC
+            LIMIT 1
+        ''', (f'-{int(hours_ago)} hours',))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return {'taken_at': row['taken_at'], **self._stats_from_counters(row)}
     
     def get_recent_reports(self, limit=20):
         """Get recent scam reports"""
@@ -506,13 +1087,99 @@ class Database:
         return [dict(row) for row in cursor.fetchall()]
     
     def get_all_users(self):
-        """Get all users"""
+        """Get all users that can receive messages (not banned, not blocked the bot)"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('SELECT user_id FROM users WHERE is_banned = 0')
+        cursor.execute('SELECT user_id FROM users WHERE is_banned = 0 AND reachable = 1')
         return [dict(row) for row in cursor.fetchall()]
     
+    # Broadcast jobs: status is 'running', 'done' or 'cancelled'.
+    # last_user_id is a keyset cursor: recipients are read in user_id order,
+    # so a restarted worker resumes after the last completed batch.
+
+    def create_broadcast(self, admin_id, message):
+        """Create a running broadcast job. Returns job_id."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO broadcast_jobs (admin_id, message, total)
+            SELECT ?, ?, COUNT(*) FROM users WHERE is_banned = 0 AND reachable = 1
+        ''', (admin_id, message))
+        conn.commit()
+        return cursor.lastrowid
+    
+    def set_broadcast_status_message(self, job_id, message_id):
+        """Remember the admin's status message so progress can be edited into it"""
+        conn = self.get_connection()
+        conn.execute('UPDATE broadcast_jobs SET status_message_id = ? WHERE job_id = ?', (message_id, job_id))
+        conn.commit()
+    
+    def get_broadcast(self, job_id=None):
+        """Get a broadcast job (the latest one if job_id is None)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        if job_id is None:
+            cursor.execute('SELECT * FROM broadcast_jobs ORDER BY job_id DESC LIMIT 1')
+        else:
+            cursor.execute('SELECT * FROM broadcast_jobs WHERE job_id = ?', (job_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+    
+    def get_running_broadcasts(self):
+        """Get job_ids of broadcasts to resume"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT job_id FROM broadcast_jobs WHERE status = 'running' ORDER BY job_id")
+        return [row['job_id'] for row in cursor.fetchall()]
+    
+    def get_broadcast_recipients(self, after_user_id, limit=500):
+        """Next batch of recipient user_ids after the cursor (keyset pagination on the primary key)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT user_id FROM users
+            WHERE user_id > ? AND is_banned = 0 AND reachable = 1
+            ORDER BY user_id
+            LIMIT ?
+        ''', (after_user_id, limit))
+        return [row['user_id'] for row in cursor.fetchall()]
+    
+    def advance_broadcast(self, job_id, last_user_id, sent, failed):
+        """
+        Record a finished batch: move the cursor and add the batch counts.
+        Returns the job status, so the worker notices a cancel between batches.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE broadcast_jobs
+            SET last_user_id = ?, sent = sent + ?, failed = failed + ?, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND status = 'running'
+        ''', (last_user_id, sent, failed, job_id))
+        cursor.execute('SELECT status FROM broadcast_jobs WHERE job_id = ?', (job_id,))
+        row = cursor.fetchone()
+        conn.commit()
+        return row['status'] if row else None
+    
+    def finish_broadcast(self, job_id, status='done'):
+        """Mark a running broadcast as done or cancelled. Returns True if it was running."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE broadcast_jobs
+            SET status = ?, finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND status = 'running'
+        ''', (status, job_id))
+        conn.commit()
+        return cursor.rowcount > 0
+    
     def log_chat_start(self, user1_id, user2_id):
         """Log chat start"""
         conn = self.get_connection()
@@ -550,7 +1217,158 @@ class Database:
         if row:
             return {'state': row['state'], 'chat_id': row['current_chat_id']}
         return None
-    
+
+    def get_partner_id(self, user_id):
+        """
+        Get partner_id from the in-memory routing table.
+        Returns None if user is not in an active chat.
+        """
+        route = self.routes.get(user_id)
+        return route[0] if route else None
+
+    def get_route(self, user_id):
+        """Return (partner_id, chat_id, lang) for a chatting user, or None."""
+        return self.routes.get(user_id)
+
+    def load_routes(self):
+        """Rebuild the routing table from users/chat_sessions (called at startup)."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT s.chat_id, s.user1_id, s.user2_id, u1.language AS lang1, u2.language AS lang2
+            FROM chat_sessions s
+            JOIN users u1 ON u1.user_id = s.user1_id
+            JOIN users u2 ON u2.user_id = s.user2_id
+            WHERE s.ended_at IS NULL
+              AND u1.state = 'CHATTING' AND u1.current_chat_id = s.chat_id
+              AND u2.state = 'CHATTING' AND u2.current_chat_id = s.chat_id
+        ''')
+        routes = {}
+        for row in cursor.fetchall():
+            routes[row['user1_id']] = (row['user2_id'], row['chat_id'], row['lang1'] or 'en')
+            routes[row['user2_id']] = (row['user1_id'], row['chat_id'], row['lang2'] or 'en')
+        with self._routes_lock:
+            self.routes = routes
+        return len(routes) // 2
+
+    def _fetch_languages(self, cursor, *user_ids):
+        """Read languages for users inside the caller's transaction."""
+        placeholders = ','.join('?' * len(user_ids))
+        cursor.execute(f'SELECT user_id, language FROM users WHERE user_id IN ({placeholders})', user_ids)
+        return {row['user_id']: row['language'] or 'en' for row in cursor.fetchall()}
+
+    def _open_route(self, chat_id, user1_id, user2_id, languages):
+        with self._routes_lock:
+            self.routes[user1_id] = (user2_id, chat_id, languages.get(user1_id, 'en'))
+            self.routes[user2_id] = (user1_id, chat_id, languages.get(user2_id, 'en'))
+
+    def _close_route(self, user_id):
+        """Drop user_id and (if still paired with them) their partner from the routing table."""
+        with self._routes_lock:
+            route = self.routes.pop(user_id, None)
+            if route:
+                partner_route = self.routes.get(route[0])
+                if partner_route and partner_route[0] == user_id:
+                    del self.routes[route[0]]
+
+    def load_queue(self):
+        """Rebuild the in-memory matchmaking queue from search_queue (called at startup)."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT q.user_id, q.target_gender, q.is_vip, u.gender
+            FROM search_queue q
+            CROSS JOIN users u ON q.user_id = u.user_id
+            WHERE u.state = 'SEARCHING' AND u.is_banned = 0 AND u.reachable = 1
+            ORDER BY q.is_vip DESC, q.joined_at ASC
+        ''')
+        engine = MatchmakingEngine()
+        for row in cursor.fetchall():
+            engine.add(row['user_id'], row['gender'], row['target_gender'], row['is_vip'])
+        self.matchmaker = engine
+        return len(engine)
+
+    def _pick_candidate(self, cursor, searcher_id, searcher_gender, target_gender):
+        """
+        Return the best queued partner row (user_id, gender, age, is_vip) or None.
+        Must run inside the caller's BEGIN IMMEDIATE transaction: each engine
+        pick is re-checked against SQLite, and stale entries are dropped or re-bucketed.
+        """
+        while True:
+            candidate_id = self.matchmaker.find(searcher_gender, target_gender, exclude=searcher_id)
+            if candidate_id is None:
+                return None
+
+            row = self._verify_queued(cursor, candidate_id)
+            if row:
+                return row
+
+    def _verify_queued(self, cursor, user_id):
+        """
+        Re-check a queued user against SQLite. Returns the row if the engine
+        entry is still valid, otherwise drops or re-buckets it and returns None.
+        """
+        cursor.execute('''
+            SELECT u.user_id, u.gender, u.age, u.is_vip, u.state, u.is_banned, u.reachable, q.target_gender, q.is_vip AS queued_vip
+            FROM users u
+            JOIN search_queue q ON q.user_id = u.user_id
+            WHERE u.user_id = ?
+        ''', (user_id,))
+        row = cursor.fetchone()
+        if not row or row['state'] != 'SEARCHING' or row['is_banned'] or not row['reachable']:
+            self.matchmaker.remove(user_id)
+            return None
+
+        entry = (row['gender'], row['target_gender'], bool(row['queued_vip']))
+        if self.matchmaker.entry(user_id) != entry:
+            # Profile changed while queued: move to the right bucket and look again.
+            self.matchmaker.add(user_id, *entry, joined_at=self.matchmaker.joined_at(user_id))
+            return None
+
+        return row
+
+    def _begin_immediate(self, conn, operation):
+        """BEGIN IMMEDIATE, recording how long we waited for SQLite's write lock"""
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        metrics.DB_LOCK_WAIT.observe(time.perf_counter() - started, operation)
+
+    def _dequeue_matched(self, *user_ids):
+        """Take matched users out of the engine, recording how long the queued ones waited"""
+        now = time.time()
+        for user_id in user_ids:
+            joined_at = self.matchmaker.joined_at(user_id)
+            if joined_at is not None:
+                metrics.TIME_TO_MATCH.observe(max(0.0, now - joined_at))
+            self.matchmaker.remove(user_id)
+
+    def _start_chat(self, cursor, user1_id, user2_id):
+        """
+        Create the chat session for a matched pair inside the caller's transaction:
+        both users go to CHATTING, leave the queue, and the chat is logged.
+        Returns the new chat_id.
+        """
+        cursor.execute('''
+            INSERT INTO chat_sessions (user1_id, user2_id, started_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+        ''', (user1_id, user2_id))
+        chat_id = cursor.lastrowid
+
+        cursor.execute('''
+            UPDATE users
+            SET state = 'CHATTING', current_chat_id = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE user_id IN (?, ?)
+        ''', (chat_id, user1_id, user2_id))
+
+        cursor.execute('DELETE FROM search_queue WHERE user_id IN (?, ?)', (user1_id, user2_id))
+
+        cursor.execute('''
+            INSERT INTO chat_history (user1_id, user2_id, started_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+        ''', (user1_id, user2_id))
+        return chat_id
+
+    @_timed_operation
     def atomic_join_queue(self, user_id, target_gender='any'):
         """
         Atomically join search queue.
@@ -562,10 +1380,10 @@ class Database:
         
         try:
             # Start transaction
-            conn.execute('BEGIN IMMEDIATE')
+            self._begin_immediate(conn, 'atomic_join_queue')
             
             # Check user state
-            cursor.execute('SELECT state, is_banned FROM users WHERE user_id = ?', (user_id,))
+            cursor.execute('SELECT state, is_banned, gender, is_vip FROM users WHERE user_id = ?', (user_id,))
             row = cursor.fetchone()
             if not row:
                 conn.rollback()
@@ -593,6 +1411,8 @@ class Database:
             ''', (target_gender, user_id))
             
             conn.commit()
+            self.user_cache.invalidate(user_id)
+            self.matchmaker.add(user_id, row['gender'], target_gender, row['is_vip'])
             return (True, "Joined queue")
             
         except sqlite3.IntegrityError as e:
@@ -602,6 +1422,7 @@ class Database:
             conn.rollback()
             return (False, f"Error: {str(e)}")
     
+    @_timed_operation
     def atomic_match(self, searcher_id, target_gender='any'):
         """
         Atomically find and match with a partner.
@@ -621,7 +1442,7 @@ class Database:
         cursor = conn.cursor()
         
         try:
-            conn.execute('BEGIN IMMEDIATE')
+            self._begin_immediate(conn, 'atomic_match')
             
             # Get searcher info
             cursor.execute('SELECT gender, is_vip FROM users WHERE user_id = ?', (searcher_id,))
@@ -630,57 +1451,16 @@ class Database:
                 conn.rollback()
                 return (False, None, "Searcher not found")
             
-            searcher_is_vip = searcher_row['is_vip']
-            
-            # Build filter query.
-            # We must respect BOTH sides:
-            # - searcher constraint: candidate.gender must match searcher target_gender (if specified)
-            # - candidate constraint: searcher.gender must match candidate target_gender (if specified)
-            # This guarantees that if user asked for `female` and there is no suitable female,
-            # we simply return "No matching candidates" and the caller keeps/joins SEARCHING.
-            gender_filter = ""
-            mutual_filter = ""
-            params = [searcher_id]
-
-            if target_gender in ('male', 'female'):
-                gender_filter = " AND u.gender = ?"
-                params.append(target_gender)
-
-            # Candidate's preference must accept the searcher's gender.
-            # Allow q.target_gender='any'. Otherwise require exact match.
-            mutual_filter = " AND (q.target_gender = 'any' OR q.target_gender = ?)"
-            params.append(searcher_row['gender'])
-            
-            # Find candidate with row-level locking
-            # Note: SQLite doesn't have SELECT FOR UPDATE, but BEGIN IMMEDIATE
-            # gives us exclusive write lock on the entire database
-            cursor.execute(f'''
-                SELECT q.user_id, u.gender, u.age, u.is_vip
-                FROM search_queue q
-                JOIN users u ON q.user_id = u.user_id
-                WHERE q.user_id != ?
-                  AND u.state = 'SEARCHING'
-                  AND u.is_banned = 0
-                  {gender_filter}
-                  {mutual_filter}
-                ORDER BY q.is_vip DESC, q.joined_at ASC
-                LIMIT 1
-            ''', params)
-            
-            candidate_row = cursor.fetchone()
+            # Pick the best compatible candidate from the in-memory queue.
+            # Both sides' gender preferences and VIP-first ordering are
+            # enforced by the engine; the row is re-checked inside this transaction.
+            candidate_row = self._pick_candidate(cursor, searcher_id, searcher_row['gender'], target_gender)
             if not candidate_row:
                 conn.rollback()
                 return (False, None, "No matching candidates")
             
             partner_id = candidate_row['user_id']
             
-            # CRITICAL: Double-check partner is still SEARCHING (not already matched)
-            cursor.execute('SELECT state FROM users WHERE user_id = ?', (partner_id,))
-            check_row = cursor.fetchone()
-            if not check_row or check_row['state'] != 'SEARCHING':
-                conn.rollback()
-                return (False, None, "Candidate no longer available")
-            
             # Create chat session
             # Guard: ensure neither side currently has an active chat session.
             cursor.execute('''
@@ -692,30 +1472,14 @@ class Database:
                 conn.rollback()
                 return (False, None, 'Candidate no longer available')
 
-            cursor.execute('''
-                INSERT INTO chat_sessions (user1_id, user2_id, started_at)
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (searcher_id, partner_id))
-            
-            chat_id = cursor.lastrowid
-            
-            # Update both users to CHATTING
-            cursor.execute('''
-                UPDATE users
-                SET state = 'CHATTING', current_chat_id = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE user_id IN (?, ?)
-            ''', (chat_id, searcher_id, partner_id))
-            
-            # Remove both from queue
-            cursor.execute('DELETE FROM search_queue WHERE user_id IN (?, ?)', (searcher_id, partner_id))
-            
-            # Log to chat history
-            cursor.execute('''
-                INSERT INTO chat_history (user1_id, user2_id, started_at)
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (searcher_id, partner_id))
+            chat_id = self._start_chat(cursor, searcher_id, partner_id)
             
+            languages = self._fetch_languages(cursor, searcher_id, partner_id)
             conn.commit()
+            self.user_cache.invalidate(searcher_id)
+            self.user_cache.invalidate(partner_id)
+            self._dequeue_matched(searcher_id, partner_id)
+            self._open_route(chat_id, searcher_id, partner_id, languages)
             return (True, partner_id, f"Matched! Chat ID: {chat_id}")
             
         except sqlite3.IntegrityError as e:
@@ -725,6 +1489,63 @@ class Database:
             conn.rollback()
             return (False, None, f"Error: {str(e)}")
     
+    @_timed_operation
+    def atomic_match_pending(self):
+        """
+        Pair everyone in the queue that can be paired, in one write transaction.
+        Used by the batched matchmaking tick instead of per-/search matching.
+
+        Searchers are taken in queue priority order (VIP first, then earliest
+        joined) and each is matched with its best compatible partner.
+
+        Returns a list of (user_id, partner_id, chat_id) tuples.
+        """
+        if len(self.matchmaker) < 2:
+            return []
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        pairs = []
+
+        try:
+            self._begin_immediate(conn, 'atomic_match_pending')
+
+            for searcher_id in self.matchmaker.queued():
+                if searcher_id not in self.matchmaker:
+                    continue  # Paired earlier in this tick
+
+                searcher_row = self._verify_queued(cursor, searcher_id)
+                if not searcher_row:
+                    continue
+
+                candidate_row = self._pick_candidate(
+                    cursor, searcher_id, searcher_row['gender'], searcher_row['target_gender']
+                )
+                if not candidate_row:
+                    continue
+
+                partner_id = candidate_row['user_id']
+                chat_id = self._start_chat(cursor, searcher_id, partner_id)
+                # Take both out of the engine now so later searchers in this tick skip them.
+                self._dequeue_matched(searcher_id, partner_id)
+                pairs.append((searcher_id, partner_id, chat_id))
+
+            paired_ids = [user_id for pair in pairs for user_id in pair[:2]]
+            languages = self._fetch_languages(cursor, *paired_ids) if pairs else {}
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            # The engine was edited inside the rolled-back transaction; resync it.
+            self.load_queue()
+            raise
+
+        for user_id, partner_id, chat_id in pairs:
+            self.user_cache.invalidate(user_id)
+            self.user_cache.invalidate(partner_id)
+            self._open_route(chat_id, user_id, partner_id, languages)
+        return pairs
+    
+    @_timed_operation
     def atomic_leave_queue(self, user_id):
         """
         Atomically leave search queue.
@@ -734,7 +1555,7 @@ class Database:
         cursor = conn.cursor()
         
         try:
-            conn.execute('BEGIN IMMEDIATE')
+            self._begin_immediate(conn, 'atomic_leave_queue')
             
             # Remove from queue
             cursor.execute('DELETE FROM search_queue WHERE user_id = ?', (user_id,))
@@ -747,12 +1568,15 @@ class Database:
             ''', (user_id,))
             
             conn.commit()
+            self.user_cache.invalidate(user_id)
+            self.matchmaker.remove(user_id)
             return (True, "Left queue")
             
         except Exception as e:
             conn.rollback()
             return (False, f"Error: {str(e)}")
     
+    @_timed_operation
     def atomic_end_chat(self, user_id):
         """
         Atomically end current chat session.
@@ -763,7 +1587,7 @@ class Database:
         cursor = conn.cursor()
         
         try:
-            conn.execute('BEGIN IMMEDIATE')
+            self._begin_immediate(conn, 'atomic_end_chat')
             
             # Get current chat info
             cursor.execute('SELECT state, current_chat_id FROM users WHERE user_id = ?', (user_id,))
@@ -806,16 +1630,24 @@ class Database:
             cursor.execute('DELETE FROM search_queue WHERE user_id IN (?, ?)', (user_id, partner_id))
             
             conn.commit()
+            self.user_cache.invalidate(user_id)
+            self.user_cache.invalidate(partner_id)
+            self.matchmaker.remove(user_id)
+            self.matchmaker.remove(partner_id)
+            self._close_route(user_id)
+            self._close_route(partner_id)
             return (True, partner_id, "Chat ended")
             
         except Exception as e:
             conn.rollback()
             return (False, None, f"Error: {str(e)}")
     
-    def atomic_next_partner(self, user_id, target_gender='any'):
+    @_timed_operation
+    def atomic_next_partner(self, user_id, target_gender='any', try_match=True):
         """
         Atomic /next operation: end current chat + start new search.
         This is the "super-operation" that prevents /next race conditions.
+        With try_match=False the user is only queued (batched matchmaking).
         
         Returns (success: bool, action: str, data: dict)
         action can be: 'matched', 'searching', 'error'
@@ -824,7 +1656,7 @@ class Database:
         cursor = conn.cursor()
         
         try:
-            conn.execute('BEGIN IMMEDIATE')
+            self._begin_immediate(conn, 'atomic_next_partner')
             
             # Step 1: End current chat if exists
             # Important: don't trust `state` alone. If `current_chat_id` points to an active
@@ -885,31 +1717,9 @@ class Database:
             cursor.execute('SELECT gender, is_vip FROM users WHERE user_id = ?', (user_id,))
             searcher_row = cursor.fetchone()
             
-            gender_filter = ""
-            mutual_filter = ""
-            params = [user_id]
-            if target_gender in ('male', 'female'):
-                gender_filter = " AND u.gender = ?"
-                params.append(target_gender)
-
-            # Candidate's preference must accept the searcher's gender.
-            mutual_filter = " AND (q.target_gender = 'any' OR q.target_gender = ?)"
-            params.append(searcher_row['gender'])
-            
-            cursor.execute(f'''
-                SELECT q.user_id, u.gender, u.age, u.is_vip
-                FROM search_queue q
-                JOIN users u ON q.user_id = u.user_id
-                WHERE q.user_id != ?
-                  AND u.state = 'SEARCHING'
-                  AND u.is_banned = 0
-                  {gender_filter}
-                  {mutual_filter}
-                ORDER BY q.is_vip DESC, q.joined_at ASC
-                LIMIT 1
-            ''', params)
-            
-            candidate_row = cursor.fetchone()
+            candidate_row = None
+            if try_match:
+                candidate_row = self._pick_candidate(cursor, user_id, searcher_row['gender'], target_gender)
             
             if candidate_row:
                 # Found match!
@@ -928,30 +1738,16 @@ class Database:
                 partner_id = candidate_row['user_id']
                 
                 # Create chat session
-                cursor.execute('''
-                    INSERT INTO chat_sessions (user1_id, user2_id, started_at)
-                    VALUES (?, ?, CURRENT_TIMESTAMP)
-                ''', (user_id, partner_id))
-                
-                chat_id = cursor.lastrowid
-                
-                # Update both to CHATTING
-                cursor.execute('''
-                    UPDATE users
-                    SET state = 'CHATTING', current_chat_id = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id IN (?, ?)
-                ''', (chat_id, user_id, partner_id))
-                
-                # Remove from queue
-                cursor.execute('DELETE FROM search_queue WHERE user_id IN (?, ?)', (user_id, partner_id))
-                
-                # Log
-                cursor.execute('''
-                    INSERT INTO chat_history (user1_id, user2_id, started_at)
-                    VALUES (?, ?, CURRENT_TIMESTAMP)
-                ''', (user_id, partner_id))
+                chat_id = self._start_chat(cursor, user_id, partner_id)
                 
+                languages = self._fetch_languages(cursor, user_id, partner_id)
                 conn.commit()
+                self._invalidate_users(user_id, partner_id, old_partner_id)
+                self._dequeue_matched(user_id, partner_id)
+                self._close_route(user_id)
+                if old_partner_id:
+                    self._close_route(old_partner_id)
+                self._open_route(chat_id, user_id, partner_id, languages)
                 
                 # Get partner info
                 partner_info = {
@@ -976,8 +1772,61 @@ class Database:
                 ''', (target_gender, user_id))
                 
                 conn.commit()
+                self._invalidate_users(user_id, old_partner_id)
+                self.matchmaker.add(user_id, searcher_row['gender'], target_gender, searcher_row['is_vip'])
+                self._close_route(user_id)
+                if old_partner_id:
+                    self._close_route(old_partner_id)
                 return (True, 'searching', {'message': 'Searching for next partner', 'old_partner_id': old_partner_id})
         
         except Exception as e:
             conn.rollback()
             return (False, 'error', {'message': f'Error: {str(e)}'})
+
+
+class AsyncDatabase:
+    """
+    Async facade over Database for use inside handlers.
+
+    Every call is queued to one dedicated DB thread, so SQLite work (including
+    waiting on BEGIN IMMEDIATE) never blocks the event loop. The wrapped
+    Database keeps its sync API for scripts:
+
+        db = Database()
+        async_db = AsyncDatabase(db)
+        user = await async_db.get_user(user_id)
+    """
+
+    def __init__(self, db):
+        self.db = db
+        # One worker = one thread-local connection and FIFO ordering of calls.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+
+    async def _run(self, func, *args, **kwargs):
+        calls = db_calls.get()
+        if calls is not None:
+            calls.append(func.__name__)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            return await self._run(attr, *args, **kwargs)
+
+        return call
+
+    async def get_user(self, user_id):
+        """Cache hits are answered on the event loop without queuing behind DB work."""
+        user = self.db.cached_user(user_id)
+        if user is not None:
+            return user
+        return await self._run(self.db._load_user, user_id)
+
+    def close(self):
+        """Wait for queued calls to finish and stop the DB thread."""
+        self._executor.shutdown(wait=True)
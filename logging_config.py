@@ -0,0 +1,149 @@
+"""
+Logging setup for Anonymous Chat Bot
+Handlers only enqueue records; formatting and I/O happen on a listener thread
+
+Structured fields are passed with `extra`, and messages use lazy %-style
+arguments so nothing is formatted for records that get filtered out:
+
+    logger.info("Matched %s <-> %s", user_id, partner_id,
+                extra={'event': 'match', 'user_id': user_id, 'partner_id': partner_id})
+"""
+
+import atexit
+import copy
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# Attributes every LogRecord has; anything else on a record came from `extra`.
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+def parse_mapping(raw: str) -> dict:
+    """'database=WARNING,httpx=WARNING' -> {'database': 'WARNING', 'httpx': 'WARNING'}"""
+    mapping = {}
+    for item in raw.split(','):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            if key.strip():
+                mapping[key.strip()] = value.strip()
+    return mapping
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, plus any `extra` fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep 1 in N records of high-volume events (by the record's `event` field).
+    Records without a sampled event always pass.
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = {event: int(rate) for event, rate in rates.items() if int(rate) > 1}
+        self._counters = {event: itertools.count() for event in self.rates}
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        counter = self._counters.get(event)
+        if counter is None:
+            return True
+        return next(counter) % self.rates[event] == 0
+
+
+class _EnqueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that renders only what can't wait. Filtering has already
+    happened when prepare() runs, so `msg % args` is paid for kept records
+    only; it must happen here because args may be mutable objects the
+    caller changes after logging. The traceback is rendered too, so no
+    frames are kept alive. The JSON or text formatting stays on the
+    listener thread (the stock prepare() does all of it in the caller).
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _TRACEBACKS.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_TRACEBACKS = logging.Formatter()
+
+
+def setup_logging(level='INFO', levels=None, fmt='json', sample_rates=None, log_file=None):
+    """
+    Route all logging through a queue to a background listener.
+
+    level: root level. levels: per-logger overrides ({'database': 'DEBUG'}).
+    fmt: 'json' or 'text'. sample_rates: {'relay': 100} keeps 1 in 100 relay records.
+    Returns stop(): flushes the queue and closes the outputs. It runs at exit
+    unless called earlier, and is safe to call more than once.
+    """
+    if fmt == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    outputs = [logging.StreamHandler(sys.stderr)]
+    if log_file:
+        outputs.append(logging.FileHandler(log_file, encoding='utf-8'))
+    for handler in outputs:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    enqueue = _EnqueueHandler(log_queue)
+    if sample_rates:
+        enqueue.addFilter(SamplingFilter(sample_rates))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(enqueue)
+    root.setLevel(level)
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level.upper())
+
+    listener = logging.handlers.QueueListener(log_queue, *outputs, respect_handler_level=True)
+    listener.start()
+
+    stopped = False
+
+    def stop():
+        # QueueListener.stop() fails if called twice, so it runs at most once.
+        nonlocal stopped
+        atexit.unregister(stop)
+        if stopped:
+            return
+        stopped = True
+        listener.stop()
+        for handler in outputs:
+            handler.close()
+
+    atexit.register(stop)
+    return stop
@@ -120,6 +120,30 @@ def show_status():
     
     print("\n" + "=" * 50)
 
+def check_ratings(repair=False):
+    """Verify denormalized rating counters against the ratings history"""
+    from config import DATABASE_PATH
+    from database import Database
+    
+    db = Database(DATABASE_PATH)
+    mismatched = db.check_rating_counters(repair=repair)
+    
+    if not mismatched:
+        print("✅ Rating counters are consistent")
+        return True
+    
+    print(f"⚠️  {len(mismatched)} user(s) with inconsistent rating counters:")
+    for user_id in mismatched[:20]:
+        print(f"   - {user_id}")
+    if len(mismatched) > 20:
+        print(f"   ... and {len(mismatched) - 20} more")
+    
+    if repair:
+        print("\n✅ Counters rebuilt from ratings history")
+    else:
+        print("\n   Run 'python manage_bot.py check-ratings --repair' to rebuild them")
+    return repair
+
 def show_help():
     """Show help message"""
     print("""
@@ -132,6 +156,8 @@ Commands:
   stop     - Stop all running bot instances
   restart  - Restart the bot
   status   - Show bot status
+  check-ratings [--repair]
+           - Verify (and optionally rebuild) rating counters
   help     - Show this help message
 
 Examples:
@@ -160,6 +186,9 @@ def main():
         restart_bot()
     elif command == 'status':
         show_status()
+    elif command == 'check-ratings':
+        if not check_ratings(repair='--repair' in sys.argv[2:]):
+            sys.exit(1)
     elif command in ['help', '-h', '--help']:
         show_help()
     else:
@@ -0,0 +1,115 @@
+"""
+Matchmaking engine for Anonymous Chat Bot
+Keeps the search queue in memory, bucketed for O(1) partner lookup
+"""
+
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+GENDERS = ('male', 'female')
+TARGETS = ('male', 'female', 'any')
+
+
+class MatchmakingEngine:
+    """
+    In-memory search queue bucketed by (gender, target_gender, is_vip).
+
+    Each bucket is FIFO, so finding a partner only looks at the heads of the
+    (at most four) compatible buckets per VIP tier, no matter how many users
+    are searching. SQLite's search_queue stays the durable record: the
+    Database updates the engine after each commit and rebuilds it on startup.
+
+    Matching rules (same as the original SQL):
+    - searcher's target_gender must accept the candidate's gender
+    - candidate's target_gender must accept the searcher's gender
+    - VIP candidates first, then whoever joined earliest
+    """
+
+    def __init__(self):
+        self._buckets = {
+            (gender, target, is_vip): OrderedDict()
+            for gender in GENDERS
+            for target in TARGETS
+            for is_vip in (True, False)
+        }
+        self._entries = {}  # {user_id: (bucket_key, joined_at)}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def add(self, user_id, gender, target_gender, is_vip, joined_at=None):
+        """Queue user_id (re-queues at the tail if already present)"""
+        key = (gender, target_gender, bool(is_vip))
+        with self._lock:
+            self._discard(user_id)
+            self._buckets.setdefault(key, OrderedDict())[user_id] = next(self._seq)
+            self._entries[user_id] = (key, joined_at if joined_at is not None else time.time())
+
+    def remove(self, user_id):
+        """Drop user_id from the queue. Returns True if it was queued."""
+        with self._lock:
+            return self._discard(user_id)
+
+    def _discard(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return False
+        del self._buckets[entry[0]][user_id]
+        return True
+
+    def find(self, gender, target_gender, exclude=None):
+        """
+        Return the best queued partner for a searcher, or None.
+        The partner is not removed: callers remove both users once the match is committed.
+        """
+        candidate_genders = GENDERS if target_gender == 'any' else (target_gender,)
+        with self._lock:
+            for is_vip in (True, False):
+                best_user_id, best_seq = None, None
+                for candidate_gender in candidate_genders:
+                    for candidate_target in (gender, 'any'):
+                        bucket = self._buckets.get((candidate_gender, candidate_target, is_vip))
+                        if not bucket:
+                            continue
+                        # At most two steps: the head, or the one after the excluded searcher.
+                        for user_id, seq in bucket.items():
+                            if user_id == exclude:
+                                continue
+                            if best_seq is None or seq < best_seq:
+                                best_user_id, best_seq = user_id, seq
+                            break
+                if best_user_id is not None:
+                    return best_user_id
+        return None
+
+    def queued(self):
+        """Snapshot of queued user_ids in priority order (VIP first, then earliest joined)"""
+        with self._lock:
+            ordered = sorted(
+                (not key[2], seq, user_id)
+                for key, bucket in self._buckets.items()
+                for user_id, seq in bucket.items()
+            )
+        return [user_id for _, _, user_id in ordered]
+
+    def depths(self):
+        """{(gender, target_gender, is_vip): queued users} for every bucket"""
+        with self._lock:
+            return {key: len(bucket) for key, bucket in self._buckets.items()}
+
+    def joined_at(self, user_id):
+        """Wall-clock time user_id joined the queue, or None"""
+        entry = self._entries.get(user_id)
+        return entry[1] if entry else None
+
+    def entry(self, user_id):
+        """(gender, target_gender, is_vip) for a queued user, or None"""
+        entry = self._entries.get(user_id)
+        return entry[0] if entry else None
+
+    def __contains__(self, user_id):
+        return user_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,260 @@
+"""
+Metrics for Anonymous Chat Bot
+Counters, gauges and histograms rendered in the Prometheus text format
+and served on a local HTTP endpoint (see config.METRICS_PORT)
+
+Updating a metric is a dict lookup and an addition under an uncontended
+lock, so instrumentation stays on in production. Values that already live
+somewhere else (queue sizes, cache counters) are read at scrape time with
+Gauge(..., fn=...) instead of being tracked on every change.
+"""
+
+import asyncio
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Seconds: from sub-millisecond SQLite calls to slow Telegram API round trips
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Seconds a user waits in the queue before being matched
+WAIT_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + body + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class: a named family of samples keyed by label values"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=(), registry=None):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def samples(self):
+        """[(suffix, label values, extra labels, value)] for rendering"""
+        with self._lock:
+            return [('', labels, (), value) for labels, value in self._values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, labels, extra)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Monotonic count, e.g. API calls or 429 responses"""
+
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Gauge(Metric):
+    """
+    Current value. Either set() explicitly or computed at scrape time by
+    fn() -> number (unlabelled) or fn() -> {label values tuple: number}.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), registry=None, fn=None):
+        super().__init__(name, help_text, labelnames, registry)
+        self.fn = fn
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self):
+        if self.fn is None:
+            return super().samples()
+        try:
+            result = self.fn()
+        except Exception as e:
+            logger.warning("Metric %s callback failed: %s", self.name, e)
+            return []
+        if not self.labelnames:
+            return [('', (), (), result)]
+        return [('', labels, (), value) for labels, value in result.items()]
+
+
+class Histogram(Metric):
+    """Distribution of observations in cumulative buckets, plus sum and count"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # [per-bucket counts (last one is +Inf), sum, count]
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, *labels):
+        """Context manager observing the elapsed time of a block"""
+        return _Timer(self, labels)
+
+    def count(self, *labels):
+        entry = self._values.get(labels)
+        return entry[2] if entry else 0
+
+    def samples(self):
+        with self._lock:
+            snapshot = [(labels, list(entry[0]), entry[1], entry[2]) for labels, entry in self._values.items()]
+        samples = []
+        for labels, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', labels, (('le', _format_value(float(bound))),), cumulative))
+            samples.append(('_sum', labels, (), total))
+            samples.append(('_count', labels, (), count))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+
+def instrument_handler(callback):
+    """Wrap a PTB handler callback to record its latency and failures under its name"""
+    label = getattr(callback, '__name__', 'handler')
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(label)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, label)
+
+    return wrapper
+
+
+class Registry:
+    """Set of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+
+async def serve(host: str, port: int, registry: Registry = REGISTRY):
+    """
+    Serve GET /metrics on host:port. Returns the asyncio server (close() it on shutdown).
+    Bind to localhost unless a scraper on another host needs it.
+    """
+
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Drain headers; the request has no body.
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                'Connection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info("Metrics endpoint on http://%s:%s/metrics", host, port)
+    return server
+
+
+# ==================== BOT METRICS ====================
+
+HANDLER_LATENCY = Histogram(
+    'chatbot_handler_seconds', 'Time spent in each update handler', ('handler',))
+HANDLER_ERRORS = Counter(
+    'chatbot_handler_errors_total', 'Handler calls that raised', ('handler',))
+DB_TRANSACTION = Histogram(
+    'chatbot_db_transaction_seconds', 'Duration of atomic_* database operations', ('operation',))
+DB_LOCK_WAIT = Histogram(
+    'chatbot_db_lock_wait_seconds', 'Time spent waiting for BEGIN IMMEDIATE', ('operation',))
+TIME_TO_MATCH = Histogram(
+    'chatbot_time_to_match_seconds', 'Time between joining the search queue and being matched',
+    buckets=WAIT_BUCKETS)
+API_CALLS = Counter(
+    'chatbot_telegram_api_calls_total', 'Outbound Bot API requests by method and HTTP status', ('method', 'status'))
+API_LATENCY = Histogram(
+    'chatbot_telegram_api_seconds', 'Outbound Bot API request latency', ('method',))
+API_FLOOD_WAITS = Counter(
+    'chatbot_telegram_flood_waits_total', 'Bot API 429 (RetryAfter) responses', ('method',))
@@ -0,0 +1,205 @@
+"""
+Content moderation for Anonymous Chat Bot
+Checks a message for links and bad words with matchers compiled once at startup,
+and hot-swaps the word list when its file changes
+"""
+
+import os
+import re
+import threading
+import unicodedata
+from collections import deque
+from typing import Iterable, List, NamedTuple, Optional
+
+# Applied after NFKC + casefold, to both the word list and messages, so that
+# look-alike spellings collapse to one form. Covers Cyrillic/Greek/Armenian
+# letters that look Latin, common leetspeak, and invisible format characters.
+_SKELETON = str.maketrans({
+    # Cyrillic
+    'а': 'a', 'в': 'b', 'е': 'e', 'ё': 'e', 'к': 'k', 'м': 'm', 'н': 'h', 'о': 'o',
+    'р': 'p', 'с': 'c', 'т': 't', 'у': 'y', 'х': 'x', 'і': 'i', 'ј': 'j', 'ѕ': 's', 'һ': 'h', 'ԁ': 'd',
+    # Greek
+    'α': 'a', 'β': 'b', 'ε': 'e', 'ι': 'i', 'κ': 'k', 'ν': 'v', 'ο': 'o', 'ρ': 'p', 'τ': 't', 'χ': 'x',
+    # Armenian
+    'օ': 'o', 'ս': 'u', 'ո': 'n', 'հ': 'h', 'զ': 'q',
+    # Leetspeak
+    '0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '@': 'a', '$': 's',
+    # Zero-width and soft-hyphen characters used to split words
+    '\u00ad': None, '\u200b': None, '\u200c': None, '\u200d': None, '\u2060': None, '\ufeff': None,
+})
+
+
+def normalize(text: str) -> str:
+    """Canonical form used for bad-word matching (NFKC, casefold, look-alike folding)"""
+    return unicodedata.normalize('NFKC', text).casefold().translate(_SKELETON)
+
+
+def load_word_list(path: str) -> List[str]:
+    """Read a word list file: UTF-8, one term per line, '#' starts a comment"""
+    words = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            word = line.split('#', 1)[0].strip()
+            if word:
+                words.append(word)
+    return words
+
+
+class Verdict(NamedTuple):
+    """Result of ModerationEngine.check: the first offending link / bad word, if any"""
+    link: Optional[str] = None
+    bad_word: Optional[str] = None
+
+    @property
+    def allowed(self) -> bool:
+        return self.link is None and self.bad_word is None
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton over a fixed word list (substring matching).
+    Finds the first word occurring in a text in one left-to-right pass,
+    no matter how many words there are.
+    """
+
+    def __init__(self, words: Iterable[str]):
+        self._goto = [{}]    # state -> {char: next state}
+        self._fail = [0]     # state -> longest proper suffix state
+        self._output = [None]  # state -> a word ending at this state (own or via suffix)
+
+        for word in words:
+            if not word:
+                continue
+            state = 0
+            for char in word:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(None)
+                    self._goto[state][char] = next_state
+                state = next_state
+            self._output[state] = word
+
+        # Breadth-first, so every fail target is finished before it is used.
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                if self._output[next_state] is None:
+                    self._output[next_state] = self._output[self._fail[next_state]]
+
+    def search(self, text: str) -> Optional[str]:
+        """Return the first word found in text, or None"""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+
+class ModerationEngine:
+    """
+    Link and bad-word filter built once from URL patterns and a word list.
+
+    Links: URL patterns are joined into a single compiled regex and matched
+    against the lowercased message.
+
+    Bad words: terms and messages are both normalize()d, then matched as
+    substrings. A handful of terms are tested with plain `in` checks (each a
+    C-level scan); longer lists go to an Aho-Corasick automaton, so the cost
+    per message does not grow with the size of the list.
+    """
+
+    # Measured crossover (benchmark.py): below this, `in` checks beat the pure-Python automaton.
+    AUTOMATON_MIN_WORDS = 100
+
+    def __init__(self, url_patterns: Iterable[str], bad_words: Iterable[str]):
+        patterns = [f'(?:{pattern})' for pattern in url_patterns]
+        self._links = re.compile('|'.join(patterns)) if patterns else None
+
+        # normalized form -> term as written in the list (reported in the verdict)
+        self._terms = {}
+        for word in bad_words:
+            key = normalize(word)
+            if key:
+                self._terms.setdefault(key, word)
+        words = sorted(self._terms)
+        self._word_list = tuple(words)
+        self._automaton = AhoCorasick(words) if len(words) >= self.AUTOMATON_MIN_WORDS else None
+
+    @property
+    def word_count(self) -> int:
+        return len(self._word_list)
+
+    def _find_word(self, text: str) -> Optional[str]:
+        if self._automaton:
+            return self._automaton.search(text)
+        for word in self._word_list:
+            if word in text:
+                return word
+        return None
+
+    def check(self, text: str) -> Verdict:
+        """Return the first link and the first bad word in text"""
+        if not text:
+            return Verdict()
+
+        match = self._links.search(text.lower()) if self._links else None
+        word = self._find_word(normalize(text))
+        return Verdict(match.group() if match else None, self._terms[word] if word else None)
+
+
+class ModerationService:
+    """
+    Holds the current ModerationEngine and rebuilds it when the word list
+    file changes. A rebuild never blocks readers: the new engine is built
+    aside and swapped in with one reference assignment, so check() always
+    sees either the old list or the new one.
+
+    Words are config.BAD_WORDS plus the file's terms (if the file exists).
+    """
+
+    def __init__(self, url_patterns: Iterable[str], base_words: Iterable[str] = (), words_path: Optional[str] = None):
+        self.url_patterns = list(url_patterns)
+        self.base_words = list(base_words)
+        self.words_path = words_path
+        self.engine = ModerationEngine(self.url_patterns, self.base_words)
+        self._loaded_mtime = None
+        self._reload_lock = threading.Lock()
+
+    def check(self, text: str) -> Verdict:
+        return self.engine.check(text)
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.words_path).st_mtime_ns if self.words_path else None
+        except FileNotFoundError:
+            return None
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Rebuild the engine if the word file changed (always, with force).
+        Slow for large lists, so call it off the event loop. Returns True if swapped.
+        """
+        with self._reload_lock:
+            mtime = self._file_mtime()
+            if not force and mtime == self._loaded_mtime:
+                return False
+
+            words = list(self.base_words)
+            if mtime is not None:
+                words += load_word_list(self.words_path)
+            self.engine = ModerationEngine(self.url_patterns, words)
+            self._loaded_mtime = mtime
+            return True
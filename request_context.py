@@ -0,0 +1,127 @@
+"""
+Per-update request context for Anonymous Chat Bot
+Memoizes what handlers look up about the sender and counts DB calls per update type
+"""
+
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from database import db_calls
+
+_MISSING = object()
+
+
+class RequestContext(CallbackContext):
+    """
+    CallbackContext that remembers lookups about the update's user.
+
+    PTB builds one context per update and passes it to every handler group,
+    so the user row, language, state and partner are read at most once per
+    update no matter how many helpers ask for them. Handlers that change
+    the user (state transitions, profile or subscription updates) call
+    forget() so later lookups in the same update see the new values.
+
+    Register with ContextTypes(context=RequestContext) after binding the
+    database: RequestContext.database = async_db.
+    """
+
+    database = None  # AsyncDatabase, bound once at startup
+
+    def __init__(self, application, chat_id=None, user_id=None):
+        super().__init__(application, chat_id=chat_id, user_id=user_id)
+        self._memo = {}
+
+    async def _memoized(self, key, load):
+        value = self._memo.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._memo[key] = await load()
+        return value
+
+    async def user_row(self):
+        """users row of the update's sender, or None if unregistered"""
+        return await self._memoized('user', lambda: self.database.get_user(self._user_id))
+
+    async def user_lang(self) -> str:
+        """Sender's language: routing table first (no DB hop), then the users row"""
+        route = self.database.db.get_route(self._user_id)
+        if route:
+            return route[2]
+        user = await self.user_row()
+        return (user.get('language') if user else None) or 'en'
+
+    async def user_state(self):
+        """{'state': ..., 'chat_id': ...} of the sender, or None"""
+        return await self._memoized('state', lambda: self.database.get_user_state(self._user_id))
+
+    def partner_id(self):
+        """Sender's chat partner from the routing table, or None"""
+        if 'partner' not in self._memo:
+            self._memo['partner'] = self.database.db.get_partner_id(self._user_id)
+        return self._memo['partner']
+
+    def forget(self):
+        """Drop memoized values after the handler changed the user"""
+        self._memo.clear()
+
+
+def update_kind(update) -> str:
+    """Coarse update type used to label per-update statistics"""
+    if not isinstance(update, Update):
+        return 'other'
+    if update.callback_query:
+        return 'callback_query'
+    if update.my_chat_member:
+        return 'my_chat_member'
+    if update.chat_member:
+        return 'chat_member'
+    message = update.effective_message
+    if message:
+        if message.text:
+            return 'command' if message.text.startswith('/') else 'message'
+        return 'media'
+    return 'other'
+
+
+class QueryStats:
+    """DB calls made per update, aggregated by update kind"""
+
+    def __init__(self):
+        self._updates = defaultdict(int)
+        self._calls = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, kind: str, calls: int):
+        with self._lock:
+            self._updates[kind] += 1
+            self._calls[kind] += calls
+
+    def summary(self) -> dict:
+        """{kind: {'updates': n, 'db_calls': n, 'per_update': avg}}"""
+        with self._lock:
+            return {
+                kind: {
+                    'updates': count,
+                    'db_calls': self._calls[kind],
+                    'per_update': self._calls[kind] / count,
+                }
+                for kind, count in self._updates.items()
+            }
+
+
+query_stats = QueryStats()
+
+
+@contextmanager
+def count_db_calls(kind: str, stats: QueryStats = query_stats):
+    """Count AsyncDatabase calls made inside the block (and tasks it spawns) under kind"""
+    calls = []
+    token = db_calls.set(calls)
+    try:
+        yield calls
+    finally:
+        db_calls.reset(token)
+        stats.record(kind, len(calls))
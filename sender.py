@@ -0,0 +1,153 @@
+"""
+Outbound message sender for Anonymous Chat Bot
+Fans notifications out concurrently while staying under Telegram's rate limits
+"""
+
+import asyncio
+import logging
+import time
+
+from telegram.error import Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Async token bucket: refills `rate` tokens per second up to `capacity`.
+    acquire() waits for a token; pause() blocks every caller (used on 429s).
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Hand out no tokens for the next `seconds` and drop the accumulated burst."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class MessageSender:
+    """
+    Shared outbound sender.
+
+    - global token bucket (Telegram allows ~30 messages/sec per bot)
+    - per-chat spacing (~1 message/sec to the same chat)
+    - bounded number of in-flight requests
+    - RetryAfter (429) pauses the whole sender and retries the message
+    - Forbidden (bot blocked) is reported to `on_forbidden(chat_id)` if given
+    """
+
+    def __init__(self, global_rate: float = 30, per_chat_rate: float = 1.0,
+                 max_concurrency: int = 20, max_retries: int = 3, on_forbidden=None):
+        self.bucket = TokenBucket(global_rate)
+        self.per_chat_interval = 1.0 / per_chat_rate
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.on_forbidden = on_forbidden
+        self._chat_next = {}  # {chat_id: monotonic time of the next free slot}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _wait_turn(self, chat_id: int):
+        now = time.monotonic()
+        if len(self._chat_next) > 10000:
+            self._chat_next = {cid: t for cid, t in self._chat_next.items() if t > now}
+        slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + self.per_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        await self.bucket.acquire()
+
+    async def send(self, bot, chat_id: int, text: str, **kwargs):
+        """Send one message within the limits. Raises the TelegramError if it finally fails."""
+        for attempt in range(self.max_retries + 1):
+            await self._wait_turn(chat_id)
+            async with self._semaphore:
+                try:
+                    return await bot.send_message(chat_id, text, **kwargs)
+                except RetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    logger.warning("Flood control hit sending to %s, pausing %ss", chat_id, e.retry_after)
+                    self.bucket.pause(float(e.retry_after))
+                except Forbidden:
+                    if self.on_forbidden:
+                        await self.on_forbidden(chat_id)
+                    raise
+
+    async def send_many(self, bot, messages, progress=None, progress_every: int = 100) -> dict:
+        """
+        Send an iterable of messages (dicts of send_message kwargs: chat_id, text, ...).
+        The iterable is consumed lazily, so it can be a generator over 100k users.
+
+        progress: optional `async def progress(sent, failed)`, called every
+        progress_every messages.
+
+        Returns {'sent': int, 'failed': int}.
+        """
+        stats = {'sent': 0, 'failed': 0}
+        pending = iter(messages)
+
+        async def worker():
+            for message in pending:
+                message = dict(message)
+                chat_id = message.pop('chat_id')
+                text = message.pop('text')
+                try:
+                    await self.send(bot, chat_id, text, **message)
+                    stats['sent'] += 1
+                except TelegramError as e:
+                    stats['failed'] += 1
+                    logger.warning("Failed to send to %s: %s", chat_id, e)
+
+                if progress and (stats['sent'] + stats['failed']) % progress_every == 0:
+                    await progress(stats['sent'], stats['failed'])
+
+        await asyncio.gather(*(worker() for _ in range(self.max_concurrency)))
+        return stats
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    HTTPXRequest that records every Bot API call: count by method and HTTP
+    status, latency, and 429 (flood control) responses. Pass it to
+    Application.builder().request(...) so all handler and sender calls go through it.
+    """
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            status, payload = await super().do_request(url, method, request_data, **kwargs)
+            return status, payload
+        finally:
+            metrics.API_LATENCY.observe(time.perf_counter() - started, api_method)
+            metrics.API_CALLS.inc(api_method, str(status))
+            if status == 429:
+                metrics.API_FLOOD_WAITS.inc(api_method)
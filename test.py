@@ -3,6 +3,7 @@ Test script for Anonymous Chat Bot
 Tests various components and functionality
 """
 
+import logging
 import sys
 import os
 
@@ -14,6 +15,7 @@ def test_database():
     print("Testing database...")
     
     try:
+        from datetime import datetime, timedelta
         from database import Database
         
         db = Database(':memory:')  # Use in-memory database for testing
@@ -37,6 +39,7 @@ def test_database():
         db.add_rating(12345, 67890, 'good')
         ratings = db.get_user_ratings(67890)
         assert ratings['good'] == 1
+        assert db.check_rating_counters() == []
         print("  ✅ Rating system works")
         
         # Test ban
@@ -45,6 +48,167 @@ def test_database():
         assert user['is_banned'] == True
         print("  ✅ Ban system works")
         
+        # Test broadcast jobs: keyset batches skip banned users, cancel stops the job
+        job_id = db.create_broadcast(1, 'hello')
+        assert db.get_broadcast()['total'] == 1
+        assert db.get_broadcast_recipients(0, 10) == [12345]
+        assert db.advance_broadcast(job_id, 12345, 1, 0) == 'running'
+        assert db.get_broadcast_recipients(12345, 10) == []
+        assert db.get_running_broadcasts() == [job_id]
+        assert db.finish_broadcast(job_id, 'cancelled')
+        assert db.advance_broadcast(job_id, 99999, 1, 0) == 'cancelled'
+        assert db.get_broadcast(job_id)['sent'] == 1 and db.get_running_broadcasts() == []
+        # /broadcast_cancel must reach an older running job, not just the newest one
+        older, newer = db.create_broadcast(1, 'a'), db.create_broadcast(1, 'b')
+        assert db.finish_broadcast(newer, 'done')
+        assert db.get_broadcast()['job_id'] == newer and db.get_running_broadcasts() == [older]
+        assert db.finish_broadcast(older, 'cancelled') and db.get_running_broadcasts() == []
+        print("  ✅ Broadcast jobs work")
+        
+        # Test reachability: blocked users leave the queue and get skipped
+        db.create_user(11111, 'female', 22)
+        db.atomic_join_queue(11111, 'any')
+        db.mark_user_unreachable(11111)
+        assert not db.is_reachable(11111) and 11111 not in db.matchmaker
+        assert db.get_user_state(11111)['state'] == 'IDLE'
+        assert 11111 not in [user['user_id'] for user in db.get_all_users()]
+        assert db.get_broadcast_recipients(0, 10) == [12345]
+        db.mark_user_reachable(11111)
+        assert db.is_reachable(11111) and db.load_unreachable() == 0
+        print("  ✅ Reachability tracking works")
+        
+        # Test stored channel memberships: old negatives expire sooner than positives
+        db.set_channel_membership(12345, '@joined', True)
+        db.set_channel_membership(12345, '@left', False)
+        db.get_connection().execute(
+            "UPDATE channel_memberships SET updated_at = datetime('now', '-60 seconds') WHERE user_id = 12345"
+        )
+        assert db.get_channel_memberships(12345, 86400) == {'@joined': True, '@left': False}
+        assert db.get_channel_memberships(12345, 86400, 30) == {'@joined': True}
+        print("  ✅ Stored memberships age negatives separately")
+        
+        # Test user cache: repeated reads are hits, every write invalidates
+        db.user_cache.clear()
+        db.get_user(12345)
+        db.get_user(12345)
+        assert db.user_cache_stats()['hits'] >= 1 and db.user_cache_stats()['size'] == 1
+        db.get_user(12345)['age'] = 99  # callers get copies
+        assert db.get_user(12345)['age'] == 25
+        db.update_age(12345, 40)
+        assert db.get_user(12345)['age'] == 40
+        db.atomic_join_queue(12345, 'any')
+        assert db.get_user(12345)['state'] == 'SEARCHING'
+        db.atomic_leave_queue(12345)
+        assert db.get_user(12345)['state'] == 'IDLE'
+        db.unban_all_users()
+        assert not db.get_user(67890)['is_banned']
+        print("  ✅ User cache works")
+        
+        # Test stats counters: triggers track every write, including REPLACE and chats
+        db.create_user(22222, 'male', 20)
+        db.atomic_join_queue(22222, 'any')
+        assert db.atomic_match(11111, 'any')[0]
+        db.create_user(12345, 'male', 25)  # re-registration replaces the VIP row
+        db.add_rating(22222, 11111, 'scam')
+        stats = db.get_stats()
+        assert stats['total_users'] == 4 and stats['vip_users'] == 0 and stats['active_chats'] == 1
+        assert stats['in_queue'] == 0 and stats['total_ratings'] == 2 and stats['total_reports'] == 1
+        assert db.check_stats_counters() == {}
+        conn = db.get_connection()
+        conn.execute("INSERT OR IGNORE INTO users (user_id, gender, age) VALUES (67890, 'female', 30)")
+        conn.execute('''
+            INSERT INTO users (user_id, gender, age) VALUES (22222, 'male', 21)
+            ON CONFLICT(user_id) DO UPDATE SET age = excluded.age, is_banned = 1
+        ''')
+        conn.execute("INSERT OR REPLACE INTO users (user_id, gender, age) VALUES (11111, 'female', 22)")
+        conn.commit()
+        assert db.check_stats_counters() == {} and db.get_stats()['banned_users'] == 1
+        assert db.get_stats()['active_chats'] == 0  # the REPLACE ended 11111's chat row
+        db.get_connection().execute('UPDATE stats_counters SET total_users = 0')
+        assert db.check_stats_counters(repair=True) == {'total_users': (0, 4)}
+        assert db.check_stats_counters() == {}
+        db.take_stats_snapshot()
+        assert db.get_stats_snapshot(0)['total_users'] == 4 and db.get_stats_snapshot(1) is None
+        # A database left at version 5 loses the old REPLACE trigger and is recounted
+        import os, tempfile
+        from database import _STATS_USERS_REPLACE_TRIGGER
+        v5_path = os.path.join(tempfile.mkdtemp(), 'v5.db')
+        v5 = Database(v5_path)
+        v5.create_user(1, 'male', 20)
+        v5_conn = v5.get_connection()
+        v5_conn.execute(_STATS_USERS_REPLACE_TRIGGER)
+        v5_conn.execute('PRAGMA user_version = 5')
+        v5_conn.execute("INSERT OR IGNORE INTO users (user_id, gender, age) VALUES (1, 'male', 20)")
+        v5_conn.commit()
+        assert v5.check_stats_counters() == {'total_users': (0, 1)}
+        upgraded = Database(v5_path)
+        assert upgraded.check_stats_counters() == {}
+        assert not upgraded.get_connection().execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'stats_users_replace'").fetchone()
+        print("  ✅ Stats counters work")
+        
+        # Test VIP pages: expiry order, lifetime last, keyset cursors both ways
+        for user_id, days in ((22222, 5), (11111, 1), (67890, 3), (12345, None)):
+            db.set_vip_status(user_id, True, days=days or 1)
+        conn = db.get_connection()
+        conn.execute('UPDATE users SET vip_expires_at = NULL WHERE user_id = 12345')
+        conn.execute('UPDATE users SET vip_expires_at = ? WHERE user_id = 11111',
+                     (datetime.now() + timedelta(days=1, hours=12),))
+        first = db.get_vip_page(limit=2)
+        assert [u['user_id'] for u in first['users']] == [11111, 67890]
+        assert first['users'][0]['days_remaining'] == db.get_vip_days_remaining(11111) == 1
+        assert not first['has_prev'] and first['has_next']
+        last = first['users'][-1]
+        second = db.get_vip_page(after=(last['sort_key'], last['user_id']), limit=2)
+        assert [u['user_id'] for u in second['users']] == [22222, 12345]
+        assert second['users'][1]['days_remaining'] is None and not second['has_next']
+        back = db.get_vip_page(before=(second['users'][0]['sort_key'], 22222), limit=2)
+        assert back['users'] == first['users'] and not back['has_prev']
+        print("  ✅ VIP list pagination works")
+        
+        # Test VIP expiry: the heap drives on-time expiry, renewals elsewhere are respected
+        from vip_expiry import ExpiryHeap
+        heap = ExpiryHeap()
+        heap.set(1, 30.0)
+        heap.set(2, 10.0)
+        heap.set(3, 20.0)
+        heap.set(2, 40.0)  # renewal leaves a stale entry behind
+        heap.remove(3)
+        assert heap.next_deadline() == 30.0 and heap.pop_due(35.0) == [1] and len(heap) == 1
+        conn.execute('UPDATE users SET vip_expires_at = ? WHERE user_id IN (11111, 67890)',
+                     (datetime.now() - timedelta(seconds=1),))
+        conn.commit()
+        db.load_vip_expiries()
+        conn.execute('UPDATE users SET vip_expires_at = ? WHERE user_id = 67890',
+                     (datetime.now() + timedelta(days=3),))  # renewed by another process
+        conn.commit()
+        assert [u['user_id'] for u in db.expire_due_vips()] == [11111]
+        assert not db.get_user(11111)['is_vip'] and db.get_user(67890)['is_vip'] and 67890 in db.vip_expiry
+        assert db.expire_due_vips() == []
+        db.set_vip_status(22222, False)
+        assert 22222 not in db.vip_expiry and db.check_and_expire_vips() == []
+        # A locked DB must not lose the ids already popped from the heap
+        import os, sqlite3, tempfile
+        locked_path = os.path.join(tempfile.mkdtemp(), 'locked.db')
+        locked_db = Database(locked_path, pragmas={'busy_timeout': 0})
+        locked_db.create_user(33333, 'male', 30)
+        locked_db.set_vip_status(33333, True, days=1)
+        locked_db.get_connection().execute('UPDATE users SET vip_expires_at = ? WHERE user_id = 33333',
+                                           (datetime.now() - timedelta(seconds=1),))
+        locked_db.get_connection().commit()
+        locked_db.load_vip_expiries()
+        blocker = sqlite3.connect(locked_path)
+        blocker.execute('BEGIN IMMEDIATE')
+        try:
+            locked_db.expire_due_vips()
+            assert False, "expected the write lock to be busy"
+        except sqlite3.OperationalError:
+            pass
+        blocker.rollback()
+        assert 33333 in locked_db.vip_expiry
+        assert [u['user_id'] for u in locked_db.expire_due_vips()] == [33333]
+        print("  ✅ VIP expiry scheduling works")
+        
         print("✅ Database tests passed!\n")
         return True
         
@@ -53,12 +217,165 @@ def test_database():
         return False
 
 
+def test_matchmaking():
+    """Test in-memory matchmaking engine"""
+    print("Testing matchmaking engine...")
+    
+    try:
+        from matchmaking import MatchmakingEngine
+        
+        engine = MatchmakingEngine()
+        engine.add(1, 'female', 'any', False)
+        engine.add(2, 'female', 'female', False)
+        engine.add(3, 'male', 'any', False)
+        
+        # Mutual preference: user 2 only accepts females
+        assert engine.find('male', 'female') == 1
+        assert engine.find('female', 'female') == 1
+        print("  ✅ Mutual gender filter works")
+        
+        # VIP first, even if they joined later
+        engine.add(4, 'female', 'any', True)
+        assert engine.find('male', 'any') == 4
+        print("  ✅ VIP priority works")
+        
+        # Searcher is never matched with themselves
+        assert engine.find('male', 'male', exclude=3) is None
+        engine.remove(4)
+        assert engine.find('male', 'any') == 1 and len(engine) == 3
+        print("  ✅ Queue removal works")
+        
+        # Batched tick pairs the whole queue in one transaction
+        from database import Database
+        db = Database(':memory:')
+        for user_id, gender in ((1, 'male'), (2, 'female'), (3, 'male'), (4, 'female'), (5, 'male')):
+            db.create_user(user_id, gender, 20)
+            db.atomic_join_queue(user_id, 'female' if gender == 'male' else 'any')
+        assert db.matchmaker.queued() == [1, 2, 3, 4, 5]
+        pairs = db.atomic_match_pending()
+        assert [pair[:2] for pair in pairs] == [(1, 2), (3, 4)]
+        assert db.get_partner_id(4) == 3 and db.get_user_state(5)['state'] == 'SEARCHING'
+        assert db.atomic_match_pending() == []
+        print("  ✅ Batched matching works")
+        
+        print("✅ Matchmaking tests passed!\n")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Matchmaking test failed: {e}\n")
+        return False
+
+
+def test_query_plans():
+    """Fail if a hot query falls back to a full table scan"""
+    print("Testing query plans...")
+    
+    try:
+        from database import Database
+        
+        db = Database(':memory:')
+        for user_id in range(1, 5):
+            db.create_user(user_id, 'male' if user_id % 2 else 'female', 20, username=f'user{user_id}')
+        db.add_rating(1, 2, 'scam')
+        db.atomic_join_queue(2, 'any')
+        db.atomic_join_queue(4, 'male')
+        
+        # Capture the SQL that the real methods run
+        conn = db.get_connection()
+        statements = []
+        conn.set_trace_callback(statements.append)
+        db.get_user_ratings(2)
+        db.get_scam_count(2)
+        db.get_user_by_username('@User3')
+        db.get_stats()
+        db.get_recent_reports()
+        db.get_broadcast_recipients(0, 100)
+        db.get_vip_page(after=('2030-01-01', 1))
+        db.get_vip_page(before=('2030-01-01', 1))
+        db.check_and_expire_vips()
+        db.atomic_match(1, 'female')
+        conn.set_trace_callback(None)
+        
+        checked = 0
+        for sql in statements:
+            # Unfiltered COUNT(*) totals scan by definition; only filtered reads matter
+            if not sql.lstrip().upper().startswith('SELECT') or 'WHERE' not in sql.upper():
+                continue
+            plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+            for step in plan:
+                assert not (step.startswith('SCAN') and 'INDEX' not in step), f"{step} in: {' '.join(sql.split())}"
+                assert 'TEMP B-TREE FOR ORDER BY' not in step or 'GROUP BY' in sql, f"{step} in: {' '.join(sql.split())}"
+            checked += 1
+        
+        print(f"  ✅ {checked} hot queries use indexes")
+        print("✅ Query plan tests passed!\n")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Query plan test failed: {e}\n")
+        return False
+
+
+def test_async_database():
+    """Test async database facade"""
+    print("Testing async database...")
+    
+    try:
+        import asyncio
+        import tempfile
+        from database import Database, AsyncDatabase
+        
+        # The DB thread opens its own connection, so use a file instead of :memory:
+        tmp_dir = tempfile.mkdtemp()
+        db = Database(os.path.join(tmp_dir, 'test.db'))
+        async_db = AsyncDatabase(db)
+        
+        async def scenario():
+            await async_db.create_user(1, 'male', 20)
+            await async_db.create_user(2, 'female', 22)
+            joined, _ = await async_db.atomic_join_queue(2, 'any')
+            assert joined
+            matched, partner_id, _ = await async_db.atomic_match(1, 'any')
+            assert matched and partner_id == 2
+            assert await async_db.get_partner_id(2) == 1
+            
+            # Matching invalidated both cached rows; the next read refills the cache
+            assert (await async_db.get_user(1))['state'] == 'CHATTING'
+            hits = db.user_cache_stats()['hits']
+            assert (await async_db.get_user(1))['state'] == 'CHATTING'
+            assert db.user_cache_stats()['hits'] == hits + 1  # answered without the DB thread
+        
+        asyncio.run(scenario())
+        async_db.close()
+        print("  ✅ Async matchmaking works")
+        
+        # Sync API stays usable for scripts
+        assert db.get_partner_id(1) == 2
+        print("  ✅ Sync API still works")
+        
+        # Routing table is rebuilt from the DB on startup and cleared on end
+        restarted = Database(os.path.join(tmp_dir, 'test.db'))
+        assert restarted.get_route(1) == db.get_route(1)
+        assert restarted.get_route(2)[0] == 1
+        db.atomic_end_chat(1)
+        assert db.get_route(1) is None and db.get_route(2) is None
+        print("  ✅ Routing table works")
+        
+        print("✅ Async database tests passed!\n")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Async database test failed: {e}\n")
+        return False
+
+
 def test_utils():
     """Test utility functions"""
     print("Testing utilities...")
     
     try:
-        from utils import MessageFilter, ValidationHelper, TextFormatter
+        import time
+        from utils import MessageFilter, ValidationHelper, TextFormatter, TTLCache, RateLimiter
         
         # Test URL detection
         assert MessageFilter.contains_url("Check out http://example.com")
@@ -80,6 +397,32 @@ def test_utils():
         assert '👑' in profile_text
         print("  ✅ Text formatting works")
         
+        # Test TTL/LRU cache
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set('a', True)
+        cache.set('b', False, ttl=0)
+        assert cache.get('a') is True
+        assert cache.get('b') is None  # expired immediately
+        cache.set('c', 1)
+        cache.set('d', 2)
+        assert cache.get('a') is None  # evicted as least recently used
+        assert cache.stats()['hits'] == 1
+        print("  ✅ TTL cache works")
+        
+        # Test GCRA rate limiter: burst of 3, then one every 0.05s
+        limiter = RateLimiter(max_requests=3, time_window=0.15)
+        assert all(limiter.is_allowed(1) for _ in range(3))
+        assert not limiter.is_allowed(1)
+        assert limiter.is_allowed(2)  # users are independent
+        assert limiter.get_remaining_time(1) == 1 and limiter.get_remaining_time(3) == 0
+        time.sleep(0.06)
+        assert limiter.is_allowed(1) and not limiter.is_allowed(1)
+        assert limiter.evict_idle() == 1 and len(limiter) == 1  # user 2 has recovered
+        time.sleep(0.16)
+        assert limiter.evict_idle() == 1 and len(limiter) == 0
+        assert all(limiter.is_allowed(1) for _ in range(3))  # full burst after eviction
+        print("  ✅ Rate limiter works")
+        
         print("✅ Utility tests passed!\n")
         return True
         
@@ -190,6 +533,519 @@ def test_files():
     return all_exist
 
 
+def test_sender():
+    """Test rate-limited outbound sender"""
+    print("Testing sender...")
+    
+    try:
+        import asyncio
+        import time
+        from telegram.error import Forbidden, RetryAfter
+        from sender import MessageSender
+        
+        class RecordingBot:
+            """Stands in for telegram.Bot: records sends, fails on request"""
+            def __init__(self):
+                self.sent = []
+                self.flood_once = {3}
+            
+            async def send_message(self, chat_id, text, **kwargs):
+                if chat_id in self.flood_once:
+                    self.flood_once.discard(chat_id)
+                    raise RetryAfter(0)
+                if chat_id == 4:
+                    raise Forbidden("bot was blocked by the user")
+                self.sent.append((chat_id, time.monotonic()))
+        
+        async def scenario():
+            sender = MessageSender(global_rate=50, per_chat_rate=10, max_concurrency=5)
+            bot = RecordingBot()
+            progress_calls = []
+            
+            async def progress(sent, failed):
+                progress_calls.append((sent, failed))
+            
+            messages = ({'chat_id': chat_id, 'text': 'hi'} for chat_id in range(1, 11))
+            stats = await sender.send_many(bot, messages, progress=progress, progress_every=5)
+            assert stats == {'sent': 9, 'failed': 1}
+            assert sorted(chat_id for chat_id, _ in bot.sent) == [1, 2, 3, 5, 6, 7, 8, 9, 10]
+            assert len(progress_calls) == 2
+            print("  ✅ Fan-out, RetryAfter retry and progress work")
+            
+            # Per-chat spacing: 3 messages to one chat at 10/s take >= 0.2s
+            bot.sent.clear()
+            started = time.monotonic()
+            await sender.send_many(bot, ({'chat_id': 20, 'text': 'x'} for _ in range(3)))
+            assert bot.sent[-1][1] - started >= 0.19
+            print("  ✅ Per-chat rate limit works")
+        
+        asyncio.run(scenario())
+        
+        print("✅ Sender tests passed!\n")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Sender test failed: {e}\n")
+        return False
+
+
+def test_webhook():
+    """Test webhook endpoint with a recorded update"""
+    print("Testing webhook...")
+    
+    try:
+        import asyncio
+        from types import SimpleNamespace
+        from aiohttp.test_utils import TestClient, TestServer
+        from webhook import build_web_app, serve_webhook, SECRET_HEADER
+        
+        recorded_update = {
+            'update_id': 1,
+            'message': {
+                'message_id': 1, 'date': 0, 'text': 'hi',
+                'chat': {'id': 5, 'type': 'private'},
+                'from': {'id': 5, 'is_bot': False, 'first_name': 'Test'},
+            },
+        }
+        
+        async def scenario():
+            application = SimpleNamespace(update_queue=asyncio.Queue(), bot=None, running=True)
+            client = TestClient(TestServer(build_web_app(application, 'secret')))
+            await client.start_server()
+            try:
+                response = await client.post('/webhook', json=recorded_update, headers={SECRET_HEADER: 'wrong'})
+                assert response.status == 403 and application.update_queue.empty()
+                print("  ✅ Secret token is enforced")
+                
+                for body in ([recorded_update], "update", 1):
+                    response = await client.post('/webhook', json=body, headers={SECRET_HEADER: 'secret'})
+                    assert response.status == 400 and application.update_queue.empty()
+                print("  ✅ Non-object bodies are rejected")
+                
+                response = await client.post('/webhook', json=recorded_update, headers={SECRET_HEADER: 'secret'})
+                assert response.status == 200
+                update = application.update_queue.get_nowait()
+                assert update.update_id == 1 and update.effective_user.id == 5
+                print("  ✅ Updates are queued")
+                
+                response = await client.get('/healthz')
+                assert response.status == 200 and (await response.json())['status'] == 'ok'
+                print("  ✅ Health endpoint works")
+            finally:
+                await client.close()
+        
+        class FakeApplication:
+            """Records the lifecycle calls serve_webhook makes"""
+            def __init__(self):
+                self.calls = []
+                self.running = False
+                self.update_queue = asyncio.Queue()
+                self.post_stop = None
+            async def initialize(self):
+                self.calls.append('initialize')
+            async def post_init(self, app):
+                self.calls.append('post_init')
+            async def start(self):
+                self.running = True
+                self.calls.append('start')
+            async def stop(self):
+                self.running = False
+                self.calls.append('stop')
+            async def shutdown(self):
+                self.calls.append('shutdown')
+            async def post_shutdown(self, app):
+                self.calls.append('post_shutdown')
+        
+        async def port_taken():
+            blocker = await asyncio.start_server(lambda r, w: None, '127.0.0.1', 0)
+            port = blocker.sockets[0].getsockname()[1]
+            application = FakeApplication()
+            try:
+                await serve_webhook(application, url='', listen='127.0.0.1', port=port, path='/webhook',
+                                    secret_token='secret', max_connections=10)
+                raise AssertionError("bind should fail")
+            except OSError:
+                pass
+            finally:
+                blocker.close()
+                await blocker.wait_closed()
+            assert application.calls == ['initialize', 'post_init', 'start', 'stop', 'shutdown', 'post_shutdown']
+            print("  ✅ Failed startup still shuts down")
+        
+        asyncio.run(scenario())
+        asyncio.run(port_taken())
+        
+        print("✅ Webhook tests passed!\n")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Webhook test failed: {e}\n")
+        return False
+
+
+def test_update_processor():
+    """Test per-user ordering with concurrent update processing"""
+    print("Testing update processor...")
+    
+    try:
+        import asyncio
+        from types import SimpleNamespace
+        from update_processor import PerUserUpdateProcessor
+        
+        def update_from(user_id):
+            return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+        
+        async def scenario():
+            processor = PerUserUpdateProcessor(8)
+            log = []
+            
+            async def handle(user_id, seq):
+                log.append((user_id, seq, 'start'))
+                await asyncio.sleep(0.02 if seq == 0 else 0)  # first update is slow
+                log.append((user_id, seq, 'end'))
+            
+            # Same order PTB uses: one task per update, created in arrival order
+            updates = [(user_id, seq) for seq in range(3) for user_id in (1, 2, 3)]
+            await asyncio.gather(*(
+                processor.process_update(update_from(user_id), handle(user_id, seq))
+                for user_id, seq in updates
+            ))
+            
+            for user_id in (1, 2, 3):
+                events = [(seq, kind) for uid, seq, kind in log if uid == user_id]
+                assert events == [(0, 'start'), (0, 'end'), (1, 'start'), (1, 'end'), (2, 'start'), (2, 'end')]
+            assert processor.in_flight_users == 0
+            print("  ✅ Per-user order is kept")
+        
+        async def blocked_user_scenario():
+            # User 1 fills more than every slot; user 2 must still get through.
+            processor = PerUserUpdateProcessor(4)
+            release = asyncio.Event()
+            done = []
+            
+            async def handle(user_id, seq):
+                if (user_id, seq) == (1, 0):
+                    await release.wait()
+                done.append((user_id, seq))
+            
+            tasks = [
+                asyncio.create_task(processor.process_update(update_from(1), handle(1, seq)))
+                for seq in range(5)
+            ]
+            tasks.append(asyncio.create_task(processor.process_update(update_from(2), handle(2, 0))))
+            for _ in range(20):
+                await asyncio.sleep(0)
+            assert done == [(2, 0)], done  # finished while user 1 is still blocked
+            release.set()
+            await asyncio.gather(*tasks)
+            assert done == [(2, 0)] + [(1, seq) for seq in range(5)]
+            assert processor.in_flight_users == 0
+            print("  ✅ A blocked user doesn't hold up other users")
+        
+        asyncio.run(scenario())
+        asyncio.run(blocked_user_scenario())
+        
+        print("✅ Update processor tests passed!\n")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Update processor test failed: {e}\n")
+        return False
+
+
+def test_request_context():
+    """Test per-update memoization and DB call counting"""
+    print("Testing request context...")
+    
+    try:
+        import asyncio
+        import tempfile
+        from datetime import datetime
+        from telegram import Chat, Message, Update, User
+        from telegram.ext import Application, ContextTypes
+        from database import Database, AsyncDatabase
+        from request_context import RequestContext, QueryStats, count_db_calls, update_kind
+        
+        db = Database(os.path.join(tempfile.mkdtemp(), 'test.db'))
+        async_db = AsyncDatabase(db)
+        RequestContext.database = async_db
+        application = Application.builder().token('1:test').context_types(ContextTypes(context=RequestContext)).build()
+        
+        def make_update(text):
+            message = Message(1, datetime.now(), Chat(7, 'private'), from_user=User(7, 'u', False), text=text)
+            return Update(1, message=message)
+        
+        assert update_kind(make_update('/search')) == 'command'
+        assert update_kind(make_update('hi')) == 'message'
+        
+        async def scenario():
+            await async_db.create_user(7, 'male', 20, language='ru')
+            stats = QueryStats()
+            update = make_update('/search')
+            context = application.context_types.context.from_update(update, application)
+            assert isinstance(context, RequestContext)
+            
+            with count_db_calls(update_kind(update), stats) as calls:
+                assert (await context.user_row())['gender'] == 'male'
+                assert await context.user_lang() == 'ru'
+                assert (await context.user_state())['state'] == 'IDLE'
+                assert (await context.user_state())['state'] == 'IDLE'
+                assert context.partner_id() is None
+                state_calls = calls.count('get_user_state')
+                await async_db.atomic_join_queue(7, 'any')
+                context.forget()
+                assert (await context.user_state())['state'] == 'SEARCHING'
+            
+            assert state_calls == 1 and calls.count('get_user_state') == 2
+            assert stats.summary()['command']['db_calls'] == len(calls)
+        
+        asyncio.run(scenario())
+        async_db.close()
+        print("  ✅ Lookups are memoized per update")
+        print("  ✅ DB calls are counted per update type")
+        
+        print("✅ Request context tests passed!\n")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Request context test failed: {e}\n")
+        return False
+
+
+def test_metrics():
+    """Test metrics rendering, the HTTP endpoint and DB instrumentation"""
+    print("Testing metrics...")
+    
+    try:
+        import asyncio
+        import metrics
+        from database import Database
+        
+        registry = metrics.Registry()
+        calls = metrics.Counter('test_calls_total', 'Calls', ('method',), registry=registry)
+        latency = metrics.Histogram('test_seconds', 'Latency', registry=registry, buckets=(0.1, 1))
+        depth = metrics.Gauge('test_depth', 'Depth', ('bucket',), registry=registry, fn=lambda: {('a',): 3})
+        calls.inc('sendMessage')
+        calls.inc('sendMessage', amount=2)
+        latency.observe(0.05)
+        latency.observe(5)
+        text = registry.render()
+        assert 'test_calls_total{method="sendMessage"} 3' in text
+        assert 'test_seconds_bucket{le="0.1"} 1' in text and 'test_seconds_bucket{le="+Inf"} 2' in text
+        assert 'test_seconds_count 2' in text and 'test_depth{bucket="a"} 3' in text
+        print("  ✅ Prometheus text format works")
+        
+        async def scrape():
+            server = await metrics.serve('127.0.0.1', 0, registry)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            response = (await reader.read()).decode()
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return response
+        
+        response = asyncio.run(scrape())
+        assert response.startswith('HTTP/1.1 200') and 'test_depth{bucket="a"} 3' in response
+        print("  ✅ Metrics endpoint works")
+        
+        db = Database(':memory:')
+        matched_before = metrics.TIME_TO_MATCH.count()
+        transactions_before = metrics.DB_TRANSACTION.count('atomic_match')
+        db.create_user(1, 'male', 20)
+        db.create_user(2, 'female', 20)
+        db.atomic_join_queue(2, 'any')
+        assert db.atomic_match(1, 'any')[0]
+        assert metrics.DB_TRANSACTION.count('atomic_match') == transactions_before + 1
+        assert metrics.DB_LOCK_WAIT.count('atomic_match') >= 1
+        assert metrics.TIME_TO_MATCH.count() == matched_before + 1  # only the queued side waited
+        print("  ✅ DB and matchmaking instrumentation works")
+        
+        print("✅ Metrics tests passed!\n")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Metrics test failed: {e}\n")
+        return False
+
+
+def test_translations():
+    """Test the compiled translation catalog and button index"""
+    print("Testing translations...")
+    
+    try:
+        from translations import BUTTON_ACTIONS, TRANSLATIONS, get_text
+        
+        assert get_text("btn_search", "ru") == TRANSLATIONS["btn_search"]["ru"]
+        assert get_text("btn_search", "de") == get_text("btn_search", None) == TRANSLATIONS["btn_search"]["en"]
+        assert get_text("no_such_key", "ru") == "no_such_key"
+        print("  ✅ Lookup and fallbacks work")
+        
+        template = TRANSLATIONS["admin_viplist_header"]["hy"]
+        assert get_text("admin_viplist_header", "hy", count=3) == template.format(count=3)
+        assert get_text("admin_viplist_header", "hy") == template  # no kwargs: text as is
+        assert get_text("admin_viplist_header", "hy", other=1) == template  # missing field: unformatted
+        print("  ✅ Formatting works")
+        
+        for key in ("btn_search", "btn_next", "btn_stop", "btn_profile", "btn_vip", "btn_rules", "btn_help"):
+            for label in TRANSLATIONS[key].values():
+                assert BUTTON_ACTIONS[label] == key
+        assert "hello" not in BUTTON_ACTIONS
+        print("  ✅ Button labels map to actions in every language")
+        
+        print("✅ Translation tests passed!\n")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Translation test failed: {e}\n")
+        return False
+
+
+def test_logging():
+    """Test JSON log formatting, sampling and the queued logging setup"""
+    print("Testing logging...")
+    
+    root = logging.getLogger()
+    saved_handlers, saved_level = list(root.handlers), root.level
+    try:
+        import json
+        import os
+        import tempfile
+        from logging_config import JsonFormatter, SamplingFilter, parse_mapping, setup_logging
+        
+        assert parse_mapping('httpx=WARNING, database=DEBUG,bad') == {'httpx': 'WARNING', 'database': 'DEBUG'}
+        record = logging.makeLogRecord({
+            'name': 'bot', 'levelname': 'INFO', 'msg': 'Matched %s <-> %s', 'args': (1, 2),
+            'event': 'match', 'user_id': 1, 'partner_id': 2,
+        })
+        entry = json.loads(JsonFormatter().format(record))
+        assert entry['msg'] == 'Matched 1 <-> 2' and entry['logger'] == 'bot'
+        assert entry['event'] == 'match' and entry['user_id'] == 1 and entry['partner_id'] == 2
+        assert entry['ts'].endswith('Z') and 'args' not in entry
+        print("  ✅ JSON formatter includes extra fields")
+        
+        sampler = SamplingFilter({'relay': '10', 'match': '1'})
+        relays = [logging.makeLogRecord({'event': 'relay'}) for _ in range(100)]
+        assert sum(sampler.filter(r) for r in relays) == 10
+        assert sampler.filter(logging.makeLogRecord({'event': 'match'}))
+        assert sampler.filter(logging.makeLogRecord({}))
+        print("  ✅ Sampling keeps 1 in N")
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bot.log')
+            stop = setup_logging('INFO', {'noisy': 'WARNING'}, 'json', {'relay': 2}, path)
+            log = logging.getLogger('test_logging')
+            for _ in range(4):
+                log.info("relay", extra={'event': 'relay', 'user_id': 7})
+            log.debug("dropped by level")
+            logging.getLogger('noisy').info("dropped by override")
+            log.info("kept", extra={'event': 'match'})
+            queue_ids = [1]
+            log.info("queue %s", queue_ids)
+            queue_ids.append(2)  # changed after logging: the record was rendered already
+            try:
+                raise KeyError('boom')
+            except KeyError:
+                log.exception("failed")
+            stop()  # flushes the queue
+            stop()  # idempotent, like the exit hook that would run later
+            with open(path, encoding='utf-8') as f:
+                lines = [json.loads(line) for line in f]
+        assert [line['msg'] for line in lines] == ['relay', 'relay', 'kept', 'queue [1]', 'failed']
+        assert lines[0]['user_id'] == 7 and "KeyError: 'boom'" in lines[-1]['exc']
+        print("  ✅ Queued logging setup works")
+        
+        print("✅ Logging tests passed!\n")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Logging test failed: {e}\n")
+        return False
+    finally:
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        for handler in saved_handlers:
+            root.addHandler(handler)
+        root.setLevel(saved_level)
+
+
+def test_moderation():
+    """Test precompiled moderation engine"""
+    print("Testing moderation...")
+    
+    try:
+        import tempfile
+        from moderation import ModerationEngine, ModerationService, AhoCorasick
+        from config import URL_PATTERNS, BAD_WORDS
+        
+        engine = ModerationEngine(URL_PATTERNS, BAD_WORDS)
+        assert engine.check("hello, how are you?").allowed
+        assert engine.check("Visit WWW.example.com").link == 'www.'
+        assert engine.check("join @mychannel").link == '@mychannel'
+        assert engine.check("see example.org").link == 'example.org'
+        assert engine.check("This is a SCAM").bad_word == 'scam'
+        print("  ✅ Links and bad words detected")
+        
+        automaton = AhoCorasick(['he', 'she', 'his', 'hers'])
+        assert automaton.search('ushers') == 'she'
+        assert automaton.search('ahis') == 'his'
+        assert automaton.search('xyz') is None
+        print("  ✅ Aho-Corasick automaton works")
+        
+        # Both word matchers (substring checks and automaton) agree
+        words = [f'bad{i:03d}' for i in range(ModerationEngine.AUTOMATON_MIN_WORDS)]
+        large = ModerationEngine([], words)
+        small = ModerationEngine([], words[:5])
+        assert large.check("so BAD042 really").bad_word == 'bad042'
+        assert small.check("so bad003!").bad_word == 'bad003'
+        assert large.check("all good").allowed and small.check("all good").allowed
+        print("  ✅ Large word lists use the automaton")
+        
+        # Look-alike spellings collapse to the listed term
+        engine = ModerationEngine([], ['scam', 'сука'])
+        assert engine.check("ѕсаm").bad_word == 'scam'  # Cyrillic letters
+        assert engine.check("5C4M").bad_word == 'scam'  # leetspeak
+        assert engine.check("s\u200bcam").bad_word == 'scam'  # zero-width space
+        assert engine.check("ＳＣＡＭ").bad_word == 'scam'  # fullwidth
+        assert engine.check("cyka").bad_word == 'сука'  # Latin spelling of a Cyrillic term
+        assert engine.check("scan me").allowed
+        print("  ✅ Homoglyphs and leetspeak normalized")
+        
+        # Word file is merged with the base list and hot-swapped on change
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'words.txt')
+            service = ModerationService([], ['spam'], path)
+            assert not service.reload() and service.engine.word_count == 1  # no file yet
+            
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write("# comment\nfoo\n\nbar  # inline comment\n")
+            assert service.reload()
+            assert service.check("FOO").bad_word == 'foo' and service.check("spam").bad_word == 'spam'
+            assert not service.reload()  # unchanged
+            
+            old_engine = service.engine
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write("\n".join(f'term{i:05d}' for i in range(1000)))
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+            assert service.reload()
+            assert service.engine is not old_engine and service.engine.word_count == 1001
+            assert service.check("foo").allowed and service.check("x term00999 x").bad_word == 'term00999'
+            assert old_engine.check("foo").bad_word == 'foo'  # readers holding the old engine are unaffected
+            
+            os.remove(path)
+            assert service.reload() and service.engine.word_count == 1
+        print("  ✅ Word file reloads and swaps atomically")
+        
+        print("✅ Moderation tests passed!\n")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Moderation test failed: {e}\n")
+        return False
+
+
 def run_all_tests():
     """Run all tests"""
     print("=" * 60)
@@ -203,7 +1059,18 @@ def run_all_tests():
     results.append(("Imports", test_imports()))
     results.append(("Config", test_config()))
     results.append(("Database", test_database()))
+    results.append(("Async Database", test_async_database()))
+    results.append(("Query Plans", test_query_plans()))
+    results.append(("Matchmaking", test_matchmaking()))
     results.append(("Utils", test_utils()))
+    results.append(("Moderation", test_moderation()))
+    results.append(("Sender", test_sender()))
+    results.append(("Webhook", test_webhook()))
+    results.append(("Update Processor", test_update_processor()))
+    results.append(("Request Context", test_request_context()))
+    results.append(("Metrics", test_metrics()))
+    results.append(("Translations", test_translations()))
+    results.append(("Logging", test_logging()))
     
     print("=" * 60)
     print("Test Results Summary")
@@ -424,10 +424,20 @@ TRANSLATIONS = {
         "ru": "{index}. {user_label}\n   ♾ Пожизненный VIP",
         "hy": "{index}. {user_label}\n   ♾ Ցմահ VIP",
     },
+    "admin_viplist_prev": {
+        "en": "⬅️ Previous",
+        "ru": "⬅️ Назад",
+        "hy": "⬅️ Նախորդ",
+    },
+    "admin_viplist_next": {
+        "en": "Next ➡️",
+        "ru": "Далее ➡️",
+        "hy": "Հաջորդ ➡️",
+    },
     "help_admin_block": {
-        "en": "\n\nAdmin commands:\n/commands - Show admin command list\n/stats - Bot statistics\n/reports - Recent reports\n/ban <user_id | @username> - Ban user\n/unban <user_id | @username> - Unban user\n/unbanall - Unban everyone\n/givevip <user_id | @username> <days> - Grant VIP for a number of days\n/takevip <user_id | @username> - Remove VIP\n/viplist - Show VIP users and days left\n/broadcast <message> - Send announcement to all users",
-        "ru": "\n\nКоманды администратора:\n/commands - Показать список команд администратора\n/stats - Статистика бота\n/reports - Последние жалобы\n/ban <user_id | @username> - Забанить пользователя\n/unban <user_id | @username> - Разбанить пользователя\n/unbanall - Разбанить всех\n/givevip <user_id | @username> <days> - Выдать VIP на нужное число дней\n/takevip <user_id | @username> - Снять VIP\n/viplist - Показать VIP пользователей и сколько дней осталось\n/broadcast <message> - Отправить объявление всем пользователям",
-        "hy": "\n\nԱդմինի հրամաններ՝\n/commands - Ցույց տալ ադմինի հրամանների ցանկը\n/stats - Բոտի վիճակագրություն\n/reports - Վերջին բողոքները\n/ban <user_id | @username> - Արգելափակել օգտատիրոջը\n/unban <user_id | @username> - Ապաարգելափակել օգտատիրոջը\n/unbanall - Ապաարգելափակել բոլորին\n/givevip <user_id | @username> <days> - Տալ VIP նշված օրերի համար\n/takevip <user_id | @username> - Հեռացնել VIP\n/viplist - Ցույց տալ VIP օգտատերերին և մնացած օրերը\n/broadcast <message> - Հայտարարություն ուղարկել բոլոր օգտատերերին",
+        "en": "\n\nAdmin commands:\n/commands - Show admin command list\n/stats - Bot statistics\n/reports - Recent reports\n/ban <user_id | @username> - Ban user\n/unban <user_id | @username> - Unban user\n/unbanall - Unban everyone\n/givevip <user_id | @username> <days> - Grant VIP for a number of days\n/takevip <user_id | @username> - Remove VIP\n/viplist - Show VIP users and days left\n/broadcast <message> - Send announcement to all users\n/broadcast_status - Broadcast progress\n/broadcast_cancel [job_id] - Cancel running broadcasts\n/reloadwords - Reload the moderation word list",
+        "ru": "\n\nКоманды администратора:\n/commands - Показать список команд администратора\n/stats - Статистика бота\n/reports - Последние жалобы\n/ban <user_id | @username> - Забанить пользователя\n/unban <user_id | @username> - Разбанить пользователя\n/unbanall - Разбанить всех\n/givevip <user_id | @username> <days> - Выдать VIP на нужное число дней\n/takevip <user_id | @username> - Снять VIP\n/viplist - Показать VIP пользователей и сколько дней осталось\n/broadcast <message> - Отправить объявление всем пользователям\n/broadcast_status - Ход рассылки\n/broadcast_cancel [job_id] - Отменить текущие рассылки\n/reloadwords - Перезагрузить список запрещённых слов",
+        "hy": "\n\nԱդմինի հրամաններ՝\n/commands - Ցույց տալ ադմինի հրամանների ցանկը\n/stats - Բոտի վիճակագրություն\n/reports - Վերջին բողոքները\n/ban <user_id | @username> - Արգելափակել օգտատիրոջը\n/unban <user_id | @username> - Ապաարգելափակել օգտատիրոջը\n/unbanall - Ապաարգելափակել բոլորին\n/givevip <user_id | @username> <days> - Տալ VIP նշված օրերի համար\n/takevip <user_id | @username> - Հեռացնել VIP\n/viplist - Ցույց տալ VIP օգտատերերին և մնացած օրերը\n/broadcast <message> - Հայտարարություն ուղարկել բոլոր օգտատերերին\n/broadcast_status - Ուղարկման ընթացքը\n/broadcast_cancel [job_id] - Չեղարկել ընթացիկ ուղարկումները\n/reloadwords - Վերաբեռնել արգելված բառերի ցանկը",
     },
 
     "admin_commands_list": {
@@ -442,7 +452,10 @@ TRANSLATIONS = {
             "/givevip <user_id | @username> <days> - Give VIP\n"
             "/takevip <user_id | @username> - Remove VIP\n"
             "/viplist - Show VIP users and days left\n"
-            "/broadcast <message> - Send message to all users"
+            "/broadcast <message> - Send message to all users\n"
+            "/broadcast_status - Broadcast progress\n"
+            "/broadcast_cancel [job_id] - Cancel running broadcasts\n"
+            "/reloadwords - Reload the moderation word list"
         ),
         "ru": (
             "🛠 Команды администратора:\n\n"
@@ -455,7 +468,10 @@ TRANSLATIONS = {
             "/givevip <user_id | @username> <days> - Выдать VIP\n"
             "/takevip <user_id | @username> - Снять VIP\n"
             "/viplist - Показать VIP и оставшиеся дни\n"
-            "/broadcast <message> - Рассылка всем пользователям"
+            "/broadcast <message> - Рассылка всем пользователям\n"
+            "/broadcast_status - Ход рассылки\n"
+            "/broadcast_cancel [job_id] - Отменить текущие рассылки\n"
+            "/reloadwords - Перезагрузить список запрещённых слов"
         ),
         "hy": (
             "🛠 Ադմինի հրամաններ՝\n\n"
@@ -468,7 +484,10 @@ TRANSLATIONS = {
             "/givevip <user_id | @username> <days> - Տալ VIP\n"
             "/takevip <user_id | @username> - Հեռացնել VIP\n"
             "/viplist - Ցուցադրել VIP-ներին և մնացած օրերը\n"
-            "/broadcast <message> - Ուղարկել բոլոր օգտատերերին"
+            "/broadcast <message> - Ուղարկել բոլոր օգտատերերին\n"
+            "/broadcast_status - Ուղարկման ընթացքը\n"
+            "/broadcast_cancel [job_id] - Չեղարկել ընթացիկ ուղարկումները\n"
+            "/reloadwords - Վերաբեռնել արգելված բառերի ցանկը"
         ),
     },
     
@@ -667,6 +686,11 @@ TRANSLATIONS = {
         "ru": "❗️ Не удалось отправить сообщение. Возможно, собеседник вышел.",
         "hy": "❗️ Չհաջողվեց ուղարկել հաղորդագրությունը։ Հնարավոր է՝ զրուցակիցը դուրս է եկել։",
     },
+    "rate_limited": {
+        "en": "⏳ Slow down! Try again in {seconds} s.",
+        "ru": "⏳ Не так быстро! Попробуйте снова через {seconds} с.",
+        "hy": "⏳ Մի շտապեք։ Կրկին փորձեք {seconds} վ հետո։",
+    },
 
     "sharelink_prompt": {
         "en": "🔗 Share your Telegram link with your partner?\n\nThis will send: https://t.me/{username}",
@@ -716,6 +740,44 @@ TRANSLATIONS = {
     },
 }
 
+LANGUAGES = ("en", "ru", "hy")
+DEFAULT_LANGUAGE = "en"
+
+
+def _compile_catalog(translations):
+    """
+    Flatten TRANSLATIONS into {lang: {key: (text, format)}} with the English
+    fallback already applied. `format` is the template's bound str.format, or
+    None when the text has no braces, so get_text never formats static text.
+    """
+    catalog = {}
+    for lang in LANGUAGES:
+        table = {}
+        for key, texts in translations.items():
+            text = texts.get(lang, texts.get(DEFAULT_LANGUAGE, key))
+            table[key] = (text, text.format if "{" in text or "}" in text else None)
+        catalog[lang] = table
+    return catalog
+
+
+def _button_actions(translations):
+    """Reverse index {button label in any language: btn_* key} for the reply keyboard"""
+    actions = {}
+    for key, texts in translations.items():
+        if not key.startswith("btn_"):
+            continue
+        for label in texts.values():
+            if actions.setdefault(label, key) != key:
+                raise ValueError(f"Button label {label!r} is used by both {actions[label]} and {key}")
+    return actions
+
+
+_CATALOG = _compile_catalog(TRANSLATIONS)
+_DEFAULT_TABLE = _CATALOG[DEFAULT_LANGUAGE]
+
+BUTTON_ACTIONS = _button_actions(TRANSLATIONS)
+
+
 def get_text(key: str, lang: str = "en", **kwargs) -> str:
     """Get translated text by key and language code.
     
@@ -727,14 +789,14 @@ def get_text(key: str, lang: str = "en", **kwargs) -> str:
     Returns:
         Translated and formatted text
     """
-    if lang not in ("en", "ru", "hy"):
-        lang = "en"
-    
-    text = TRANSLATIONS.get(key, {}).get(lang, TRANSLATIONS.get(key, {}).get("en", key))
+    entry = _CATALOG.get(lang, _DEFAULT_TABLE).get(key)
+    if entry is None:
+        return key
     
-    if kwargs:
+    text, format_text = entry
+    if kwargs and format_text:
         try:
-            return text.format(**kwargs)
+            return format_text(**kwargs)
         except KeyError:
             return text
     
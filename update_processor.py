@@ -0,0 +1,81 @@
+"""
+Update processing for Anonymous Chat Bot
+Runs updates from different users concurrently while keeping each user's updates in order
+"""
+
+from collections import deque
+
+from telegram.ext import BaseUpdateProcessor
+
+from request_context import count_db_calls, update_kind
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process up to max_concurrent_updates updates at once, but serialize
+    updates that belong to the same user (e.g. /next and the messages sent
+    right after it). Updates without a user or chat run unordered.
+
+    PTB holds one of its max_concurrent_updates slots for the whole of
+    do_process_update, so an update must never wait for its user there:
+    a user flooding updates would fill every slot with waiters and stall
+    everyone else. Instead, the first update of a user runs and drains
+    that user's FIFO of updates that arrived meanwhile; later updates are
+    appended to the FIFO and return at once, freeing their slot. A user
+    therefore occupies at most one slot, and only while an update of
+    theirs is actually running. PTB starts update tasks in arrival order,
+    so the FIFO keeps a user's updates in order.
+
+    Also counts the DB calls each update makes (request_context.query_stats).
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._pending = {}  # {key: deque of (update, coroutine)} for users with an update running
+
+    @staticmethod
+    def ordering_key(update):
+        user = getattr(update, 'effective_user', None)
+        if user:
+            return user.id
+        chat = getattr(update, 'effective_chat', None)
+        return chat.id if chat else None
+
+    @staticmethod
+    async def _run(update, coroutine):
+        with count_db_calls(update_kind(update)):
+            await coroutine
+
+    async def do_process_update(self, update, coroutine):
+        key = self.ordering_key(update)
+        if key is None:
+            await self._run(update, coroutine)
+            return
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            # The user's running update picks this one up when it is done.
+            pending.append((update, coroutine))
+            return
+
+        pending = self._pending[key] = deque()
+        try:
+            await self._run(update, coroutine)
+            while pending:
+                await self._run(*pending.popleft())
+        finally:
+            del self._pending[key]
+            # Only left over if we were cancelled (shutdown): don't leak un-awaited coroutines.
+            for _, coroutine in pending:
+                coroutine.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def in_flight_users(self):
+        """Users with an update running or waiting"""
+        return len(self._pending)
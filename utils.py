@@ -2,42 +2,42 @@
 Utility functions for Anonymous Chat Bot
 """
 
+import logging
+import math
 import re
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Optional
+from typing import Any, Hashable, List, Optional
 
 class MessageFilter:
     """Filter and validate messages"""
     
+    # Each pattern list is compiled once into a single alternation.
+    URL_RE = re.compile('|'.join([
+        r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+',
+        r'www\.[a-zA-Z0-9-]+\.[a-zA-Z]{2,}',
+        r't\.me/[a-zA-Z0-9_]+',
+        r'@[a-zA-Z0-9_]+',
+        r'[a-zA-Z0-9-]+\.(com|net|org|io|co|ru|me|uk|de|fr|it|es|cn|jp|in|br|au|tv|xyz)',
+    ]), re.IGNORECASE)
+    
+    PHONE_RE = re.compile('|'.join([
+        r'\+?[1-9]\d{1,14}',  # International format
+        r'\d{3}[-.\s]?\d{3}[-.\s]?\d{4}',  # US format
+        r'\(\d{3}\)\s?\d{3}[-.\s]?\d{4}',  # (123) 456-7890
+    ]))
+    
     @staticmethod
     def contains_url(text: str) -> bool:
         """Check if text contains any URLs or links"""
-        patterns = [
-            r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+',
-            r'www\.[a-zA-Z0-9-]+\.[a-zA-Z]{2,}',
-            r't\.me/[a-zA-Z0-9_]+',
-            r'@[a-zA-Z0-9_]+',
-            r'[a-zA-Z0-9-]+\.(com|net|org|io|co|ru|me|uk|de|fr|it|es|cn|jp|in|br|au|tv|xyz)',
-        ]
-        
-        for pattern in patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                return True
-        return False
+        return MessageFilter.URL_RE.search(text) is not None
     
     @staticmethod
     def contains_phone(text: str) -> bool:
         """Check if text contains phone numbers"""
-        patterns = [
-            r'\+?[1-9]\d{1,14}',  # International format
-            r'\d{3}[-.\s]?\d{3}[-.\s]?\d{4}',  # US format
-            r'\(\d{3}\)\s?\d{3}[-.\s]?\d{4}',  # (123) 456-7890
-        ]
-        
-        for pattern in patterns:
-            if re.search(pattern, text):
-                return True
-        return False
+        return MessageFilter.PHONE_RE.search(text) is not None
     
     @staticmethod
     def contains_bad_words(text: str, bad_words: List[str]) -> bool:
@@ -58,43 +58,111 @@ class MessageFilter:
 
 
 class RateLimiter:
-    """Simple rate limiter for preventing spam"""
+    """
+    Per-user rate limiter (GCRA): allows bursts of up to max_requests, then
+    one request every time_window / max_requests seconds.
+
+    State is a single float per user (the theoretical arrival time), so a
+    check is O(1) and memory is one dict slot per recently active user.
+    Users whose state has fully recovered carry no information and are
+    dropped by evict_idle().
+    """
     
-    def __init__(self, max_requests: int = 10, time_window: int = 60):
+    def __init__(self, max_requests: int = 10, time_window: float = 60):
         self.max_requests = max_requests
         self.time_window = time_window
-        self.requests = {}  # {user_id: [timestamp1, timestamp2, ...]}
+        self.interval = time_window / max_requests
+        self.tat = {}  # {user_id: theoretical arrival time (monotonic)}
     
     def is_allowed(self, user_id: int) -> bool:
-        """Check if user is allowed to make a request"""
-        now = datetime.now().timestamp()
-        
-        if user_id not in self.requests:
-            self.requests[user_id] = []
-        
-        # Remove old requests outside time window
-        self.requests[user_id] = [
-            ts for ts in self.requests[user_id]
-            if now - ts < self.time_window
-        ]
-        
-        # Check if under limit
-        if len(self.requests[user_id]) < self.max_requests:
-            self.requests[user_id].append(now)
-            return True
-        
-        return False
+        """Check if user is allowed to make a request (and count it if so)"""
+        now = time.monotonic()
+        tat = max(self.tat.get(user_id, now), now) + self.interval
+        if tat - now > self.time_window:
+            return False
+        self.tat[user_id] = tat
+        return True
     
     def get_remaining_time(self, user_id: int) -> Optional[int]:
         """Get remaining time until user can make request again"""
-        if user_id not in self.requests or len(self.requests[user_id]) < self.max_requests:
+        tat = self.tat.get(user_id)
+        if tat is None:
             return 0
-        
-        now = datetime.now().timestamp()
-        oldest = self.requests[user_id][0]
-        remaining = self.time_window - (now - oldest)
-        
-        return max(0, int(remaining))
+        remaining = tat + self.interval - self.time_window - time.monotonic()
+        return max(0, math.ceil(remaining))
+    
+    def evict_idle(self) -> int:
+        """Forget users back at a full burst allowance. Returns how many were dropped."""
+        now = time.monotonic()
+        idle = [user_id for user_id, tat in self.tat.items() if tat <= now]
+        for user_id in idle:
+            del self.tat[user_id]
+        return len(idle)
+    
+    def __len__(self) -> int:
+        return len(self.tat)
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire after a per-entry TTL.
+
+    Thread-safe, so it can be shared between the event loop and the DB thread.
+    """
+    
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # {key: (expires_at, value)}
+        self._lock = threading.Lock()
+    
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return cached value, or default if missing/expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[0] <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Store value, evicting the least recently used entries past max_size"""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+    
+    def invalidate(self, key: Hashable):
+        """Drop a single entry"""
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def clear(self):
+        """Drop all entries"""
+        with self._lock:
+            self._data.clear()
+    
+    def stats(self) -> dict:
+        """Hit/miss counters and current size"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'hit_rate': (self.hits / total) if total else 0.0,
+        }
+    
+    def __len__(self) -> int:
+        return len(self._data)
 
 
 class TextFormatter:
@@ -241,32 +309,43 @@ class TimeFormatter:
 
 
 class Logger:
-    """Simple logging helper"""
+    """Event logging helpers (structured records on the 'events' logger)"""
+    
+    log = logging.getLogger('events')
     
     @staticmethod
     def log_chat_start(user1_id: int, user2_id: int):
         """Log when a chat starts"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(f"[{timestamp}] Chat started: {user1_id} <-> {user2_id}")
+        Logger.log.info("Chat started: %s <-> %s", user1_id, user2_id,
+                        extra={'event': 'chat_start', 'user_id': user1_id, 'partner_id': user2_id})
     
     @staticmethod
     def log_chat_end(user1_id: int, user2_id: int, duration: int):
         """Log when a chat ends"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        duration_str = TimeFormatter.format_duration(duration)
-        print(f"[{timestamp}] Chat ended: {user1_id} <-> {user2_id} (Duration: {duration_str})")
+        Logger.log.info("Chat ended: %s <-> %s (Duration: %s)", user1_id, user2_id, _LazyDuration(duration),
+                        extra={'event': 'chat_end', 'user_id': user1_id, 'partner_id': user2_id, 'duration': duration})
     
     @staticmethod
     def log_report(reporter_id: int, target_id: int, reason: str):
         """Log when a user is reported"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(f"[{timestamp}] Report: User {target_id} reported by {reporter_id} ({reason})")
+        Logger.log.info("Report: User %s reported by %s (%s)", target_id, reporter_id, reason,
+                        extra={'event': 'report', 'user_id': target_id, 'reporter_id': reporter_id})
     
     @staticmethod
     def log_ban(user_id: int, reason: str = "Multiple reports"):
         """Log when a user is banned"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(f"[{timestamp}] Ban: User {user_id} banned ({reason})")
+        Logger.log.info("Ban: User %s banned (%s)", user_id, reason,
+                        extra={'event': 'ban', 'user_id': user_id})
+
+
+class _LazyDuration:
+    """Formats a duration only if the record is actually emitted"""
+    
+    def __init__(self, seconds: int):
+        self.seconds = seconds
+    
+    def __str__(self):
+        return TimeFormatter.format_duration(self.seconds)
 
 
 def escape_markdown(text: str) -> str:
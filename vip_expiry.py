@@ -0,0 +1,68 @@
+"""
+VIP expiry schedule for Anonymous Chat Bot
+Keeps upcoming vip_expires_at deadlines in a min-heap so expiries run on time
+"""
+
+import heapq
+import threading
+
+
+class ExpiryHeap:
+    """
+    Min-heap of (deadline, user_id), deadlines as Unix timestamps.
+
+    set() pushes a new entry instead of searching the heap for the old one;
+    _deadlines holds each user's current deadline, and stale entries are
+    skipped when they reach the top. SQLite stays the durable record: the
+    Database updates the heap after each commit and rebuilds it on startup.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}  # {user_id: current deadline}
+        self._lock = threading.Lock()
+
+    def set(self, user_id, deadline):
+        """Schedule user_id to expire at deadline (None = never)"""
+        with self._lock:
+            if deadline is None:
+                self._deadlines.pop(user_id, None)
+                return
+            self._deadlines[user_id] = deadline
+            heapq.heappush(self._heap, (deadline, user_id))
+            # Renewals leave stale entries behind; rebuild once they dominate.
+            if len(self._heap) > 2 * len(self._deadlines) + 64:
+                self._heap = [(d, uid) for uid, d in self._deadlines.items()]
+                heapq.heapify(self._heap)
+
+    def remove(self, user_id):
+        self.set(user_id, None)
+
+    def _drop_stale(self):
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_deadline(self):
+        """Earliest scheduled deadline, or None"""
+        with self._lock:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now, limit=None):
+        """Remove and return up to limit user_ids whose deadline is <= now, earliest first"""
+        due = []
+        with self._lock:
+            while limit is None or len(due) < limit:
+                self._drop_stale()
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                _, user_id = heapq.heappop(self._heap)
+                del self._deadlines[user_id]
+                due.append(user_id)
+        return due
+
+    def __contains__(self, user_id):
+        return user_id in self._deadlines
+
+    def __len__(self):
+        return len(self._deadlines)
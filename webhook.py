@@ -0,0 +1,139 @@
+"""
+Webhook runner for Anonymous Chat Bot
+Receives updates on an embedded aiohttp server instead of long polling
+
+Select it with BOT_MODE=webhook (see config.py). For local testing leave
+WEBHOOK_URL empty (nothing is registered with Telegram) and replay recorded
+updates, one JSON update per line, against the running bot:
+
+    python webhook.py replay updates.jsonl [http://127.0.0.1:8080/webhook]
+"""
+
+import asyncio
+import hmac
+import json
+import logging
+import signal
+import sys
+
+from aiohttp import ClientSession, web
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def build_web_app(application, secret_token: str, path: str = '/webhook') -> web.Application:
+    """
+    aiohttp app with two routes:
+    - POST {path}: validates the secret token header and queues the update
+    - GET /healthz: liveness plus update queue depth
+    """
+
+    async def receive_update(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret_token):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except (ValueError, UnicodeDecodeError):
+            return web.Response(status=400)
+        # Valid JSON that is not an object would make de_json raise (a 500 Telegram redelivers)
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+
+        # Acknowledge right away; PTB's update workers process the queue.
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+
+    async def healthz(request: web.Request) -> web.Response:
+        running = application.running
+        return web.json_response(
+            {'status': 'ok' if running else 'starting', 'pending_updates': application.update_queue.qsize()},
+            status=200 if running else 503,
+        )
+
+    app = web.Application()
+    app.router.add_post(path, receive_update)
+    app.router.add_get('/healthz', healthz)
+    return app
+
+
+async def serve_webhook(application, *, url: str, listen: str, port: int, path: str,
+                        secret_token: str, max_connections: int):
+    """
+    Run the PTB application behind the webhook server until SIGINT/SIGTERM.
+    Mirrors run_polling's lifecycle (post_init / post_stop / post_shutdown).
+    If url is empty the webhook is not registered with Telegram (local testing).
+    """
+    if not secret_token:
+        raise ValueError("WEBHOOK_SECRET_TOKEN is required in webhook mode")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    await application.initialize()
+    runner = None
+    try:
+        if application.post_init:
+            await application.post_init(application)
+
+        if url:
+            await application.bot.set_webhook(
+                url=url.rstrip('/') + path,
+                secret_token=secret_token,
+                max_connections=max_connections,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info("Webhook set to %s", url.rstrip('/') + path)
+        else:
+            logger.warning("WEBHOOK_URL is empty: not registering the webhook with Telegram")
+
+        await application.start()
+        runner = web.AppRunner(build_web_app(application, secret_token, path))
+        await runner.setup()
+        await web.TCPSite(runner, listen, port).start()
+        logger.info("Webhook server listening on %s:%s", listen, port)
+
+        await stop.wait()
+    finally:
+        # Undo only what started, so a failed startup (port taken, set_webhook
+        # error) still closes the DB and the metrics server in post_shutdown.
+        if runner is not None:
+            await runner.cleanup()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+async def replay(path: str, url: str, secret_token: str):
+    """POST recorded updates (one JSON object per line) to a running webhook server"""
+    async with ClientSession() as session:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                update = json.loads(line)
+                async with session.post(url, json=update, headers={SECRET_HEADER: secret_token}) as response:
+                    print(f"update {update.get('update_id')}: HTTP {response.status}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] != 'replay':
+        print("Usage: python webhook.py replay <updates.jsonl> [url]")
+        sys.exit(1)
+
+    from config import WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN
+
+    host = '127.0.0.1' if WEBHOOK_LISTEN in ('0.0.0.0', '::') else WEBHOOK_LISTEN
+    target = sys.argv[3] if len(sys.argv) > 3 else f"http://{host}:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    asyncio.run(replay(sys.argv[2], target, WEBHOOK_SECRET_TOKEN))